@@ -0,0 +1,109 @@
+"""Just enough of discord.py for the players to run without a gateway"""
+import time
+import asyncio
+import threading
+import numpy as np
+from typing import *
+
+FRAME_DURATION = 0.02
+
+
+class FakeMessage:
+    def __init__(self, content: str):
+        self.content = content
+
+    async def edit(self, content: str = None):
+        self.content = content
+
+    async def pin(self):
+        pass
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+        self.members = [FakeMember()]
+        self.messages: List[FakeMessage] = []
+
+    async def send(self, content: str = None) -> FakeMessage:
+        message = FakeMessage(content)
+        self.messages.append(message)
+        return message
+
+
+class FakeMember:
+    bot = False
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+
+
+class FakeVoiceClient:
+    def __init__(self, channel: FakeChannel):
+        self.channel = channel
+        self.source = None
+
+    def stop(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+
+class FakeBot:
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+
+
+class FakeContext:
+    """Stands in for commands.Context, the text and voice channel are the same object"""
+
+    def __init__(self, bot: FakeBot, guild_id: int):
+        self.bot = bot
+        self.guild = FakeGuild(guild_id)
+        self.channel = FakeChannel(guild_id)
+        self.voice_client = FakeVoiceClient(self.channel)
+        self.author = FakeMember()
+
+    async def send(self, content: str = None) -> FakeMessage:
+        return await self.channel.send(content)
+
+
+class FramePump(threading.Thread):
+    """Call read() on a strict 20ms schedule, like the AudioPlayer thread of discord.py
+
+    The lateness of every frame against its slot is recorded, a frame
+    ready more than 20ms after its slot is one discord would send late."""
+
+    def __init__(self, source, duration: float, silence: bytes):
+        super().__init__(daemon=True)
+        self.source = source
+        self.duration = duration
+        self.silence = silence
+        self.lateness = np.zeros(int(duration / FRAME_DURATION) + 1, dtype=np.float64)
+        self.frames = 0
+        self.silent_frames = 0
+        self.ended_early = False
+        self.elapsed = 0.0
+
+    def run(self):
+        started = time.perf_counter()
+        total_frames = len(self.lateness)
+        for frame_number in range(total_frames):
+            slot = started + frame_number * FRAME_DURATION
+            frame = self.source.read()
+            self.lateness[frame_number] = time.perf_counter() - slot
+            if not frame:
+                self.ended_early = True
+                break
+            self.frames += 1
+            if frame == self.silence:
+                self.silent_frames += 1
+
+            delay = slot + FRAME_DURATION - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        self.elapsed = time.perf_counter() - started
+        self.lateness = self.lateness[:self.frames]
@@ -0,0 +1,136 @@
+"""A local stand-in for an Icecast server
+
+Two mounts are served from media generated with ffmpeg:
+    /icy.mp3      MP3 with icy-metaint metadata blocks, StreamTitle change every loop
+    /chained.ogg  chained Ogg Vorbis, every link has its own serial and comment header
+
+Both are paced at their bitrate after an initial burst, like a real server."""
+import os
+import asyncio
+import subprocess
+from typing import *
+from aiohttp import web
+
+ICY_METAINT = 16000
+MP3_BITRATE = 128000
+BURST_SECONDS = 2
+CHUNK_SECONDS = 0.25
+
+
+def generate_fixtures(directory: str, seconds: int = 20, links: int = 3) -> Dict[str, Any]:
+    """Tones encoded once with ffmpeg, reused between runs"""
+    os.makedirs(directory, exist_ok=True)
+    mp3_path = os.path.join(directory, "tone.mp3")
+    if not os.path.exists(mp3_path):
+        subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+                        "-ac", "2", "-ar", "44100", "-c:a", "libmp3lame", "-b:a", str(MP3_BITRATE), mp3_path], check=True)
+
+    ogg_paths = []
+    for link in range(links):
+        ogg_path = os.path.join(directory, f"link{link}.ogg")
+        if not os.path.exists(ogg_path):
+            subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", f"sine=frequency={330 + 110 * link}:duration={seconds}",
+                            "-ac", "2", "-ar", "44100", "-c:a", "libvorbis", "-q:a", "4",
+                            "-metadata", f"title=Bench link {link}", "-metadata", "artist=Fake Icecast", ogg_path], check=True)
+        ogg_paths.append(ogg_path)
+
+    return {"mp3": mp3_path, "ogg": ogg_paths, "seconds": seconds}
+
+
+class FakeIcecast:
+
+    def __init__(self, fixtures: Dict[str, Any]):
+        self.seconds = fixtures["seconds"]
+        with open(fixtures["mp3"], "rb") as file_handle:
+            self.mp3 = file_handle.read()
+        self.ogg_links: List[bytes] = []
+        for ogg_path in fixtures["ogg"]:
+            with open(ogg_path, "rb") as file_handle:
+                self.ogg_links.append(file_handle.read())
+
+        self.connections = 0
+        self.runner: web.AppRunner = None
+        self.port: int = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        app = web.Application()
+        app.router.add_get("/icy.mp3", self.icy)
+        app.router.add_get("/chained.ogg", self.chained_ogg)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def url(self, mount: str) -> str:
+        return f"http://127.0.0.1:{self.port}/{mount}"
+
+    @staticmethod
+    async def paced_write(response: web.StreamResponse, data: bytes, bytes_per_second: float, sent: List[float], started: float):
+        """Write data no faster than bytes_per_second once the burst has been sent"""
+        loop = asyncio.get_event_loop()
+        chunk_size = max(1, int(bytes_per_second * CHUNK_SECONDS))
+        for offset in range(0, len(data), chunk_size):
+            chunk = data[offset:offset + chunk_size]
+            await response.write(chunk)
+            sent[0] += len(chunk)
+            ahead = sent[0] / bytes_per_second - BURST_SECONDS - (loop.time() - started)
+            if ahead > 0:
+                await asyncio.sleep(ahead)
+
+    async def icy(self, request: web.Request) -> web.StreamResponse:
+        self.connections += 1
+        wants_metadata = request.headers.get("Icy-MetaData") == "1"
+        headers = {"Content-Type": "audio/mpeg", "icy-name": "Bench"}
+        if wants_metadata:
+            headers["icy-metaint"] = str(ICY_METAINT)
+        response = web.StreamResponse(headers=headers)
+        await response.prepare(request)
+
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        sent = [0.0]
+        bytes_per_second = MP3_BITRATE / 8
+        loop_number = 0
+        try:
+            while True:
+                loop_number += 1
+                if not wants_metadata:
+                    await self.paced_write(response, self.mp3, bytes_per_second, sent, started)
+                    continue
+
+                title = f"StreamTitle='Fake Icecast - Loop {loop_number}';".encode()
+                block_count = -(-len(title) // 16)
+                metadata = bytes([block_count]) + title.ljust(block_count * 16, b"\0")
+                for offset in range(0, len(self.mp3), ICY_METAINT):
+                    audio = self.mp3[offset:offset + ICY_METAINT].ljust(ICY_METAINT, b"\0")
+                    await self.paced_write(response, audio, bytes_per_second, sent, started)
+                    # the title only need to be sent once per loop, the other blocks are empty
+                    await response.write(metadata if offset == 0 else b"\0")
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connections -= 1
+        return response
+
+    async def chained_ogg(self, request: web.Request) -> web.StreamResponse:
+        self.connections += 1
+        response = web.StreamResponse(headers={"Content-Type": "application/ogg"})
+        await response.prepare(request)
+
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        sent = [0.0]
+        try:
+            while True:
+                for link in self.ogg_links:
+                    await self.paced_write(response, link, len(link) / self.seconds, sent, started)
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connections -= 1
+        return response
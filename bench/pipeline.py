@@ -0,0 +1,215 @@
+"""Throughput and jitter of the audio pipeline without discord
+
+    python -m bench.pipeline --kind radio-icy --sources 1 10 100 --duration 30 [--decoder pyav] [--engine resample]
+
+Every source is read by its own FramePump at a strict 20ms cadence. The
+radio kinds connect to a local FakeIcecast, one station per source unless
+--shared is given. The nightcore kind plays tones generated into a
+scratch media directory, resolved through the media store and the
+extraction cache so youtube is never contacted.
+
+Needs ffmpeg on the PATH, built with libmp3lame, libvorbis, libopus and
+librubberband."""
+import os
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+import numpy as np
+from typing import *
+
+import psutil
+
+from bench.fake_discord import FakeBot, FakeContext, FramePump
+from bench.fake_icecast import FakeIcecast, generate_fixtures
+from utils import config
+from utils.decoders import BACKENDS
+from utils.nightcore_effect import NightcoreEffect, ENGINES
+from utils.jitter_buffer import PCM_SILENCE, OPUS_SILENCE
+
+KINDS = ("radio-icy", "radio-vorbis", "nightcore")
+
+
+class ResourceSampler(threading.Thread):
+    """CPU time, peak RSS and context switches of the bot process and every child it spawned"""
+
+    def __init__(self, interval: float = 0.5):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.process = psutil.Process()
+        # children are gone by the end of the run, their last cpu times are kept
+        self.child_cpu: Dict[int, float] = {}
+        self.child_switches: Dict[int, int] = {}
+        self.peak_rss = 0
+        self.peak_own_rss = 0
+        self.peak_children = 0
+        self.running = True
+
+    def sample(self):
+        total_rss = self.process.memory_info().rss
+        self.peak_own_rss = max(self.peak_own_rss, total_rss)
+        children = self.process.children(recursive=True)
+        for child in children:
+            try:
+                with child.oneshot():
+                    cpu_times = child.cpu_times()
+                    self.child_cpu[child.pid] = cpu_times.user + cpu_times.system
+                    self.child_switches[child.pid] = sum(child.num_ctx_switches())
+                    total_rss += child.memory_info().rss
+            except psutil.Error:
+                continue
+        self.peak_rss = max(self.peak_rss, total_rss)
+        self.peak_children = max(self.peak_children, len(children))
+
+    def run(self):
+        while self.running:
+            self.sample()
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.sample()
+
+    def own_cpu(self) -> float:
+        cpu_times = self.process.cpu_times()
+        return cpu_times.user + cpu_times.system
+
+    def children_cpu(self) -> float:
+        return sum(self.child_cpu.values())
+
+    def context_switches(self) -> int:
+        """Voluntary and involuntary, of the bot and of the children"""
+        return sum(self.process.num_ctx_switches()) + sum(self.child_switches.values())
+
+
+def make_radio_players(loop: asyncio.AbstractEventLoop, server: FakeIcecast, kind: str, count: int, shared: bool, decoder: str) -> List[Any]:
+    from cogs.radio import RadioPlayer
+    mount, radio_format = ("icy.mp3", "icy") if kind == "radio-icy" else ("chained.ogg", "vorbis")
+    bot = FakeBot(loop)
+    return [RadioPlayer("bench" if shared else f"bench{index}", "Bench", server.url(mount), radio_format, FakeContext(bot, index), decoder)
+            for index in range(count)]
+
+
+def make_nightcore_players(loop: asyncio.AbstractEventLoop, scratch: str, count: int, songs: int, decoder: str, engine: str) -> List[Any]:
+    from cogs.nightcore import NightcorePlayer
+    from utils.extraction import ExtractionPool
+    from utils.extraction_cache import ExtractionCache
+    from utils.media_store import MediaStore
+    from utils.render_cache import RenderCache
+    from concurrent.futures import ThreadPoolExecutor
+
+    media_dir = os.path.join(scratch, "media")
+    os.makedirs(media_dir, exist_ok=True)
+    media_store = MediaStore(media_dir, 2 ** 40)
+    extraction_cache = ExtractionCache(os.path.join(scratch, "extractions.sqlite3"), 3600, 3600)
+    links = []
+    for song in range(songs):
+        video_id = f"benchtone{song:02d}"
+        path = os.path.join(media_dir, video_id + ".webm")
+        if not os.path.exists(path):
+            subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", f"sine=frequency={220 * (song + 1)}:duration=60",
+                            "-ac", "2", "-ar", "48000", "-c:a", "libopus", path], check=True)
+        media_store.add(video_id, path, f"Bench tone {song}", 60)
+        link = f"https://youtu.be/{video_id}"
+        extraction_cache.put_link(link, {"_type": "video", "id": video_id, "extractor": "youtube", "title": f"Bench tone {song}"})
+        links.append(link)
+
+    # every song is already on disk, the pool never get a request
+    extraction_pool = ExtractionPool(0, 60)
+    download_pool = ThreadPoolExecutor(max_workers=config.NIGHTCORE_DOWNLOAD_THREADS)
+    # a scratch render cache so the first run measure live rendering
+    render_cache = RenderCache(os.path.join(scratch, "renders"), 2 ** 40)
+    bot = FakeBot(loop)
+    effect = NightcoreEffect(engine, config.NIGHTCORE_SPEED_PERCENT / 100, config.NIGHTCORE_BASS_GAIN, config.NIGHTCORE_TREBLE_GAIN)
+
+    players = []
+    for index in range(count):
+        player = NightcorePlayer(links[index % songs], FakeContext(bot, index), download_pool, render_cache,
+                                 media_store, extraction_cache, extraction_pool, decoder_backend=decoder, effect=effect)
+        for link in links[index % songs + 1:] + links[:index % songs]:
+            player.add_song(link)
+        players.append(player)
+    return players
+
+
+def report(kind: str, count: int, pumps: List[FramePump], sampler: ResourceSampler, wall: float, cpu_before: float, switches_before: int):
+    lateness = np.concatenate([pump.lateness for pump in pumps]) * 1000 if pumps else np.zeros(1)
+    frames = sum(pump.frames for pump in pumps)
+    silent = sum(pump.silent_frames for pump in pumps)
+    late = int((lateness > 20).sum())
+    own_cpu = sampler.own_cpu() - cpu_before
+    print(f"{kind:>13} x{count:<4} {frames / wall:9.1f} frames/s  "
+          f"lateness p50 {np.percentile(lateness, 50):6.2f}ms p99 {np.percentile(lateness, 99):6.2f}ms max {lateness.max():7.2f}ms  "
+          f"late {late:6d}  underruns {silent:6d}  ended early {sum(pump.ended_early for pump in pumps):3d}  "
+          f"cpu bot {own_cpu / wall * 100:6.1f}% ffmpeg {sampler.children_cpu() / wall * 100:6.1f}%  "
+          f"processes {sampler.peak_children:4d}  ctx switches {(sampler.context_switches() - switches_before) / wall:9.0f}/s  "
+          f"peak rss {sampler.peak_rss / 2 ** 20:7.1f}MiB  peak rss self {sampler.peak_own_rss / 2 ** 20:7.1f}MiB")
+
+
+async def run_one(kind: str, count: int, args: argparse.Namespace, server: FakeIcecast, scratch: str):
+    loop = asyncio.get_event_loop()
+    sampler = ResourceSampler()
+    cpu_before = sampler.own_cpu()
+    switches_before = sampler.context_switches()
+    sampler.start()
+
+    if kind == "nightcore":
+        players = await loop.run_in_executor(None, make_nightcore_players, loop, scratch, count, args.songs, args.decoder, args.engine)
+    else:
+        players = make_radio_players(loop, server, kind, count, args.shared, args.decoder)
+    silence = OPUS_SILENCE if players and players[0].is_opus() else PCM_SILENCE
+
+    started = time.perf_counter()
+    pumps = [FramePump(player, args.duration, silence) for player in players]
+    for pump in pumps:
+        pump.start()
+    while any(pump.is_alive() for pump in pumps):
+        await asyncio.sleep(0.1)
+    wall = time.perf_counter() - started
+
+    sampler.stop()
+    report(kind, count, pumps, sampler, wall, cpu_before, switches_before)
+    for player in players:
+        player.cleanup()
+    # let the stations close their connections before the next round
+    await asyncio.sleep(1)
+
+
+async def main(args: argparse.Namespace):
+    scratch = args.scratch or tempfile.mkdtemp(prefix="nazbot-bench-")
+    # the fake guilds must not end up resumed by the real bot
+    config.PLAYER_JOURNAL_PATH = os.path.join(scratch, "players.sqlite3")
+    server = FakeIcecast(generate_fixtures(os.path.join(scratch, "icecast")))
+    await server.start()
+    try:
+        for kind in args.kind:
+            for count in args.sources:
+                await run_one(kind, count, args, server, scratch)
+    finally:
+        await server.stop()
+        if not args.scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+def parse_arguments(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--kind", nargs="+", choices=KINDS, default=list(KINDS))
+    parser.add_argument("--sources", nargs="+", type=int, default=[1, 10, 100])
+    parser.add_argument("--duration", type=float, default=30, help="seconds every source is read for")
+    parser.add_argument("--shared", action="store_true", help="every radio source listen to the same station")
+    parser.add_argument("--songs", type=int, default=3, help="songs in each nightcore playlist")
+    parser.add_argument("--decoder", choices=BACKENDS, default="subprocess",
+                        help="pyav needs the av package, what it can't do still goes to ffmpeg")
+    parser.add_argument("--engine", choices=ENGINES, default=config.NIGHTCORE_ENGINE, help="how the nightcore kind speed the songs up")
+    parser.add_argument("--scratch", help="keep the generated media and renders here between runs")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    if shutil.which("ffmpeg") is None:
+        sys.exit("ffmpeg is needed on the PATH")
+    asyncio.get_event_loop().run_until_complete(main(parse_arguments(sys.argv[1:])))
@@ -1,128 +1,235 @@
-import time
-import audioop
-import youtube_dl
+import math
 import discord
 import asyncio
+import queue
 import subprocess
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, Future, CancelledError, TimeoutError
+from collections import deque
+from dataclasses import asdict, replace
 from functools import partial
-from threading import Lock
+from threading import Lock, Condition
 from types import GeneratorType
 from typing import *
-from dataclasses import dataclass, field
-from discord.ext import commands, tasks
-
-@dataclass
-class SongFileInfo:
-    """Class for Song File Info"""
-    filename: str
-    title: str = field(compare=False)
-    duration: int = field(compare=False)
-
-    def __post_init__(self):
-        self.nightcore_duration: int = int(self.duration / 1.3)
-
-    @property
-    def duration_nightcore_string(self):
-        return f"{self.nightcore_duration // 60}:{str(self.nightcore_duration % 60).zfill(2)}"
+from discord.ext import commands
+from utils import config, metrics
+from utils.download_scheduler import OrderedDownloadScheduler
+from utils.dsp import GainProcessor, Crossfader
+from utils.extraction import ExtractionPool, ExtractionRequest, ExtractionResult, ExtractionError
+from utils.extraction_cache import ExtractionCache
+from utils.jitter_buffer import PCM_SILENCE, OPUS_SILENCE
+from utils.media_store import MediaStore
+from utils.nightcore_effect import NightcoreEffect, ENGINES
+from utils.notifier import get_notifier
+from utils.player_journal import GuildPlayerState, ResumedContext, get_journal
+from utils.playlist import Playlist
+from utils.render_cache import RenderCache
+from utils.song_info import SongFileInfo
+from utils.track_decoder import TrackDecoder, FRAMES_PER_SECOND
+
+class PlayerControl(NamedTuple):
+    """A command for the player thread, applied between two frames
+
+    action is one of skip, jump (value is the playlist index), seek (value
+    is the position in seconds, 0 restart the song) or one of the playlist
+    edits remove (value is the index), move (value to destination),
+    shuffle and insert (song goes right after the one playing)."""
+    action: str
+    value: float = None
+    destination: int = None
+    song: SongFileInfo = None
 
 
 class NightcorePlayer(discord.AudioSource):
 
-    def __init__(self, video_link: str, discord_ctx: commands.Context, pool: ThreadPoolExecutor):
+    def __init__(self, video_link: Optional[str], discord_ctx: commands.Context, download_pool: ThreadPoolExecutor, render_cache: RenderCache,
+                 media_store: MediaStore, extraction_cache: ExtractionCache, extraction_pool: ExtractionPool, extracted_info: Dict = None,
+                 decoder_backend: str = None, effect: NightcoreEffect = None):
         self.lock = Lock()
-        self.pool = pool
-
-        self.playlist: List[SongFileInfo] = []
-        self.currently_playing_index = -1
-
-        self.ffmpeg: subprocess.Popen = None
+        self.playlist_changed = Condition(self.lock)
+        # add_song calls still looking up their song, the player wait for them
+        self.adding = 0
+        # only runs the playlist downloads, they hold their threads for the whole playlist
+        self.download_pool = download_pool
+        self.render_cache = render_cache
+        self.media_store = media_store
+        self.extraction_cache = extraction_cache
+        self.extraction_pool = extraction_pool
+        self.extractions: Set[Future] = set()
+
+        # a new effect is used from the next song on, like the volume in opus mode
+        self.effect = effect or NightcoreEffect.from_config()
+        self.playlist = Playlist(speed=self.effect.speed)
+        self.downloads: List[OrderedDownloadScheduler] = []
+
+        self.decoder: TrackDecoder = None
+        # (index, decoder, future of its start) of the song started ahead of time
+        self.upcoming: Tuple[int, TrackDecoder, Future] = None
+        # its own thread, a shared pool busy with downloads would hold the next song up
+        self.prestart_pool = ThreadPoolExecutor(max_workers=1)
+        self.crossfader = Crossfader()
+        # only the player thread move through the playlist, everybody else
+        # ask it to through here
+        self.controls: "queue.SimpleQueue[PlayerControl]" = queue.SimpleQueue()
+
+        self.opus = bool(config.OPUS_PASSTHROUGH)
+        # live renders only, the pyav backend fall back to ffmpeg for opus and missing filters
+        self.decoder_backend = decoder_backend or config.DECODER_BACKEND
+        self.output_format = "opus" if self.opus else "pcm"
+        self.silence_frame = OPUS_SILENCE if self.opus else PCM_SILENCE
+
+        self._volume = 0.07
+        self.gain = GainProcessor(self._volume)
 
         self.discord_ctx = discord_ctx
         self.event_loop: asyncio.AbstractEventLoop = discord_ctx.bot.loop
+        self.notifier = get_notifier(discord_ctx.bot)
 
         self.repeating_mode = False
 
-        self.add_song(video_link)
+        self.metrics = metrics.registry.register(metrics.SourceMetrics(
+            "nightcore", discord_ctx.guild.id, self.metrics_gauges, self.ffmpeg_processes))
 
-        self.audio_reader = self.audio_generator_nc()
+        self.player_journal = get_journal()
+        self.player_token = self.player_journal.new_player()
+        self.journal("start", kind="nightcore", voice_channel_id=discord_ctx.voice_client.channel.id,
+                     text_channel_id=discord_ctx.channel.id, volume=self._volume, effect=asdict(self.effect))
 
-        self.setup_auto_disconnect()
+        # a resumed player get its songs from restore() instead
+        if video_link is not None:
+            self.add_song(video_link, extracted_info)
 
+        self.audio_reader = self.audio_generator_nc()
 
-    def add_song(self, video_link: str):
-        self.lock.acquire()
+
+    def add_song(self, video_link: str, extracted_info: Dict = None, play_next: bool = False):
+        """Queue the song or playlist of a link, with play_next the song (or the
+        first song of the playlist) goes right after the one playing"""
+        # the lock is only taken to put the song in the playlist, the player
+        # thread keep sending silence while the song is looked up
+        with self.playlist_changed:
+            self.adding += 1
         try:
-            try:
-                extracted_info = youtube_dl.YoutubeDL(params={"noplaylist": True, "quiet": True}).extract_info(video_link, process=False)
-            except youtube_dl.utils.DownloadError:
-                self.event_loop.create_task(self.discord_ctx.send("Sorry, searching youtube is not supported or your link is invalid"))
-                return
+            link_result = None
+            if extracted_info is None:
+                extracted_info = self.extraction_cache.get_link(video_link)
+            if extracted_info is None:
+                link_result = self.extract(ExtractionRequest("link", video_link))
+                if link_result.info is None:
+                    self.send("Sorry, searching youtube is not supported or your link is invalid")
+                    return
+                extracted_info = self.extraction_cache.put_link(video_link, link_result.info)
             extractor = extracted_info.get("extractor")
 
             if "youtube" in extractor:
-                ydl_config = {
-                    "outtmpl": "./media/%(id)s.%(ext)s",
-                    "format": "250/251",
-                    "quiet": True,
-                    "noplaylist": True
-                }
                 info_type = extracted_info.get("_type", "video")
 
-                if info_type == "video":
-                    with youtube_dl.YoutubeDL(params=ydl_config) as ydl:
-                        try:
-                            processed_ie = ydl.process_ie_result(extracted_info, download=True)
-                        except (youtube_dl.utils.ExtractorError, youtube_dl.utils.DownloadError):
-                            # if we reached here, it means that the link might be a livestream
-                            self.event_loop.create_task(self.discord_ctx.send("Link is unsupported..."))
-                            return
-                        filename = ydl.prepare_filename(processed_ie)
+                if info_type == "playlist":
+                    entries = iter(extracted_info.get("entries") or [])
+                    first_entry = next(entries, None)
+                    if first_entry is None:
+                        self.send("The playlist is empty...")
+                        return
+                    video_id = first_entry.get("id")
+                else:
+                    video_id = extracted_info.get("id")
+
+                # already on disk, no need to ask youtube anything
+                song_file_info = self.song_from_store(video_id)
+
+                if song_file_info is not None:
+                    pass
+                elif info_type == "video":
+                    # resolved along with the link unless it came from the extraction cache
+                    song_result = link_result or self.extract(ExtractionRequest("resolve", video_link))
+                    if song_result.song is None:
+                        # if we reached here, it means that the link might be a livestream
+                        self.send("Link is unsupported...")
+                        return
                 elif info_type == "url" and extracted_info.get("webpage_url_basename") == "watch":
-                    with youtube_dl.YoutubeDL(params=ydl_config) as ydl:
-                        try:
-                            processed_ie = ydl.extract_info(extracted_info.get("url"), ie_key=extracted_info.get("ie_key"))
-                        except youtube_dl.utils.DownloadError:
-                            self.event_loop.create_task(self.discord_ctx.send("Error downloading this -->" + extracted_info.get("url")))
-                            return
-                        filename = ydl.prepare_filename(processed_ie)
+                    song_result = self.extract(ExtractionRequest("resolve", extracted_info.get("url"), extracted_info.get("ie_key")))
+                    if song_result.song is None:
+                        self.send("Error downloading this -->" + extracted_info.get("url"))
+                        return
                 elif info_type == "playlist":
-                    entries = extracted_info.get("entries")
-                    if isinstance(entries, GeneratorType):
-                        first_entry = next(entries)
-                        with youtube_dl.YoutubeDL(params=ydl_config) as ydl:
-                            try:
-                                processed_ie = ydl.extract_info(first_entry.get("url"), ie_key=first_entry.get("ie_key"))
-                            except youtube_dl.utils.DownloadError:
-                                self.event_loop.create_task(self.discord_ctx.send("Error downloading this -->" + first_entry.get("url")))
-                                return
-                            filename = ydl.prepare_filename(processed_ie)
-                        
+                    song_result = self.extract(ExtractionRequest("resolve", first_entry.get("url"), first_entry.get("ie_key")))
+                    if song_result.song is None:
+                        self.send("Error downloading this -->" + first_entry.get("url"))
+                        return
 
-                
-                song_file_info = SongFileInfo(filename, processed_ie.get("title"), processed_ie.get("duration"))
+                if song_file_info is None:
+                    song_file_info = song_result.song
+                    self.extraction_cache.put_video(song_file_info.video_id, song_file_info.title, song_file_info.duration)
+
+                    # the song can start from stream_url right away,
+                    # the file is kept for the replays
+                    persist = self.extraction_pool.submit(ExtractionRequest("persist", processed_info=song_result.processed_info), config.DOWNLOAD_TIMEOUT)
+                    persist.add_done_callback(self.persisted)
+
+                if play_next:
+                    # the player thread know which song is playing when it get to it
+                    self.controls.put(PlayerControl("insert", song=song_file_info))
+                else:
+                    self.publish_song(song_file_info)
 
-                if song_file_info not in self.playlist:
-                    self.playlist.append(song_file_info)
-                
                 if info_type == "playlist":
                     later_entries = list(entries)
-                    self.event_loop.create_task(self.discord_ctx.send(f"Queuing {len(later_entries) + 1} songs."))
-                    self.pool.submit(self.process_playlist_youtube, later_entries)
+                    self.send(f"Queuing {len(later_entries) + 1} songs.")
+                    self.process_playlist_youtube(later_entries)
+                elif play_next:
+                    self.send(f"Playing `{song_file_info.title}` next - {song_file_info.duration_nightcore_string}")
                 else:
-                    self.event_loop.create_task(self.discord_ctx.send(f"Queued `{song_file_info.title}` - {song_file_info.duration_nightcore_string}"))
+                    self.send(f"Queued `{song_file_info.title}` - {song_file_info.duration_nightcore_string}")
                 
             else:
-                self.event_loop.create_task(self.discord_ctx.send("Link is unsupported for now come back later!"))
+                self.send("Link is unsupported for now come back later!")
                 return
         finally:
-            try:
-                self.lock.release()
-            except RuntimeError:
-                # we reached here because we tried to release an unlocked lock.
-                pass
+            with self.playlist_changed:
+                self.adding -= 1
+                self.playlist_changed.notify_all()
+
+    def send(self, text: str):
+        """Reply in the text channel of the player, from any thread"""
+        asyncio.run_coroutine_threadsafe(self.discord_ctx.send(text), self.event_loop)
+
+    def extract(self, request: ExtractionRequest, timeout: float = None) -> ExtractionResult:
+        """Run a request on the extraction pool, cancelled if the player get cleaned up meanwhile"""
+        future = self.extraction_pool.submit(request, timeout)
+        self.extractions.add(future)
+        try:
+            return future.result()
+        except (ExtractionError, CancelledError) as e:
+            return ExtractionResult(error=str(e) or "cancelled")
+        finally:
+            self.extractions.discard(future)
+
+    def persisted(self, future: Future):
+        try:
+            result: ExtractionResult = future.result()
+        except ExtractionError as e:
+            print(f"Failed to save a song: {e}")
+            return
+        if result.error is not None:
+            print(f"Failed to save {result.song and result.song.video_id}: {result.error}")
+            return
+        song_file_info = result.song
+        self.media_store.add(song_file_info.video_id, song_file_info.filename, song_file_info.title, song_file_info.duration)
+
+    def song_from_store(self, video_id: str) -> Optional[SongFileInfo]:
+        media_entry = self.media_store.get(video_id)
+        if media_entry is None:
+            return None
+        title, duration = media_entry.title, media_entry.duration
+        if title is None or duration is None:
+            video_info = self.extraction_cache.get_video(video_id)
+            if video_info is None:
+                return None
+            title, duration = video_info["title"], video_info["duration"]
+        return SongFileInfo(media_entry.path, title, duration, video_id=video_id)
 
     def audio_generator_nc(self):
+        # last frames of the previous song, faded into the start of the next one
+        tail: Deque[bytes] = deque()
         while True:
             self.currently_playing_index += 1
 
@@ -132,137 +239,438 @@ class NightcorePlayer(discord.AudioSource):
                 self.currently_playing_index = -1
                 continue
             else:
-                if self.lock.locked():
-                    self.lock.acquire()
-                    self.lock.release()
+                # nothing to fade into yet
+                yield from tail
+                tail.clear()
+                if self.adding or self.downloading():
+                    # more songs are on the way, play silence until the next one show up
+                    self.currently_playing_index -= 1
+                    control = self.take_control()
+                    if control is not None and control.action == "jump":
+                        self.currently_playing_index = int(control.value) - 1
+                    elif control is not None:
+                        self.edit_playlist(control)
+                    with self.playlist_changed:
+                        self.playlist_changed.wait(0.02)
+                    yield self.silence_frame
                     continue
                 break
 
-            self.event_loop.create_task(self.discord_ctx.send(f"Currently playing `{self.currently_playing_index + 1}. {current_song_file.title}` - {current_song_file.duration_nightcore_string}"))
+            self.notifier.notify(self.discord_ctx.channel, f"Currently playing `{self.currently_playing_index + 1}. {current_song_file.title}` - {current_song_file.duration_nightcore_string}")
 
-            self.ffmpeg = subprocess.Popen(f"ffmpeg -i {current_song_file.filename} -f s16le -ac 2 -ar 48000 -filter_complex rubberband=tempo=1.3:pitch=1.3,bass=gain=2,treble=gain=-1 -".split(), stdout=subprocess.PIPE, stdin=subprocess.PIPE, creationflags=0x08000000)
+            self.prerender_upcoming()
+            self.media_store.touch(current_song_file.video_id)
 
-            while True:
-                # 3840 is the amount of byte that has 20ms amount of audio
-                try:
-                    audio_frame = self.ffmpeg.stdout.read(3840)
-                except ValueError:
-                    # read of closed file
-                    break
-                if audio_frame:
-                    yield audio_frame
-                else:
-                    break
-    
-    def queue(self):
-        queue_string = "```\n"
+            decoder = self.take_decoder(self.currently_playing_index, current_song_file)
+            self.decoder = decoder
+            try:
+                yield from self.play(decoder, tail)
+            finally:
+                self.decoder = None
+                decoder.close()
+
+    def play(self, decoder: TrackDecoder, tail: Deque[bytes]):
+        """Frames of a song, starting with the crossfade from the previous one"""
+        fade_length = len(tail)
+        for position in range(fade_length):
+            audio_frame = decoder.read_frame()
+            if not audio_frame:
+                break
+            yield self.crossfader.mix(tail.popleft(), audio_frame, position, fade_length)
+        # the song was shorter than the fade
+        yield from tail
+        tail.clear()
+
+        crossfade_frames = 0 if self.opus else config.NIGHTCORE_CROSSFADE_MS // 20
+        prestart_at = decoder.expected_frames - config.NIGHTCORE_PRESTART_SECONDS * FRAMES_PER_SECOND - crossfade_frames
+        position_interval = config.PLAYER_POSITION_INTERVAL * FRAMES_PER_SECOND
+        frames_read = 0
+        self.journal_position(frames_read)
+        while True:
+            control = self.take_control()
+            if control is not None:
+                if control.action == "seek":
+                    frames_read = int(control.value * FRAMES_PER_SECOND)
+                    decoder.seek(frames_read)
+                    self.journal_position(frames_read)
+                    # held back from before the seek
+                    tail.clear()
+                elif control.action in ("skip", "jump"):
+                    if control.action == "jump":
+                        self.currently_playing_index = int(control.value) - 1
+                    decoder.stop()
+                elif self.edit_playlist(control):
+                    # the song playing got removed
+                    decoder.stop()
+
+            if frames_read >= prestart_at and self.upcoming is None:
+                self.prestart_next()
+            audio_frame = decoder.read_frame()
+            if not audio_frame:
+                break
+            frames_read += 1
+            if frames_read % position_interval == 0:
+                self.journal_position(frames_read)
+
+            if not crossfade_frames:
+                yield audio_frame
+                continue
+            # hold back enough frames to fade them into the next song
+            tail.append(audio_frame)
+            if len(tail) > crossfade_frames:
+                yield tail.popleft()
+
+        if decoder.stopped:
+            # skipped, the next song start right away
+            tail.clear()
+
+    def edit_playlist(self, control: PlayerControl) -> bool:
+        """Apply a playlist edit, return whether the song playing got removed"""
+        if control.action == "remove":
+            index = int(control.value)
+            if not 0 <= index < len(self.playlist):
+                return False
+            removed_current = index == self.currently_playing_index
+            song_file_info = self.playlist.remove(index)
+            self.media_store.unpin(song_file_info.video_id)
+            self.journal("remove", index=index)
+            return removed_current
+        if control.action == "move":
+            index, destination = int(control.value), max(0, min(control.destination, len(self.playlist) - 1))
+            if 0 <= index < len(self.playlist):
+                self.playlist.move(index, destination)
+                self.journal("move", index=index, destination=destination)
+        elif control.action == "insert":
+            index = self.currently_playing_index + 1
+            if self.playlist.insert(index, control.song):
+                self.media_store.pin(control.song.video_id)
+                self.journal_song(control.song, index)
+        elif control.action == "shuffle":
+            self.playlist.shuffle()
+            self.journal("order", filenames=[song_file_info.filename for song_file_info in self.playlist])
+        return False
+
+    def take_control(self) -> Optional[PlayerControl]:
         try:
-            for index in range(len(self.playlist)):
-                a_song_file = self.playlist[index]
-                if index == self.currently_playing_index:
-                    queue_string += f"{index + 1}. {a_song_file.title} - {a_song_file.duration_nightcore_string} <--- Now playing\n"
-                else:
-                    queue_string += f"{index + 1}. {a_song_file.title} - {a_song_file.duration_nightcore_string}\n"
-        except AttributeError:
-            return "```\n```"
-        
-        return queue_string + "```"
+            return self.controls.get_nowait()
+        except queue.Empty:
+            return None
+
+    def next_index(self) -> Optional[int]:
+        if self.currently_playing_index + 1 < len(self.playlist):
+            return self.currently_playing_index + 1
+        if self.repeating_mode and self.playlist:
+            return 0
+        return None
+
+    def prestart_next(self):
+        """Start decoding the next song in the background before the current one ends"""
+        index = self.next_index()
+        if index is None or self.upcoming is not None:
+            return
+        decoder = TrackDecoder(self.playlist[index], self.render_cache, self.output_filter_chain, self.output_format, config.NIGHTCORE_PREBUFFER_FRAMES,
+                               self.tempo, self.decoder_backend, self.processor)
+        self.upcoming = (index, decoder, self.prestart_pool.submit(decoder.start))
+
+    def take_decoder(self, index: int, song_file_info: SongFileInfo) -> TrackDecoder:
+        """The prestarted decoder if it is for this song, a new one otherwise"""
+        upcoming, self.upcoming = self.upcoming, None
+        if upcoming is not None:
+            upcoming_index, upcoming_decoder, started = upcoming
+            if upcoming_index == index and upcoming_decoder.song_file_info is song_file_info and upcoming_decoder.filter_chain == self.output_filter_chain:
+                try:
+                    started.result(timeout=config.NIGHTCORE_PRESTART_TIMEOUT)
+                    return upcoming_decoder
+                except TimeoutError:
+                    print(f"Prestart of {song_file_info.title} is too slow, starting it again")
+                    started.cancel()
+                    # a start still running give up at its next frame
+                    upcoming_decoder.stop()
+                except Exception as e:
+                    print(f"Failed to prestart {song_file_info.title}: {e!r}")
+            # got skipped past or the volume or the effect changed, this one is of no use
+            started.add_done_callback(lambda _: upcoming_decoder.close())
+
+        decoder = TrackDecoder(song_file_info, self.render_cache, self.output_filter_chain, self.output_format, 0,
+                               self.tempo, self.decoder_backend, self.processor)
+        decoder.start()
+        return decoder
+
+    def prerender_upcoming(self):
+        """Render the next few songs in the background so they start from the cache"""
+        if self.processor is not None:
+            # cheap enough to render live, and only ffmpeg renders in the background
+            return
+        upcoming = self.playlist[self.currently_playing_index + 1:self.currently_playing_index + 1 + config.NIGHTCORE_PRERENDER_AHEAD]
+        for song_file_info in upcoming:
+            self.render_cache.prerender(song_file_info.filename, self.output_filter_chain, self.output_format)
 
+    @property
+    def output_filter_chain(self) -> str:
+        filter_chain = self.effect.filter_chain(self.output_format)
+        if self.opus:
+            # opus packets are sent as they are so the volume has to be
+            # applied before ffmpeg encode them
+            return filter_chain + f",volume={self._volume}"
+        return filter_chain
 
-    def process_playlist_youtube(self, ie_entries: List):
-        ydl_config = {
-            "outtmpl": "./media/%(id)s.%(ext)s",
-            "format": "250/251",
-            "quiet": True,
-            "noplaylist": True
-        }
-        ydl = youtube_dl.YoutubeDL(params=ydl_config)
-        for ie_entry in ie_entries:
-            time.sleep(0.083)
-            self.lock.acquire()
-            try:
-                try:
-                    processed_ie = ydl.extract_info(ie_entry.get("url"), ie_key=ie_entry.get("ie_key"))
-                except youtube_dl.utils.DownloadError:
-                    self.event_loop.create_task(self.discord_ctx.send("Error downloading this -->" + ie_entry.get("url")))
-                    
-                
-                filename = ydl.prepare_filename(processed_ie)
+    @property
+    def processor(self) -> Optional[Callable]:
+        return self.effect.processor if self.effect.in_process(self.output_format) else None
 
-                song_file_info = SongFileInfo(filename, processed_ie.get("title"), processed_ie.get("duration"))
+    @property
+    def tempo(self) -> float:
+        return self.effect.speed
 
-                if song_file_info not in self.playlist:
-                    try:
-                        self.playlist.append(song_file_info)
-                    except (NameError, Exception) as e:
-                        print(e)
-                        return
-            finally:
-                self.lock.release()
+    def set_effect(self, effect: NightcoreEffect):
+        self.effect = effect
+        self.playlist.set_speed(effect.speed)
+        self.journal("effect", **asdict(effect))
 
+    @property
+    def currently_playing_index(self) -> int:
+        return self.playlist.cursor
+
+    @currently_playing_index.setter
+    def currently_playing_index(self, index: int):
+        self.playlist.cursor = index
 
-    def setup_auto_disconnect(self):
-        @tasks.loop(minutes=5, loop=self.event_loop)
-        async def auto_disconnect():
-            voice_client: discord.VoiceClient = self.discord_ctx.voice_client
-            members: List[discord.Member] = voice_client.channel.members
-            if len([member for member in members if not member.bot]) == 0:
-                await self.discord_ctx.send("Disconnecting due to there is nobody in the VC")
-                voice_client.stop()
-                await voice_client.disconnect()
+    def queue(self, page: int = 0):
+        """A page of the queue, the one with the song playing by default"""
+        return self.playlist.render_page(page)
 
-        auto_disconnect.start()
-        self.auto_disconnect: tasks.Loop = auto_disconnect
 
-    def skip(self, index: int):
+    def process_playlist_youtube(self, ie_entries: List):
+        """Download the rest of a playlist in the background, keeping its order"""
+        scheduler = OrderedDownloadScheduler(
+            ie_entries,
+            self.download_playlist_entry,
+            self.publish_song,
+            config.NIGHTCORE_DOWNLOAD_CONCURRENCY)
+        self.downloads.append(scheduler)
+        scheduler.start(self.download_pool)
+
+    def download_playlist_entry(self, ie_entry: Dict) -> Optional[SongFileInfo]:
+        song_file_info = self.song_from_store(ie_entry.get("id"))
+        if song_file_info is not None:
+            return song_file_info
+
+        result = self.extract(ExtractionRequest("download", ie_entry.get("url"), ie_entry.get("ie_key")), config.DOWNLOAD_TIMEOUT)
+        if result.song is None:
+            self.send("Error downloading this -->" + ie_entry.get("url"))
+            return None
+
+        song_file_info = result.song
+        self.extraction_cache.put_video(song_file_info.video_id, song_file_info.title, song_file_info.duration)
+        self.media_store.add(song_file_info.video_id, song_file_info.filename, song_file_info.title, song_file_info.duration)
+        return song_file_info
+
+    def publish_song(self, song_file_info: SongFileInfo):
+        # the lock is only held to put the finished song in the playlist
+        with self.playlist_changed:
+            if self.playlist.append(song_file_info):
+                self.media_store.pin(song_file_info.video_id)
+                self.journal_song(song_file_info)
+            self.playlist_changed.notify_all()
+
+    def downloading(self) -> bool:
+        return any(not scheduler.is_done() for scheduler in self.downloads)
+
+    def skip(self, index: int = -1):
+        """Go to the next song, or to the song at index if it is given"""
         if index > -1:
-            self.currently_playing_index = index - 1
-        self.ffmpeg.communicate(b'q')
+            self.controls.put(PlayerControl("jump", index))
+        else:
+            self.controls.put(PlayerControl("skip"))
+
+    def seek(self, seconds: float):
+        if not math.isfinite(seconds):
+            # would overflow turning it into a frame on the player thread
+            raise ValueError(f"can't seek to {seconds}")
+        self.controls.put(PlayerControl("seek", max(0.0, seconds)))
+
+    def restart(self):
+        self.controls.put(PlayerControl("seek", 0.0))
+
+    def remove(self, index: int):
+        self.controls.put(PlayerControl("remove", index))
 
+    def move(self, index: int, destination: int):
+        self.controls.put(PlayerControl("move", index, destination))
+
+    def shuffle(self):
+        self.controls.put(PlayerControl("shuffle"))
+
+    def journal(self, event: str, **payload):
+        self.player_journal.record(self.discord_ctx.guild.id, self.player_token, event, **payload)
+
+    def journal_song(self, song_file_info: SongFileInfo, index: int = None):
+        song = dict(video_id=song_file_info.video_id, filename=song_file_info.filename,
+                    title=song_file_info.title, duration=song_file_info.duration)
+        if index is None:
+            self.journal("add", **song)
+        else:
+            self.journal("insert", index=index, **song)
+
+    def journal_position(self, frames_read: int):
+        self.journal("position", index=self.currently_playing_index, offset=frames_read / FRAMES_PER_SECOND)
+
+    def restore(self, state: GuildPlayerState):
+        """Queue the songs of a saved state that are still on disk and continue where it stopped
+
+        Nothing is extracted or downloaded again, a song that got evicted
+        from the media store meanwhile is left out."""
+        played_before = 0
+        resume_current = False
+        for position, song in enumerate(state.songs):
+            media_entry = self.media_store.get(song["video_id"])
+            if media_entry is None:
+                continue
+            song_file_info = SongFileInfo(media_entry.path, song["title"], song["duration"], video_id=song["video_id"])
+            if not self.playlist.append(song_file_info):
+                continue
+            self.media_store.pin(song_file_info.video_id)
+            self.journal_song(song_file_info)
+            if position < state.index:
+                played_before += 1
+            elif position == state.index:
+                resume_current = True
+
+        # the player thread step onto the next index before playing it
+        self.currently_playing_index = played_before - 1
+        if resume_current and state.offset:
+            self.seek(state.offset)
+        self.repeating_mode = state.repeating
+        self.journal("repeat", on=state.repeating)
+        if state.effect is not None:
+            self.set_effect(NightcoreEffect(**state.effect))
+        if state.volume is not None:
+            self.volume = state.volume
+
+    @metrics.instrumented
     def read(self):
         if isinstance(self.audio_reader, GeneratorType):
             try:
                 audio_frame = next(self.audio_reader)
             except StopIteration:
                 return b''
+            if self.opus:
+                return audio_frame
             if len(audio_frame) < 3840:
-                return bytes(3840)
-            else:
-                return audioop.mul(audio_frame, 2, 0.07)
+                # pad rather than drop the end of the song
+                audio_frame += bytes(3840 - len(audio_frame))
+            return self.gain.process(audio_frame)
         else:
             return b''
     
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float):
+        # in opus mode the new volume is used from the next song on
+        self._volume = min(1.0, value)
+        self.gain.volume = self._volume
+        self.journal("volume", volume=self._volume)
+
+    def is_opus(self):
+        return self.opus
+
+    def metrics_gauges(self) -> Dict[str, float]:
+        return {
+            "playlist_length": len(self.playlist),
+            "playlist_index": self.currently_playing_index,
+            "prebuffered_frames": len(self.decoder.prebuffered) if self.decoder is not None else 0,
+            "pending_extractions": len(self.extractions),
+        }
+
+    def ffmpeg_processes(self) -> List[subprocess.Popen]:
+        decoders = [self.decoder] + ([self.upcoming[1]] if self.upcoming is not None else [])
+        return [decoder.ffmpeg for decoder in decoders if decoder is not None]
+
     def cleanup(self):
-        try:
-            self.ffmpeg.terminate()
-        except AttributeError:
-            # this mean that ffmpeg is already terminated naturally
-            pass
-        del self.playlist
+        # also called when __init__ failed halfway, only undo what got done
+        if hasattr(self, "metrics"):
+            metrics.registry.unregister(self.metrics)
+        if hasattr(self, "player_token"):
+            # stopped on purpose, nothing to resume
+            self.journal("stop")
+        self.notifier.forget(self.discord_ctx.channel)
+        upcoming, self.upcoming = self.upcoming, None
+        if upcoming is not None:
+            _, decoder, started = upcoming
+            started.add_done_callback(lambda _: decoder.close())
+        self.prestart_pool.shutdown(wait=False)
+        for scheduler in self.downloads:
+            scheduler.cancel()
+        for future in list(self.extractions):
+            self.extraction_pool.cancel(future)
+        for song_file_info in self.playlist:
+            self.media_store.unpin(song_file_info.video_id)
+        # closing the generator closes the decoder, which release the cached reader or the cache writer
+        if hasattr(self, "audio_reader"):
+            self.audio_reader.close()
+        self.playlist.clear()
             
 
 class Nightcore(commands.Cog):
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.pool = ThreadPoolExecutor()
+        self.download_pool = ThreadPoolExecutor(max_workers=config.NIGHTCORE_DOWNLOAD_THREADS)
+        self.render_cache = RenderCache(config.NIGHTCORE_CACHE_DIR, config.NIGHTCORE_CACHE_MAX_BYTES)
+        self.media_store = MediaStore(config.MEDIA_DIR, config.MEDIA_MAX_BYTES)
+        self.extraction_cache = ExtractionCache(config.EXTRACTION_CACHE_PATH, config.EXTRACTION_VIDEO_TTL, config.EXTRACTION_PLAYLIST_TTL)
+        self.extraction_pool = ExtractionPool(config.EXTRACTION_WORKERS, config.EXTRACTION_TIMEOUT, config.EXTRACTION_LOOKUP_WORKERS)
+        self.notifier = get_notifier(bot)
+        # what each guild chose, the players started after get it too
+        self.effects: Dict[int, NightcoreEffect] = {}
+
+    def cog_unload(self):
+        self.extraction_pool.close()
+        self.media_store.close()
 
     @commands.Cog.listener()
     async def on_ready(self):
         print("Nightcore Cog is loaded.")
+
+    async def resume(self, state: GuildPlayerState):
+        """Rejoin the voice channel of a saved state and play its songs from the media store"""
+        voice_channel = self.bot.get_channel(state.voice_channel_id)
+        text_channel = self.bot.get_channel(state.text_channel_id)
+        if voice_channel is None or text_channel is None:
+            return False
+        if voice_channel.guild.voice_client is None:
+            await voice_channel.connect()
+        ctx = ResumedContext(self.bot, text_channel)
+
+        player = await self.bot.loop.run_in_executor(None, partial(NightcorePlayer, None, ctx, self.download_pool, self.render_cache, self.media_store, self.extraction_cache, self.extraction_pool))
+        await self.bot.loop.run_in_executor(None, player.restore, state)
+        if not player.playlist:
+            player.cleanup()
+            await voice_channel.guild.voice_client.disconnect()
+            return False
+        self.effects[voice_channel.guild.id] = player.effect
+
+        ctx.voice_client.play(player)
+        await ctx.send(f"Resumed the queue, {len(player.playlist)} songs.")
+        return True
     
     @commands.command(aliases=["nc"])
     async def nightcore(self, ctx: commands.Context, video_link: str):
         # await ctx.send("Nightcore feature coming soon!")
+        extracted_info = await self.extraction_cache.lookup(video_link, self.bot.loop)
 
         if ctx.voice_client.is_playing():
             source: NightcorePlayer = ctx.voice_client.source
             async with ctx.typing():
-                await self.bot.loop.run_in_executor(None, partial(source.add_song, video_link))
+                await self.bot.loop.run_in_executor(None, partial(source.add_song, video_link, extracted_info))
             return
 
         async with ctx.typing():
-            player = await self.bot.loop.run_in_executor(None, partial(NightcorePlayer, video_link, ctx, self.pool))
+            player = await self.bot.loop.run_in_executor(None, partial(NightcorePlayer, video_link, ctx, self.download_pool, self.render_cache, self.media_store, self.extraction_cache, self.extraction_pool, extracted_info,
+                                                                      effect=self.effects.get(ctx.guild.id)))
 
         ctx.voice_client.play(player)
 
@@ -280,26 +688,98 @@ class Nightcore(commands.Cog):
             ctx.voice_client.stop()
     
     @commands.command(aliases=["queue"])
-    async def nc_queue(self, ctx: commands.Context):
+    async def nc_queue(self, ctx: commands.Context, page: int = 0):
+        """Usage: .queue [page], the page of the song playing by default"""
         if ctx.voice_client is not None and isinstance(ctx.voice_client.source, NightcorePlayer):
-            await ctx.send(await self.bot.loop.run_in_executor(None, ctx.voice_client.source.queue))
+            # only the asked page is rendered, and only again once the playlist changed
+            await ctx.send(ctx.voice_client.source.queue(page))
         else:
             await ctx.send("Can't show queue right now...")
     
+    @commands.command(aliases=["playnext"])
+    async def nc_playnext(self, ctx: commands.Context, video_link: str):
+        """Usage: .playnext <link>, queued right after the song playing"""
+        if ctx.voice_client is not None and isinstance(ctx.voice_client.source, NightcorePlayer):
+            source: NightcorePlayer = ctx.voice_client.source
+            extracted_info = await self.extraction_cache.lookup(video_link, self.bot.loop)
+            async with ctx.typing():
+                await self.bot.loop.run_in_executor(None, partial(source.add_song, video_link, extracted_info, play_next=True))
+        else:
+            await ctx.send("Nothing is playing, use .nc <link> to start")
+
     @commands.command(aliases=["skip"])
     async def nc_skip(self, ctx: commands.Context, index: int = 0):
         """Index start from 1"""
         if ctx.voice_client is not None and isinstance(ctx.voice_client.source, NightcorePlayer):
             source: NightcorePlayer = ctx.voice_client.source
-            await self.bot.loop.run_in_executor(None, partial(source.skip, index - 1))
+            if index > len(source.playlist):
+                await ctx.send(f"There are only {len(source.playlist)} songs in the queue!")
+                return
+            source.skip(index - 1)
         else:
             await ctx.send("Can't skip!")
+
+    @commands.command(aliases=["remove"])
+    async def nc_remove(self, ctx: commands.Context, index: int):
+        """Index start from 1"""
+        if ctx.voice_client is not None and isinstance(ctx.voice_client.source, NightcorePlayer):
+            source: NightcorePlayer = ctx.voice_client.source
+            if not 1 <= index <= len(source.playlist):
+                await ctx.send(f"There are only {len(source.playlist)} songs in the queue!")
+                return
+            title = source.playlist[index - 1].title
+            source.remove(index - 1)
+            await ctx.send(f"Removed `{title}`")
+        else:
+            await ctx.send("Can't remove right now...")
+
+    @commands.command(aliases=["move"])
+    async def nc_move(self, ctx: commands.Context, index: int, destination: int):
+        """Usage: .move <from> <to>, index start from 1"""
+        if ctx.voice_client is not None and isinstance(ctx.voice_client.source, NightcorePlayer):
+            source: NightcorePlayer = ctx.voice_client.source
+            if not (1 <= index <= len(source.playlist) and 1 <= destination <= len(source.playlist)):
+                await ctx.send(f"There are only {len(source.playlist)} songs in the queue!")
+                return
+            title = source.playlist[index - 1].title
+            source.move(index - 1, destination - 1)
+            await ctx.send(f"Moved `{title}` to {destination}")
+        else:
+            await ctx.send("Can't move right now...")
+
+    @commands.command(aliases=["shuffle"])
+    async def nc_shuffle(self, ctx: commands.Context):
+        if ctx.voice_client is not None and isinstance(ctx.voice_client.source, NightcorePlayer):
+            ctx.voice_client.source.shuffle()
+            await ctx.send("Shuffled the songs coming up!")
+        else:
+            await ctx.send("Can't shuffle right now...")
+
+    @commands.command(aliases=["seek"])
+    async def nc_seek(self, ctx: commands.Context, timestamp: str):
+        """Usage: .seek <m:ss or seconds>"""
+        if ctx.voice_client is not None and isinstance(ctx.voice_client.source, NightcorePlayer):
+            try:
+                seconds = sum(float(part) * 60 ** power for power, part in enumerate(reversed(timestamp.split(":"))))
+                ctx.voice_client.source.seek(seconds)
+            except ValueError:
+                await ctx.send("Usage: .seek <m:ss or seconds>")
+        else:
+            await ctx.send("Can't seek right now...")
+
+    @commands.command(aliases=["restart"])
+    async def nc_restart(self, ctx: commands.Context):
+        if ctx.voice_client is not None and isinstance(ctx.voice_client.source, NightcorePlayer):
+            ctx.voice_client.source.restart()
+        else:
+            await ctx.send("Can't restart right now...")
     
     @commands.command(aliases=["repeat"])
     async def nc_repeat(self, ctx: commands.Context):
         if ctx.voice_client is not None and isinstance(ctx.voice_client.source, NightcorePlayer):
             source: NightcorePlayer = ctx.voice_client.source
             source.repeating_mode = not source.repeating_mode
+            source.journal("repeat", on=source.repeating_mode)
             if source.repeating_mode:
                 await ctx.send("Turned repeating mode on!")
             else:
@@ -307,6 +787,54 @@ class Nightcore(commands.Cog):
         else:
             await ctx.send("Can't repeat right now...")
 
+    @commands.command(aliases=["ncvolume"])
+    async def nc_volume(self, ctx: commands.Context, volume: int):
+        """Usage: .ncvolume <0-100>"""
+        if ctx.voice_client is not None and isinstance(ctx.voice_client.source, NightcorePlayer):
+            source: NightcorePlayer = ctx.voice_client.source
+            source.volume = float(volume / 100)
+            await ctx.send(f"Changed volume to {volume}")
+        else:
+            await ctx.send("Failed to change volume")
+
+
+    @commands.command(aliases=["ncspeed"])
+    async def nc_speed(self, ctx: commands.Context, percent: int):
+        """Usage: .ncspeed <50-200>, how fast the songs play, 130 is the classic nightcore"""
+        if not 50 <= percent <= 200:
+            await ctx.send("Usage: .ncspeed <50-200>")
+            return
+        await self.change_effect(ctx, speed=percent / 100)
+
+    @commands.command(aliases=["nceq"])
+    async def nc_eq(self, ctx: commands.Context, bass: float, treble: float):
+        """Usage: .nceq <bass dB> <treble dB>, both between -12 and 12"""
+        if not (-12 <= bass <= 12 and -12 <= treble <= 12):
+            await ctx.send("Usage: .nceq <bass dB> <treble dB>, both between -12 and 12")
+            return
+        await self.change_effect(ctx, bass=bass, treble=treble)
+
+    @commands.command(aliases=["ncengine"])
+    async def nc_engine(self, ctx: commands.Context, engine: str):
+        """Usage: .ncengine <rubberband or resample>, resample is the lighter one"""
+        if engine not in ENGINES:
+            await ctx.send(f"Usage: .ncengine <{' or '.join(ENGINES)}>")
+            return
+        await self.change_effect(ctx, engine=engine)
+
+    async def change_effect(self, ctx: commands.Context, **changes):
+        source = ctx.voice_client.source if ctx.voice_client is not None else None
+        if isinstance(source, NightcorePlayer):
+            effect = replace(source.effect, **changes)
+            source.set_effect(effect)
+        else:
+            effect = replace(self.effects.get(ctx.guild.id) or NightcoreEffect.from_config(), **changes)
+        self.effects[ctx.guild.id] = effect
+        if isinstance(source, NightcorePlayer):
+            await ctx.send(f"Nightcore is now {effect.describe()}, from the next song on")
+        else:
+            await ctx.send(f"Nightcore is now {effect.describe()}")
+
 
 def setup(bot: commands.Bot):
     bot.add_cog(Nightcore(bot))
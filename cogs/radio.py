@@ -1,169 +1,355 @@
-import json
-import array
-import struct
-import audioop
+import re
+import random
+import aiohttp
 import discord
 import asyncio
-import requests
 import threading
-from io import BufferedIOBase, BytesIO
-from queue import Queue, Empty as EmptyQueue
+import time
+from io import BytesIO
 from typing import *
-from subprocess import Popen, PIPE
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import partial
-from discord.ext import commands, tasks
+from discord.ext import commands
 from discord.ext.commands import CommandError
+from utils import config, metrics
+from utils.decoders import open_stream_decoder
+from utils.dsp import GainProcessor
+from utils.jitter_buffer import FrameRingBuffer, PCM_SILENCE, OPUS_SILENCE
+from utils.notifier import get_notifier
+from utils.player_journal import GuildPlayerState, ResumedContext, get_journal
+from utils.ogg import OggDemuxer
+from utils.radio_registry import RadioRegistry
+from utils.station_health import StationProber, WarmConnection
 
 
-class OggVorbisStream:
+class FFmpegClosed(Exception):
+    """ffmpeg stopped taking input, the station is going away"""
 
-    def __init__(self, file_handle: BufferedIOBase) -> None:
-        self.page_iter = self.page_generator(file_handle)
 
-    def page_generator(self, file_handle: BufferedIOBase):
-        while file_handle.read(4) == b"OggS":
-            yield OggPage(file_handle)
+class RadioStation:
+    """Broadcast hub for a radio station
 
-    def get_next_page(self):
-        try:
-            return next(self.page_iter)
-        except StopIteration:
-            return None
-
-
-class OggPage:
-
-    ogg_page_struct = struct.Struct("=BBQIIIB")
+    Only one upstream connection and one decoder is kept per
+    radio_code_name, every guild tuned into the station subscribe to it
+    and get the same decoded frames pushed into their own queue. Guilds
+    asking for another decoder backend get a station of their own.
 
-    def __init__(self, file_handle: BufferedIOBase) -> None:
-        self.version, self.mode, self.granule, self.serial, self.page_no, self.crc, self.len_seg_table = self.ogg_page_struct.unpack(
-            file_handle.read(self.ogg_page_struct.size))
+    When opus_volume is set the station encode Opus packets with the volume
+    already applied, guilds listening at the same volume share it."""
 
-        self.seg_table = array.array('B', struct.unpack(
-            'B'*self.len_seg_table, file_handle.read(self.len_seg_table)))
+    stations: Dict[Tuple[str, Optional[float], str], "RadioStation"] = {}
+    stations_lock = threading.Lock()
 
-        self.data = file_handle.read(sum(self.seg_table))
-
-    def convert_to_bytes(self):
-        return b"OggS" + self.ogg_page_struct.pack(self.version, self.mode, self.granule, self.serial, self.page_no, self.crc, self.len_seg_table) + self.seg_table.tobytes() + self.data
-
-
-class RadioPlayer(discord.AudioSource):
-    """The radio player class"""
+    session: aiohttp.ClientSession = None
+    stdin_writer = ThreadPoolExecutor(max_workers=4)
+    # set by the cog, hand over its warm connections
+    prober: StationProber = None
 
-    def __init__(self, radio_code_name: str, radio_name: str, radio_url: str, radio_format: str, discord_ctx: commands.Context):
+    def __init__(self, radio_code_name: str, radio_name: str, radio_url: str, radio_format: str, event_loop: asyncio.AbstractEventLoop,
+                 opus_volume: Optional[float] = None, decoder_backend: str = "subprocess"):
         self.radio_code_name = radio_code_name
         self.radio_name = radio_name
         self.radio_url = radio_url
         self.radio_format = radio_format
+        self.opus_volume = opus_volume
+        self.station_key = (radio_code_name, opus_volume, decoder_backend)
 
-        self.discord_ctx = discord_ctx
-        self.event_loop: asyncio.AbstractEventLoop = discord_ctx.bot.loop
-        self.last_now_playing_message: discord.Message = None
+        self.event_loop = event_loop
 
-        self._volume = 0.07
-        self.audio_queue = Queue()
+        # subscribers is replaced instead of mutated so drain_decoder
+        # can iterate over it without holding the lock for every frame
+        self.subscribers: Tuple["RadioPlayer", ...] = ()
+        self.now_playing: str = None
 
-        if self.radio_format == "direct":
-            ffmpeg_command_line = "ffmpeg -i {url} -f s16le -ac 2 -ar 48000 pipe:1".format(
-                url=radio_url).split()
+        self.closed = False
+        self.ingest_future: Future = None
+        self.bytes_ingested = 0
 
-            self.ffmpeg_process = Popen(
-                ffmpeg_command_line, stdout=PIPE, creationflags=0x08000000)
+        if self.radio_format == "direct":
+            # the decoder does the http itself
+            self.decoder = open_stream_decoder(decoder_backend, radio_url, opus_volume, config.RADIO_RECONNECT_MAX_DELAY)
+        else:
+            self.decoder = open_stream_decoder(decoder_backend, None, opus_volume)
+
+            # the upstream connection live on the bot's event loop
+            self.ingest_future = asyncio.run_coroutine_threadsafe(
+                self.ingest(), self.event_loop)
+        decoder_thread = threading.Thread(target=self.drain_decoder, daemon=True)
+        decoder_thread.start()
+
+    @classmethod
+    def active_codes(cls) -> Set[str]:
+        """Codes of the stations being ingested right now"""
+        with cls.stations_lock:
+            return {station_key[0] for station_key in cls.stations}
+
+    @classmethod
+    def subscribe(cls, player: "RadioPlayer", announce: bool = True) -> "RadioStation":
+        """Tune the player into its station, starting the station if nobody is listening to it yet"""
+        opus_volume = player.volume if player.opus else None
+        with cls.stations_lock:
+            station = cls.stations.get((player.radio_code_name, opus_volume, player.decoder_backend))
+            if station is None:
+                station = cls(player.radio_code_name, player.radio_name,
+                              player.radio_url, player.radio_format, player.event_loop, opus_volume, player.decoder_backend)
+                cls.stations[station.station_key] = station
+            station.subscribers = station.subscribers + (player,)
+            now_playing = station.now_playing
+
+        # let the new guild know what is currently on air
+        if announce and now_playing is not None:
+            player.tell_now_playing(now_playing)
+
+        return station
+
+    def unsubscribe(self, player: "RadioPlayer"):
+        """Remove the player from the station, the station is torn down when the last guild leaves"""
+        with RadioStation.stations_lock:
+            self.subscribers = tuple(
+                subscriber for subscriber in self.subscribers if subscriber is not player)
+            if self.subscribers:
+                return
+            if RadioStation.stations.get(self.station_key) is self:
+                del RadioStation.stations[self.station_key]
+        self.close()
+
+    def close(self):
+        self.closed = True
+        if self.ingest_future is not None:
+            self.ingest_future.cancel()
+        self.decoder.stop()
+
+    def broadcast_metadata(self, metadata_type: str, metadata: Any):
+        if metadata_type == "vorbis":
+            song_name = f"{metadata.get('artist', 'Unknown artist')} - {metadata.get('title', 'Unknown title')}"
         else:
-            ffmpeg_command_line = "ffmpeg -i pipe:0 -f s16le -ac 2 -ar 48000 pipe:1".split()
+            song_name = self.get_current_song_title(metadata)
+        if song_name is None:
+            return
+
+        self.now_playing = song_name
+        for subscriber in self.subscribers:
+            subscriber.tell_now_playing(song_name)
 
-            self.ffmpeg_process = Popen(
-                ffmpeg_command_line, stdin=PIPE, stdout=PIPE, creationflags=0x08000000)
-            # the creationflags part is only if this is running in Windows
+    @staticmethod
+    def get_current_song_title(metadata_string: str) -> Optional[str]:
+        match = re.search(r"StreamTitle='(.*?)';", metadata_string)
+        if match:
+            return match.group(1)
+        return None
+
+    def drain_decoder(self):
+        for data in self.decoder.frames():
+            # a guild that stopped reading slow us down for at most one
+            # frame, after that its oldest frames get dropped instead
+            deadline = time.monotonic() + 0.02
+            for subscriber in self.subscribers:
+                try:
+                    audio_buffer: FrameRingBuffer = subscriber.audio_buffer
+                except AttributeError:
+                    # subscriber got cleaned up while we were fanning out
+                    continue
+                if not audio_buffer.put(data, timeout=max(0, deadline - time.monotonic())):
+                    audio_buffer.put_overwrite(data)
+
+        # the decoder is gone, make sure the next .radio starts a fresh station
+        with RadioStation.stations_lock:
+            if RadioStation.stations.get(self.station_key) is self:
+                del RadioStation.stations[self.station_key]
+            subscribers = self.subscribers
+
+        # let the guilds still tuned in finish what is buffered and stop
+        for subscriber in subscribers:
+            try:
+                subscriber.audio_buffer.close()
+            except AttributeError:
+                continue
+
+    @classmethod
+    def get_session(cls) -> aiohttp.ClientSession:
+        """The connection pool shared by every station, must be called on the event loop"""
+        if cls.session is None or cls.session.closed:
+            cls.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=config.RADIO_CONNECTION_LIMIT, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30))
+        return cls.session
+
+    async def ingest(self):
+        """Stream the station into ffmpeg, reconnecting with exponential backoff when it drop"""
+        attempt = 0
+        # only the first connection can be a warm one
+        warm_connection = None
+        if self.prober is not None and self.radio_format != "vorbis":
+            warm_connection = await self.prober.claim(self.radio_code_name)
+        if self.prober is not None:
+            # this station count as active from now on, the warm connection
+            # it may have had goes to the next most played one
+            self.prober.refresh_warm()
+        while not self.closed:
+            bytes_ingested = self.bytes_ingested
+            connected_at = self.event_loop.time()
+            try:
+                if warm_connection is not None:
+                    warm_connection, claimed = None, warm_connection
+                    await self.ingest_warm(claimed)
+                else:
+                    headers = {"Icy-MetaData": "1"} if self.radio_format != "vorbis" else {}
+                    async with self.get_session().get(self.radio_url, headers=headers) as response:
+                        response.raise_for_status()
+                        if self.radio_format == "vorbis":
+                            await self.ingest_vorbis(response)
+                        else:
+                            await self.ingest_icy(response)
+            except FFmpegClosed:
+                return
+            except (aiohttp.ClientError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError) as e:
+                print(f"Lost connection to {self.radio_name}: {e!r}")
+
+            if self.bytes_ingested > bytes_ingested and self.event_loop.time() - connected_at > config.RADIO_RECONNECT_MAX_DELAY:
+                # it did play for a while, start the backoff over
+                attempt = 0
+            if self.closed:
+                return
+            if attempt >= config.RADIO_RECONNECT_ATTEMPTS:
+                print(f"Giving up on {self.radio_name} after {attempt} reconnects")
+                # ffmpeg finish what it has and drain_decoder end the station
+                try:
+                    await self.event_loop.run_in_executor(self.stdin_writer, self.decoder.close_input)
+                except (OSError, ValueError):
+                    pass
+                return
 
-            # Threading!
-            stdin_thread = threading.Thread(
-                target=self.stdin_blaster, daemon=True)
-            stdin_thread.start()
-        stdout_thread = threading.Thread(target=self.drain_stdout, daemon=True)
-        stdout_thread.start()
+            delay = min(config.RADIO_RECONNECT_MAX_DELAY, 0.5 * 2 ** attempt)
+            attempt += 1
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
 
-        self.setup_auto_disconnect()
+    async def write_stdin(self, data: bytes):
+        # pipe writes can block so they are done on the small shared pool
+        # instead of a dedicated thread for every station
+        try:
+            await self.event_loop.run_in_executor(self.stdin_writer, self.decoder.write, data)
+        except (OSError, ValueError):
+            raise FFmpegClosed()
+        self.bytes_ingested += len(data)
 
-    def drain_stdout(self):
-        stdout: IO = self.ffmpeg_process.stdout
+    async def ingest_warm(self, warm_connection: WarmConnection):
+        """Carry on from a connection the prober kept open, starting with the audio it held on to"""
+        try:
+            if warm_connection.last_metadata is not None:
+                self.broadcast_metadata("icy", warm_connection.last_metadata)
+            await self.write_stdin(warm_connection.backlog())
+            await self.ingest_icy(warm_connection.response, warm_connection.audio_left, warm_connection.metadata_left)
+        finally:
+            warm_connection.close()
+
+    async def ingest_icy(self, response: aiohttp.ClientResponse, audio_left: int = None, metadata_left: int = 0):
+        """audio_left and metadata_left pick a stream up from the middle of a block"""
+        content = response.content
+        metaint = response.headers.get("icy-metaint")
+        if metaint is None:
+            # the server does not interleave metadata
+            async for data in content.iter_chunked(16384):
+                await self.write_stdin(data)
+            return
+
+        metaint = int(metaint)
+        if metadata_left:
+            # what is left of a block the warm connection was reading, the
+            # title get announced with the next one
+            await content.readexactly(metadata_left)
+        audio_left = metaint if audio_left is None else audio_left
         while True:
-            data = stdout.read(3840)
+            if audio_left:
+                await self.write_stdin(await content.readexactly(audio_left))
+            audio_left = metaint
+
+            metadata_block_size = (await content.readexactly(1))[0]
+            if metadata_block_size != 0:
+                metadata_bytes: bytes = await content.readexactly(metadata_block_size * 16)
+                self.broadcast_metadata(
+                    "icy", metadata_bytes.decode("utf-8", errors="replace"))
+
+    async def ingest_vorbis(self, response: aiohttp.ClientResponse):
+        content = response.content
+        # a reconnect start a new chained stream so it get a fresh demuxer,
+        # ffmpeg pick the new stream up from its headers
+        demuxer = OggDemuxer()
+        while True:
+            data = await content.readany()
             if not data:
-                break
-            try:
-                self.audio_queue.put(data)
-            except AttributeError:
                 return
+            demuxer.feed(data)
 
-    def stdin_blaster(self):
-        stdin: IO = self.ffmpeg_process.stdin
-        if self.radio_format != "vorbis":
-            headers = {"Icy-MetaData": "1"}
-            with requests.get(self.radio_url, headers=headers, stream=True) as response:
-                response.raise_for_status()
+            for page in demuxer.pages():
+                for packet in demuxer.packets(page):
+                    if packet[:7] == b"\x03vorbis":
+                        self.broadcast_metadata("vorbis", self.parse_vorbis_comment(packet))
 
-                metaint: int = int(response.headers.get("icy-metaint"))
-                try:
-                    data = response.raw.read(metaint)
-                    while True:
-                        stdin.write(data)
-
-                        metadata_block_size = int.from_bytes(
-                            response.raw.read(1), byteorder="little")
-                        if metadata_block_size != 0:
-                            metadata_bytes: bytes = response.raw.read(
-                                metadata_block_size * 16)
-                            self.event_loop.create_task(
-                                self.tell_text_channel_currently_playing(metadata_bytes.decode("utf-8")))
-
-                        data = response.raw.read(metaint)
-                except OSError:
-                    # ffmpeg closed
-                    return
-        else:
-            with requests.get(self.radio_url, stream=True) as response:
-                response.raise_for_status()
+                # the page is passed on exactly as it was received
+                await self.write_stdin(page.raw)
+
+    @staticmethod
+    def parse_vorbis_comment(data: bytes) -> Dict[str, str]:
+        metadata = dict()
+
+        data_io = BytesIO(data)
 
-                ogg_stream = OggVorbisStream(response.raw)
+        data_io.read(7)
 
-                page = ogg_stream.get_next_page()
+        data_io.read(int.from_bytes(
+            data_io.read(4), "little", signed=False))
 
-                while page:
-                    if page.data[:7] == b"\x03vorbis":
-                        metadata = dict()
+        for _ in range(int.from_bytes(data_io.read(4), "little", signed=False)):
+            separated_metadata = data_io.read(int.from_bytes(
+                data_io.read(4), "little", signed=False)).decode(errors="replace").split('=')
+            metadata[separated_metadata[0].lower()] = "=".join(
+                separated_metadata[1:])
 
-                        data_io = BytesIO(page.data)
+        return metadata
 
-                        data_io.read(7)
 
-                        data_io.read(int.from_bytes(
-                            data_io.read(4), "little", signed=False))
+class RadioPlayer(discord.AudioSource):
+    """The radio player class
+
+    Each guild get its own RadioPlayer with its own volume, the decoding
+    itself is done once per station by RadioStation"""
+
+    def __init__(self, radio_code_name: str, radio_name: str, radio_url: str, radio_format: str, discord_ctx: commands.Context,
+                 decoder_backend: str = None):
+        self.radio_code_name = radio_code_name
+        self.radio_name = radio_name
+        self.radio_url = radio_url
+        self.radio_format = radio_format
+        self.decoder_backend = decoder_backend or config.DECODER_BACKEND
 
-                        for _ in range(int.from_bytes(data_io.read(4), "little", signed=False)):
-                            separated_metadata = data_io.read(int.from_bytes(
-                                data_io.read(4), "little", signed=False)).decode().split('=')
-                            metadata[separated_metadata[0].lower()] = "=".join(
-                                separated_metadata[1:])
+        self.discord_ctx = discord_ctx
+        self.event_loop: asyncio.AbstractEventLoop = discord_ctx.bot.loop
+        self.notifier = get_notifier(discord_ctx.bot)
 
-                        del data_io
+        self._volume = 0.07
+        self.gain = GainProcessor(self._volume)
 
-                        self.event_loop.create_task(self.tell_np_vorbis(metadata))
+        # in opus mode discord get the packets as they are and the
+        # volume is applied by the station's ffmpeg instead
+        self.opus = bool(config.OPUS_PASSTHROUGH)
+        self.audio_buffer = FrameRingBuffer(
+            config.RADIO_BUFFER_FRAMES, config.RADIO_PREBUFFER_FRAMES, OPUS_SILENCE if self.opus else PCM_SILENCE)
+        self.silence_frame = self.audio_buffer.silence
+        self.station = RadioStation.subscribe(self)
 
-                        del metadata
+        self.metrics = metrics.registry.register(metrics.SourceMetrics(
+            "radio", discord_ctx.guild.id, self.metrics_gauges, lambda: [self.station.decoder.process]))
 
-                    try:
-                        stdin.write(page.convert_to_bytes())
-                    except OSError:
-                        return
+        self.player_journal = get_journal()
+        self.player_token = self.player_journal.new_player()
+        self.journal("start", kind="radio", voice_channel_id=discord_ctx.voice_client.channel.id,
+                     text_channel_id=discord_ctx.channel.id, radio_code=radio_code_name, volume=self._volume)
 
-                    page = ogg_stream.get_next_page()
+    def journal(self, event: str, **payload):
+        self.player_journal.record(self.discord_ctx.guild.id, self.player_token, event, **payload)
 
-    async def tell_np_vorbis(self, metadata: Dict):
-        if self.last_now_playing_message:
-            await self.last_now_playing_message.delete()
-        self.last_now_playing_message = await self.discord_ctx.send(f"Now playing {metadata['artist']} - {metadata['title']} from {self.radio_name}")
+    def tell_now_playing(self, song_name: str):
+        self.notifier.notify(self.discord_ctx.channel, f"Now playing {song_name} from {self.radio_name}")
 
     @property
     def volume(self):
@@ -172,56 +358,50 @@ class RadioPlayer(discord.AudioSource):
     @volume.setter
     def volume(self, value: float):
         self._volume = min(1.0, value)
-
-    def get_current_song_title(self, metadata_string: str):
-        """Temp func until able to tell what is playing in the text channel"""
-        metadatas = metadata_string.split(";")
-        for metadata_line in metadatas:
-            metadata_line_pair = metadata_line.split("=")
-            if metadata_line_pair[0] == "StreamTitle":
-                # print("Currently playing {song_name} in {server_name}".format(
-                #     song_name=metadata_line_pair[1].strip("'"), server_name=self.discord_ctx.guild))
-                # break
-                return metadata_line_pair[1].strip("'")
-
-    async def tell_text_channel_currently_playing(self, metadata: str):
-        song_name = await self.event_loop.run_in_executor(None, partial(self.get_current_song_title, metadata))
-        if self.last_now_playing_message:
-            await self.last_now_playing_message.delete()
-        self.last_now_playing_message = await self.discord_ctx.send(f"Now playing {song_name} from {self.radio_name}")
-
-    def setup_auto_disconnect(self):
-        @tasks.loop(minutes=5, loop=self.event_loop)
-        async def auto_disconnect():
-            voice_client: discord.VoiceClient = self.discord_ctx.voice_client
-            members: List[discord.Member] = voice_client.channel.members
-            if len([member for member in members if not member.bot]) == 0:
-                await self.discord_ctx.send("Disconnecting due to there is nobody in the VC")
-                voice_client.stop()
-                await voice_client.disconnect()
-
-        auto_disconnect.start()
-        self.auto_disconnect: tasks.Loop = auto_disconnect
-
+        self.gain.volume = self._volume
+        self.journal("volume", volume=self._volume)
+        if self.opus:
+            # move over to the station encoding at the new volume
+            old_station = self.station
+            self.station = RadioStation.subscribe(self, announce=False)
+            old_station.unsubscribe(self)
+
+    def is_opus(self):
+        return self.opus
+
+    @metrics.instrumented
     def read(self):
-        try:
-            return audioop.mul(self.audio_queue.get(timeout=15), 2, self._volume)
-        except EmptyQueue:
-            return b''
+        audio_frame = self.audio_buffer.get()
+        if self.opus or audio_frame is self.audio_buffer.silence or not audio_frame:
+            return audio_frame
+        return self.gain.process(audio_frame)
+
+    def buffer_stats(self) -> Dict[str, int]:
+        """Occupancy and underrun counters of the jitter buffer, for tuning its depth"""
+        return self.audio_buffer.stats()
+
+    def metrics_gauges(self) -> Dict[str, float]:
+        buffer_stats = self.buffer_stats()
+        return {
+            "buffer_occupancy_frames": buffer_stats["occupancy"],
+            "buffer_underruns": buffer_stats["underruns"],
+            "buffer_overruns": buffer_stats["overruns"],
+            "station_bytes_ingested": self.station.bytes_ingested,
+        }
 
     def cleanup(self):
-        self.auto_disconnect.cancel()
-        self.ffmpeg_process.terminate()
-
-        del self.auto_disconnect
-        del self.audio_queue
-        del self.ffmpeg_process
-        del self.last_now_playing_message
+        # also called when __init__ failed halfway, only undo what got done
+        if hasattr(self, "metrics"):
+            metrics.registry.unregister(self.metrics)
+        if hasattr(self, "player_token"):
+            # stopped on purpose, nothing to resume
+            self.journal("stop")
+        self.notifier.forget(self.discord_ctx.channel)
+        if hasattr(self, "station"):
+            self.station.unsubscribe(self)
 
-        del self.radio_code_name
-        del self.radio_format
-        del self.radio_name
-        del self.radio_url
+        for name in ("audio_buffer", "station", "radio_code_name", "radio_format", "radio_name", "radio_url"):
+            self.__dict__.pop(name, None)
 
 
 class Radio(commands.Cog):
@@ -229,24 +409,64 @@ class Radio(commands.Cog):
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        self.registry = RadioRegistry()
+        self.notifier = get_notifier(bot)
+
+        self.prober = StationProber(
+            self.registry, bot.loop, config.RADIO_PROBE_INTERVAL, config.RADIO_PROBE_CONCURRENCY, config.RADIO_PROBE_TIMEOUT,
+            config.RADIO_WARM_STATIONS, config.RADIO_WARM_BACKLOG_BYTES, RadioStation.active_codes)
+        RadioStation.prober = self.prober
+        self.prober_task = bot.loop.create_task(self.prober.run())
+
+    def cog_unload(self):
+        if RadioStation.session is not None:
+            self.bot.loop.create_task(RadioStation.session.close())
+        RadioStation.prober = None
+        self.prober_task.cancel()
+        self.bot.loop.create_task(self.prober.close())
 
     @commands.Cog.listener()
     async def on_ready(self):
         print("Radio Cog is loaded.")
 
+    async def resume(self, state: GuildPlayerState):
+        """Rejoin the voice channel of a saved state and tune back into its station"""
+        station = self.registry.get(state.radio_code)
+        voice_channel = self.bot.get_channel(state.voice_channel_id)
+        text_channel = self.bot.get_channel(state.text_channel_id)
+        if station is None or voice_channel is None or text_channel is None:
+            return False
+        if voice_channel.guild.voice_client is None:
+            await voice_channel.connect()
+        ctx = ResumedContext(self.bot, text_channel)
+
+        player = await self.bot.loop.run_in_executor(None, partial(RadioPlayer, station.code, station.name, station.url, station.format, ctx))
+        if state.volume is not None and state.volume != player.volume:
+            player.volume = state.volume
+        ctx.voice_client.play(player)
+        return True
+
     @commands.command()
     async def radio(self, ctx: commands.Context, radio_code_name: str):
         """Command to play a radio"""
 
-        radio_data = await self.bot.loop.run_in_executor(None, partial(Radio.get_radio, radio_code_name))
+        station = self.registry.resolve(radio_code_name)
 
-        # There are always 3 element in radio_data, [0] is the url
-        # [1] is the format and [2] is the radio name
-
-        if not radio_data:
+        if station is None:
+            suggestions = self.registry.suggestions(radio_code_name)
+            if suggestions:
+                return await ctx.send(f"There is no such thing as {radio_code_name}, did you mean {', '.join(suggestions)}?")
             return await ctx.send(f"There is no such thing as {radio_code_name}")
 
-        player = await self.bot.loop.run_in_executor(None, partial(RadioPlayer, radio_code_name, radio_data[2], radio_data[0], radio_data[1], ctx))
+        health = self.prober.get(station.code)
+        if health is not None and not health.up:
+            # it was down on the last round, it might be back by now
+            health = await self.prober.probe(station)
+            if not health.up:
+                return await ctx.send(f"{station.name} seems to be down right now, try again later!")
+        self.prober.played(station.code)
+
+        player = await self.bot.loop.run_in_executor(None, partial(RadioPlayer, station.code, station.name, station.url, station.format, ctx))
 
         ctx.voice_client.play(player)
 
@@ -297,40 +517,32 @@ class Radio(commands.Cog):
             ctx.voice_client.stop()
 
     @commands.command(aliases=["radios"])
-    async def list_all_radio(self, ctx: commands.Context):
-        line_format = "{radio_name} -> {radio_code}\n"
-        formatted_str = ""
+    async def list_all_radio(self, ctx: commands.Context, page_number: int = 1):
+        """Usage: .radios [page]"""
+        page, page_count = self.registry.get_page(page_number, self.prober.annotations())
 
-        radios: Dict = await self.bot.loop.run_in_executor(None, Radio.get_radios)
-
-        radio_code: str
-        radio_data: List[str]
-        for radio_code, radio_data in radios.items():
-            formatted_str += line_format.format(
-                radio_name=radio_data[2], radio_code=radio_code)
+        footer = ""
+        if page_count > 1:
+            footer = f"Page {min(max(page_number, 1), page_count)}/{page_count}"
 
         await ctx.send(
             "```\n" +
-            formatted_str +
-            "```"
+            page +
+            "```" +
+            footer
         )
 
-    @staticmethod
-    def get_radio(radio_name: str) -> Union[Dict, bool]:
-        with open("data/radios.json", 'r') as json_file:
-            radios: Dict = json.load(json_file)
-
-        try:
-            return radios[radio_name]
-        except:
-            return False
-
-    @staticmethod
-    def get_radios():
-        with open("data/radios.json", 'r') as json_file:
-            radios: Dict = json.load(json_file)
-
-        return radios
+    @commands.command(aliases=["radiorank"])
+    async def radio_ranking(self, ctx: commands.Context):
+        """The stations that answered the last health check, quickest first"""
+        ranking = self.prober.ranking()
+        if not ranking:
+            return await ctx.send("The stations were not checked yet, try again in a bit!")
+
+        lines = [f"{index + 1}. {self.registry.stations[health.code].name} -> {health.code} "
+                 f"[{health.annotation}, connect {health.connect_latency * 1000:.0f}ms{', icy' if health.icy else ''}]"
+                 for index, health in enumerate(ranking[:15]) if health.code in self.registry.stations]
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
 
 
 def setup(bot: commands.Bot):
@@ -1,12 +1,45 @@
+import time
+STARTED_AT = time.perf_counter()
+
 import os
 import random
 from typing import *
-from discord import Intents
+from discord import Intents, MemberCacheFlags
 from discord.ext import commands
+from utils import config, metrics
+from utils.lazy_cogs import LazyCogLoader
+from utils.player_journal import get_journal
+from utils.voice_presence import VoicePresenceTracker
+
+IMPORTED_AT = time.perf_counter()
+
+# only what the commands use, members are only cached while they are in
+# voice, which is all the voice channel member lists need
+intents = Intents.none()
+intents.guilds = True
+intents.guild_messages = True
+intents.dm_messages = True
+intents.voice_states = True
+
+# the cog and the class of every kind of player that can be resumed
+RESUMABLE_PLAYERS = {"nightcore": ("cogs.nightcore", "Nightcore"), "radio": ("cogs.radio", "Radio")}
+
+
+class NazBot(commands.Bot):
+
+    async def close(self):
+        # the players are cleaned up while disconnecting, stop journaling
+        # first so they get resumed on the next start instead of forgotten
+        if config.PLAYER_RESUME:
+            get_journal().close()
+        await super().close()
+
 
 # BOT DECLARATION
-bot = commands.Bot(command_prefix=".",
-                   description="Bot that Naz made.", intents=Intents.all())
+bot = NazBot(command_prefix=".",
+             description="Bot that Naz made.", intents=intents,
+             member_cache_flags=MemberCacheFlags.from_intents(intents), chunk_guilds_at_startup=False)
+cog_loader = LazyCogLoader(bot)
 
 # BOT EVENTS
 
@@ -17,6 +50,11 @@ async def on_ready():
         "Bot is ready!\n"
         f"Bot username: {bot.user}"
     )
+    if not hasattr(bot, "startup_report"):
+        bot.startup_report = startup_report()
+        print(bot.startup_report)
+        if config.PLAYER_RESUME:
+            await resume_players()
 
 
 # BOT COMMANDS
@@ -51,7 +89,10 @@ async def random_number_error(ctx: commands.Context, error):
 @bot.command(aliases=["rld"])
 @commands.is_owner()
 async def reload(ctx: commands.Context, extension_name: str):
-    bot.reload_extension(f"cogs.{extension_name}")
+    if f"cogs.{extension_name}" in bot.extensions:
+        bot.reload_extension(f"cogs.{extension_name}")
+    else:
+        cog_loader.load(f"cogs.{extension_name}")
 
     await ctx.send(f"Successfully reloaded {extension_name}")
 
@@ -73,12 +114,64 @@ async def leave_voice_channel(ctx: commands.Context):
     print(f"Disconnected from {ctx.guild}!")
 
 
+@bot.command()
+@commands.is_owner()
+async def stats(ctx: commands.Context):
+    """Frame timing of every player, event loop lag and ffmpeg usage"""
+    text = await bot.loop.run_in_executor(None, metrics.registry.render_text)
+    await ctx.send(f"```\n{text[:1900]}\n```")
+
+
+@stats.error
+async def stats_error(ctx: commands.Context, error):
+    if isinstance(error, commands.NotOwner):
+        await ctx.send("You do not have enough power to access this command.")
+
+
 # UTILITY FUNCTION
+def startup_report() -> str:
+    ready_at = time.perf_counter()
+    report = (f"Started in {ready_at - STARTED_AT:.2f}s "
+              f"(imports {IMPORTED_AT - STARTED_AT:.2f}s, login and guilds {ready_at - IMPORTED_AT:.2f}s), "
+              f"{len(bot.guilds)} guilds, {len(bot.extensions)} cogs loaded, "
+              f"{sum(len(placeholders) for placeholders in cog_loader.placeholders.values())} commands waiting for their cog")
+    if metrics.psutil is not None:
+        report += f", {metrics.psutil.Process().memory_info().rss / 2 ** 20:.0f}MiB rss"
+    return report
+
+
+async def resume_players():
+    """Rejoin the guilds that were playing when the bot went down"""
+    journal = get_journal()
+    for state in journal.saved:
+        extension_name, cog_name = RESUMABLE_PLAYERS.get(state.kind, (None, None))
+        resumed = False
+        try:
+            if extension_name is not None:
+                cog_loader.load(extension_name)
+                resumed = await bot.get_cog(cog_name).resume(state)
+        except Exception as e:
+            print(f"Failed to resume the {state.kind} player of {state.guild_id}: {e!r}")
+        if resumed:
+            print(f"Resumed the {state.kind} player of {state.guild_id}")
+        else:
+            # nothing left to resume it with, don't try again on the next start
+            journal.record(state.guild_id, state.player, "stop")
 
 
 # CODE TO RUN BEFORE STARTING BOT
-for filename in os.listdir("./cogs"):
-    if filename.endswith(".py"):
-        bot.load_extension(f"cogs.{filename[:-3]}")
+# the youtube_dl worker processes import this file again, they must not start a bot
+if __name__ == "__main__":
+    if config.LAZY_COGS:
+        cog_loader.register_all()
+    else:
+        cog_loader.load_all()
+
+    voice_presence = VoicePresenceTracker(bot, config.VOICE_IDLE_TIMEOUT)
+    bot.add_listener(voice_presence.on_voice_state_update)
+
+    bot.loop.create_task(metrics.registry.monitor_event_loop())
+    if config.METRICS_PORT:
+        bot.loop.create_task(metrics.registry.serve_prometheus("127.0.0.1", config.METRICS_PORT))
 
-bot.run(os.getenv("DISCORDBOTAPIKEY"))
+    bot.run(os.getenv("DISCORDBOTAPIKEY"))
@@ -0,0 +1,33 @@
+import unittest
+from utils.extraction import ExtractionPool, ExtractionRequest, ExtractionError
+
+
+class ExtractionPoolQueueTest(unittest.TestCase):
+    """No worker process is started, the requests are taken by hand"""
+
+    def setUp(self):
+        self.pool = ExtractionPool(0, 60)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_lookups_go_first(self):
+        download = self.pool.submit(ExtractionRequest("download", "https://youtu.be/a"))
+        link = self.pool.submit(ExtractionRequest("link", "https://youtu.be/b"))
+
+        self.assertIs(self.pool.take(lookups_only=True)[2], link)
+        self.assertIs(self.pool.take(lookups_only=False)[2], download)
+
+    def test_submit_after_close(self):
+        queued = self.pool.submit(ExtractionRequest("persist", processed_info={}))
+        self.pool.close()
+        late = self.pool.submit(ExtractionRequest("resolve", "https://youtu.be/c"))
+
+        for future in (queued, late):
+            with self.assertRaises(ExtractionError):
+                future.result(timeout=1)
+        self.assertIsNone(self.pool.take(lookups_only=False))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import json
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from utils.media_store import MediaStore
+
+
+class MediaStoreSaveTest(unittest.TestCase):
+    """Every guild touch the store from its own player thread"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        # only saved when the tests ask for it
+        self.store = MediaStore(self.directory.name, 2 ** 30, save_interval=3600)
+        for number in range(4):
+            path = os.path.join(self.directory.name, f"video{number}.webm")
+            with open(path, "wb") as media_file:
+                media_file.write(b"\0" * 16)
+            self.store.add(f"video{number}", path)
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def saved_index(self):
+        with open(self.store.index_path) as json_file:
+            return json.load(json_file)
+
+    def test_touch_does_not_write(self):
+        self.store.save()
+        saved = self.saved_index()
+        self.store.touch("video0")
+        self.assertEqual(self.saved_index(), saved)
+
+        self.store.close()
+        self.assertGreater(self.saved_index()["video0"]["last_played"], saved["video0"]["last_played"])
+
+    def test_concurrent_touch(self):
+        def play(video_id: str):
+            for _ in range(200):
+                self.store.touch(video_id)
+                self.store.save()
+
+        threads = [threading.Thread(target=play, args=(f"video{number % 4}",)) for number in range(8)]
+        # a failed save is only printed
+        with mock.patch("builtins.print") as printed:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        printed.assert_not_called()
+        self.store.close()
+        self.assertEqual(sorted(self.saved_index()), [f"video{number}" for number in range(4)])
+
+
+if __name__ == "__main__":
+    unittest.main()
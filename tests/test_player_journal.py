@@ -0,0 +1,63 @@
+import os
+import time
+import sqlite3
+import tempfile
+import unittest
+from utils.player_journal import PlayerJournal, GuildPlayerState
+
+
+class PlayerJournalCompactionTest(unittest.TestCase):
+    """Events recorded while the writer compact the log must replay exactly once"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "players.sqlite3")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_record_during_compaction(self):
+        journal = PlayerJournal(self.path, compact_after=10)
+        journal.record(1, "a", "start", kind="nightcore", voice_channel_id=2, text_channel_id=3)
+        for number in range(9):
+            journal.record(1, "a", "add", filename=f"f{number}")
+        time.sleep(0.2)
+
+        # hold the database so the writer get stuck on the batch that go past compact_after
+        blocker = sqlite3.connect(self.path, isolation_level=None)
+        blocker.execute("BEGIN EXCLUSIVE")
+        journal.record(1, "a", "repeat", on=True)
+        time.sleep(0.2)
+
+        # folded and queued while the writer wait, then covered by its compaction
+        journal.record(1, "a", "add", filename="fa")
+        journal.record(1, "a", "add", filename="fb")
+        journal.record(1, "a", "add", filename="fc")
+        journal.record(1, "a", "move", index=0, destination=1)
+        journal.record(1, "a", "remove", index=11)
+        blocker.execute("COMMIT")
+        blocker.close()
+        expected = [song["filename"] for song in journal.states[1].songs]
+        journal.close()
+
+        resumed = PlayerJournal(self.path)
+        try:
+            self.assertEqual(expected, ["f1", "f0"] + [f"f{number}" for number in range(2, 9)] + ["fa", "fb"])
+            self.assertEqual(len(resumed.saved), 1)
+            self.assertEqual([song["filename"] for song in resumed.saved[0].songs], expected)
+        finally:
+            resumed.close()
+
+
+class GuildPlayerStateTest(unittest.TestCase):
+
+    def test_insert_keeps_index(self):
+        state = GuildPlayerState(1, "a", "nightcore", 2, 3, songs=[{"filename": name} for name in ("f0", "f1", "f2")], index=1)
+        state.apply("insert", {"index": 0, "filename": "fa"})
+        state.apply("insert", {"index": 3, "filename": "fb"})
+        self.assertEqual([song["filename"] for song in state.songs], ["fa", "f0", "f1", "fb", "f2"])
+        self.assertEqual(state.songs[state.index]["filename"], "f1")
+
+
+if __name__ == "__main__":
+    unittest.main()
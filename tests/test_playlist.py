@@ -0,0 +1,46 @@
+import unittest
+from utils.playlist import Playlist
+from utils.song_info import SongFileInfo
+
+
+def song(name: str, title: str = None, duration: int = 60) -> SongFileInfo:
+    return SongFileInfo(f"/media/{name}.webm", title, duration, video_id=name)
+
+
+class PlaylistCursorTest(unittest.TestCase):
+    """The cursor stay on the song playing whatever gets edited around it"""
+
+    def setUp(self):
+        self.playlist = Playlist([song(name) for name in "abcd"])
+        self.playlist.cursor = 2
+
+    def playing(self) -> str:
+        return self.playlist[self.playlist.cursor].video_id
+
+    def test_insert_before_cursor(self):
+        self.assertTrue(self.playlist.insert(0, song("e")))
+        self.assertEqual(self.playing(), "c")
+        self.assertEqual([song_file_info.video_id for song_file_info in self.playlist], list("eabcd"))
+
+    def test_insert_after_cursor(self):
+        self.assertTrue(self.playlist.insert(self.playlist.cursor + 1, song("e")))
+        self.assertEqual(self.playing(), "c")
+        self.assertEqual(self.playlist[self.playlist.cursor + 1].video_id, "e")
+
+    def test_insert_already_queued(self):
+        self.assertFalse(self.playlist.insert(0, song("d")))
+        self.assertEqual(len(self.playlist), 4)
+        self.assertEqual(self.playing(), "c")
+
+
+class PlaylistPageTest(unittest.TestCase):
+
+    def test_song_without_metadata(self):
+        playlist = Playlist([song("abc"), song("def", "A title", None)], speed=1)
+        page = playlist.render_page()
+        self.assertIn("1. abc - 1:00", page)
+        self.assertIn("2. A title - ?:??", page)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import asyncio
+import unittest
+from unittest import mock
+from utils.voice_presence import TimerWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+    """The wheel sleeps once per tick, the sleeps are counted instead of waited"""
+
+    def fired_after(self, ticks: int, slot_count: int = 256) -> int:
+        loop = asyncio.new_event_loop()
+        real_sleep = asyncio.sleep
+        slept = 0
+        fired = loop.create_future()
+
+        async def sleep(delay: float):
+            nonlocal slept
+            slept += 1
+            await real_sleep(0)
+
+        try:
+            with mock.patch("utils.voice_presence.asyncio.sleep", sleep):
+                wheel = TimerWheel(loop, tick=1.0, slot_count=slot_count)
+                # not starting at slot 0
+                wheel.current_slot = 17
+                wheel.schedule("channel", ticks, lambda: fired.set_result(slept))
+                return loop.run_until_complete(asyncio.wait_for(fired, 5))
+        finally:
+            loop.close()
+
+    def test_delays(self):
+        for ticks in (1, 255, 256, 257, 512, 600):
+            with self.subTest(ticks=ticks):
+                self.assertEqual(self.fired_after(ticks), ticks)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+"""Tunables of the bot
+
+Every value here can be overridden with an environment variable of the
+same name prefixed with NAZBOT_, the same way the api key is given."""
+import os
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.getenv(f"NAZBOT_{name}")
+    return int(value) if value else default
+
+
+def env_str(name: str, default: str) -> str:
+    return os.getenv(f"NAZBOT_{name}") or default
+
+
+# Nightcore render cache
+NIGHTCORE_CACHE_DIR = env_str("NIGHTCORE_CACHE_DIR", "./cache/nightcore")
+NIGHTCORE_CACHE_MAX_BYTES = env_int(
+    "NIGHTCORE_CACHE_MAX_BYTES", 4 * 1024 * 1024 * 1024)
+# how many upcoming songs get rendered in the background
+NIGHTCORE_PRERENDER_AHEAD = env_int("NIGHTCORE_PRERENDER_AHEAD", 2)
+
+# Send Opus packets made by ffmpeg straight to discord instead of PCM
+# that discord.py has to encode on the player thread
+OPUS_PASSTHROUGH = env_int("OPUS_PASSTHROUGH", 0)
+
+# Radio jitter buffer, in 20ms frames
+RADIO_BUFFER_FRAMES = env_int("RADIO_BUFFER_FRAMES", 250)
+RADIO_PREBUFFER_FRAMES = env_int("RADIO_PREBUFFER_FRAMES", 15)
+
+# Radio stream ingestion
+RADIO_CONNECTION_LIMIT = env_int("RADIO_CONNECTION_LIMIT", 100)
+RADIO_RECONNECT_ATTEMPTS = env_int("RADIO_RECONNECT_ATTEMPTS", 8)
+# seconds
+RADIO_RECONNECT_MAX_DELAY = env_int("RADIO_RECONNECT_MAX_DELAY", 30)
+
+# How many playlist songs get downloaded at the same time, per guild and for the whole bot
+NIGHTCORE_DOWNLOAD_CONCURRENCY = env_int("NIGHTCORE_DOWNLOAD_CONCURRENCY", 4)
+NIGHTCORE_DOWNLOAD_THREADS = env_int("NIGHTCORE_DOWNLOAD_THREADS", 16)
+
+# Downloaded media
+MEDIA_DIR = env_str("MEDIA_DIR", "./media")
+MEDIA_MAX_BYTES = env_int("MEDIA_MAX_BYTES", 10 * 1024 * 1024 * 1024)
+
+# youtube_dl extraction cache, time to live in seconds
+EXTRACTION_CACHE_PATH = env_str("EXTRACTION_CACHE_PATH", "./cache/extractions.sqlite3")
+EXTRACTION_VIDEO_TTL = env_int("EXTRACTION_VIDEO_TTL", 7 * 24 * 60 * 60)
+EXTRACTION_PLAYLIST_TTL = env_int("EXTRACTION_PLAYLIST_TTL", 60 * 60)
+
+# youtube_dl worker processes, timeouts in seconds
+EXTRACTION_WORKERS = env_int("EXTRACTION_WORKERS", 2)
+# extra workers that only look links up, so a user never wait behind a download
+EXTRACTION_LOOKUP_WORKERS = env_int("EXTRACTION_LOOKUP_WORKERS", 1)
+EXTRACTION_TIMEOUT = env_int("EXTRACTION_TIMEOUT", 60)
+DOWNLOAD_TIMEOUT = env_int("DOWNLOAD_TIMEOUT", 600)
+
+# Song transitions, the next song is started NIGHTCORE_PRESTART_SECONDS
+# before the current one ends with its first frames already decoded
+NIGHTCORE_PRESTART_SECONDS = env_int("NIGHTCORE_PRESTART_SECONDS", 5)
+NIGHTCORE_PREBUFFER_FRAMES = env_int("NIGHTCORE_PREBUFFER_FRAMES", 25)
+# seconds the player thread wait for a prestart still running, then it start the song itself
+NIGHTCORE_PRESTART_TIMEOUT = env_int("NIGHTCORE_PRESTART_TIMEOUT", 2)
+# 0 to go straight from one song into the next
+NIGHTCORE_CROSSFADE_MS = env_int("NIGHTCORE_CROSSFADE_MS", 0)
+
+# Prometheus text endpoint on localhost, 0 to turn it off
+METRICS_PORT = env_int("METRICS_PORT", 0)
+
+# seconds a voice channel can stay without listeners before the bot leave it
+VOICE_IDLE_TIMEOUT = env_int("VOICE_IDLE_TIMEOUT", 60)
+
+# Load a cog the first time one of its commands is used instead of at startup
+LAZY_COGS = env_int("LAZY_COGS", 1)
+
+# What every guild is playing, replayed at startup to resume the players
+PLAYER_JOURNAL_PATH = env_str("PLAYER_JOURNAL_PATH", "./cache/players.sqlite3")
+PLAYER_RESUME = env_int("PLAYER_RESUME", 1)
+# seconds between two saved positions of a playing song
+PLAYER_POSITION_INTERVAL = env_int("PLAYER_POSITION_INTERVAL", 5)
+
+# Radio station health checks, every RADIO_PROBE_INTERVAL seconds
+RADIO_PROBE_INTERVAL = env_int("RADIO_PROBE_INTERVAL", 300)
+RADIO_PROBE_CONCURRENCY = env_int("RADIO_PROBE_CONCURRENCY", 16)
+RADIO_PROBE_TIMEOUT = env_int("RADIO_PROBE_TIMEOUT", 10)
+# connections kept open to the most played stations, 0 to turn it off
+RADIO_WARM_STATIONS = env_int("RADIO_WARM_STATIONS", 2)
+RADIO_WARM_BACKLOG_BYTES = env_int("RADIO_WARM_BACKLOG_BYTES", 64 * 1024)
+
+# subprocess to decode with ffmpeg processes, pyav to decode in the bot
+# process (needs the av package, falls back to ffmpeg when it can't)
+DECODER_BACKEND = env_str("DECODER_BACKEND", "subprocess")
+
+# Nightcore effect of a guild until it picks its own, rubberband stretch
+# pitch and tempo in ffmpeg, resample speed the song up in the bot process
+NIGHTCORE_ENGINE = env_str("NIGHTCORE_ENGINE", "rubberband")
+NIGHTCORE_SPEED_PERCENT = env_int("NIGHTCORE_SPEED_PERCENT", 130)
+# shelving gains in dB
+NIGHTCORE_BASS_GAIN = env_int("NIGHTCORE_BASS_GAIN", 2)
+NIGHTCORE_TREBLE_GAIN = env_int("NIGHTCORE_TREBLE_GAIN", -1)
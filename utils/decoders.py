@@ -0,0 +1,300 @@
+import threading
+import subprocess
+from functools import partial
+from typing import *
+from utils.ogg import OggOpusStream, FFMPEG_OPUS_OUTPUT
+from utils.processes import NO_WINDOW
+from utils.render_cache import RenderCache, FRAME_SIZE
+
+try:
+    import av
+    # FFmpegError since PyAV 9, AVError before
+    AV_ERROR = getattr(av, "AVError", None) or av.error.FFmpegError
+except ImportError:
+    # only the ffmpeg subprocess backend is there without it
+    av = None
+    AV_ERROR = OSError
+
+BACKENDS = ("subprocess", "pyav")
+PCM_OUTPUT = RenderCache.output_formats["pcm"]
+
+
+class DecoderUnavailable(Exception):
+    """The backend can't do what is asked, the caller fall back to the subprocess one"""
+
+
+def pyav_available() -> bool:
+    return av is not None
+
+
+class ByteQueue:
+    """Bounded pipe between the thread pushing a stream and the decoder reading it
+
+    write() block while max_bytes are waiting, the same back pressure a
+    full stdin pipe gives, and read() block until there is something."""
+
+    def __init__(self, max_bytes: int = 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.chunks = bytearray()
+        self.closed = False
+        self.changed = threading.Condition()
+
+    def write(self, data: bytes):
+        with self.changed:
+            while len(self.chunks) >= self.max_bytes and not self.closed:
+                self.changed.wait()
+            if self.closed:
+                raise ValueError("write to closed queue")
+            self.chunks += data
+            self.changed.notify_all()
+
+    def read(self, size: int = -1) -> bytes:
+        with self.changed:
+            while not self.chunks and not self.closed:
+                self.changed.wait()
+            size = len(self.chunks) if size < 0 else min(size, len(self.chunks))
+            data = bytes(self.chunks[:size])
+            del self.chunks[:size]
+            self.changed.notify_all()
+            return data
+
+    def close(self):
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+
+
+class FrameBuffer:
+    """Collect decoded PCM of any length and hand it out in FRAME_SIZE frames
+
+    The same bytearray is reused for the whole stream, only the frames
+    handed out are copied."""
+
+    def __init__(self):
+        self.pending = bytearray()
+
+    def push(self, data) -> Iterator[bytes]:
+        self.pending += data
+        full_size = len(self.pending) - len(self.pending) % FRAME_SIZE
+        if not full_size:
+            return
+        view = memoryview(self.pending)
+        try:
+            for start in range(0, full_size, FRAME_SIZE):
+                yield bytes(view[start:start + FRAME_SIZE])
+        finally:
+            view.release()
+        del self.pending[:full_size]
+
+    def flush(self) -> Iterator[bytes]:
+        """The last partial frame, as it is"""
+        if self.pending:
+            yield bytes(self.pending)
+            self.pending.clear()
+
+
+class SubprocessDecoder:
+    """ffmpeg in its own process, the input written to its stdin or read by ffmpeg itself
+
+    frames() yield FRAME_SIZE PCM frames (the last one can be shorter), or
+    Opus packets when opus is set."""
+
+    def __init__(self, input_arguments: List[str], output_arguments: List[str], filter_chain: str = None,
+                 stdin: bool = False, opus: bool = False):
+        self.opus = opus
+        filter_arguments = ["-filter_complex", filter_chain] if filter_chain else []
+        self.process = subprocess.Popen(
+            ["ffmpeg"] + input_arguments + filter_arguments + output_arguments + ["pipe:1"],
+            stdin=subprocess.PIPE if stdin else subprocess.DEVNULL, stdout=subprocess.PIPE, **NO_WINDOW)
+
+    def write(self, data: bytes):
+        self.process.stdin.write(data)
+
+    def close_input(self):
+        self.process.stdin.close()
+
+    def frames(self, tee: Callable[[memoryview], None] = None) -> Iterator[bytes]:
+        """tee get the raw Ogg pages in opus mode, for the render cache"""
+        stdout = self.process.stdout
+        try:
+            if self.opus:
+                yield from OggOpusStream(stdout, tee=tee)
+            else:
+                yield from iter(partial(stdout.read, FRAME_SIZE), b'')
+        except ValueError:
+            # read of closed file
+            pass
+
+    def finished_cleanly(self) -> bool:
+        return self.process.wait() == 0
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+
+
+class PyAVDecoder:
+    """libav decoding in this process through PyAV, s16le 48kHz stereo output only
+
+    The input is a url or file opened by libav, or a ByteQueue fed with
+    write(). Decoded audio go through the filter chain as a libav filter
+    graph and the resampler, straight into a FrameBuffer, so there is no
+    process, no pipe and no read syscall per frame. Opus output and
+    filters missing from the libav PyAV was built with raise
+    DecoderUnavailable right away."""
+
+    process = None
+
+    def __init__(self, source: Optional[str], filter_chain: str = None, start_seconds: float = 0.0,
+                 options: Dict[str, str] = None, input_format: str = None):
+        if av is None:
+            raise DecoderUnavailable("PyAV is not installed")
+        self.source = source
+        self.filter_chain = filter_chain
+        self.start_seconds = start_seconds
+        self.options = options or {}
+        self.input_format = input_format
+        self.input_queue = ByteQueue() if source is None else None
+        self.stopped = False
+        self.failed = False
+
+        if filter_chain:
+            # find out now rather than halfway into the song
+            for name, _ in self.parse_filter_chain(filter_chain):
+                try:
+                    av.filter.Filter(name)
+                except (ValueError, KeyError) as e:
+                    raise DecoderUnavailable(f"libav has no {name} filter") from e
+
+    @staticmethod
+    def parse_filter_chain(filter_chain: str) -> List[Tuple[str, Optional[str]]]:
+        """(name, arguments) of a linear ffmpeg filter chain like a=x=1,b"""
+        parsed = []
+        for description in filter_chain.split(","):
+            name, _, arguments = description.partition("=")
+            parsed.append((name.strip(), arguments or None))
+        return parsed
+
+    def write(self, data: bytes):
+        self.input_queue.write(data)
+
+    def close_input(self):
+        self.input_queue.close()
+
+    def build_graph(self, stream):
+        graph = av.filter.Graph()
+        previous = source = graph.add_abuffer(template=stream)
+        for name, arguments in self.parse_filter_chain(self.filter_chain):
+            node = graph.add(name, arguments)
+            previous.link_to(node)
+            previous = node
+        sink = graph.add("abuffersink")
+        previous.link_to(sink)
+        graph.configure()
+        return source, sink
+
+    @staticmethod
+    def pull_all(sink) -> Iterator["av.AudioFrame"]:
+        while True:
+            try:
+                yield sink.pull()
+            except (BlockingIOError, EOFError):
+                return
+
+    @staticmethod
+    def resample(resampler: "av.AudioResampler", frame: Optional["av.AudioFrame"]) -> List["av.AudioFrame"]:
+        # PyAV before 9 give back one frame, later versions a list
+        resampled = resampler.resample(frame)
+        if resampled is None:
+            return []
+        return resampled if isinstance(resampled, list) else [resampled]
+
+    def frames(self, tee: Callable[[memoryview], None] = None) -> Iterator[bytes]:
+        container = None
+        try:
+            container = av.open(self.input_queue if self.source is None else self.source,
+                                format=self.input_format, options=self.options)
+            stream = container.streams.audio[0]
+            if self.start_seconds:
+                container.seek(int(self.start_seconds / stream.time_base), stream=stream)
+            graph = self.build_graph(stream) if self.filter_chain else None
+            resampler = av.AudioResampler(format="s16", layout="stereo", rate=48000)
+            frame_buffer = FrameBuffer()
+
+            def to_pcm(decoded_frames: Iterable["av.AudioFrame"]) -> Iterator[bytes]:
+                for decoded_frame in decoded_frames:
+                    for resampled in self.resample(resampler, decoded_frame):
+                        # packed s16, the plane can be padded past the samples
+                        yield from frame_buffer.push(memoryview(resampled.planes[0])[:resampled.samples * 4])
+
+            for decoded_frame in container.decode(stream):
+                if self.stopped:
+                    return
+                if graph is None:
+                    yield from to_pcm((decoded_frame,))
+                    continue
+                graph[0].push(decoded_frame)
+                yield from to_pcm(self.pull_all(graph[1]))
+
+            if graph is not None:
+                graph[0].push(None)
+                yield from to_pcm(self.pull_all(graph[1]))
+            for resampled in self.resample(resampler, None):
+                yield from frame_buffer.push(memoryview(resampled.planes[0])[:resampled.samples * 4])
+            yield from frame_buffer.flush()
+        except (AV_ERROR, OSError, ValueError) as e:
+            if not self.stopped:
+                self.failed = True
+                print(f"PyAV decoding of {self.source or 'a stream'} failed: {e!r}")
+        finally:
+            if container is not None:
+                container.close()
+
+    def finished_cleanly(self) -> bool:
+        return not self.failed and not self.stopped
+
+    def stop(self):
+        self.stopped = True
+        if self.input_queue is not None:
+            self.input_queue.close()
+
+
+def open_stream_decoder(backend: str, url: str = None, opus_volume: Optional[float] = None, reconnect_delay_max: int = 30):
+    """Decoder of a live stream, pushed through write() or read from url by the decoder itself
+
+    With opus_volume the output is Opus with the volume applied, which only
+    the subprocess backend can do."""
+    if backend == "pyav" and opus_volume is None:
+        try:
+            options = {"reconnect": "1", "reconnect_streamed": "1", "reconnect_delay_max": str(reconnect_delay_max)} if url else {}
+            return PyAVDecoder(url, options=options)
+        except DecoderUnavailable as e:
+            print(f"Falling back to ffmpeg: {e}")
+
+    if opus_volume is None:
+        output_arguments = PCM_OUTPUT
+    else:
+        output_arguments = ["-af", f"volume={opus_volume}"] + FFMPEG_OPUS_OUTPUT
+    if url is not None:
+        # ffmpeg does the http itself, let it reconnect by itself too
+        input_arguments = ["-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", str(reconnect_delay_max), "-i", url]
+        return SubprocessDecoder(input_arguments, output_arguments, opus=opus_volume is not None)
+    return SubprocessDecoder(["-i", "pipe:0"], output_arguments, stdin=True, opus=opus_volume is not None)
+
+
+def open_file_decoder(backend: str, source: str, filter_chain: str, output_format: str, start_seconds: float = 0.0, remote: bool = False):
+    """Decoder of a whole file or media url through a filter chain, from start_seconds on"""
+    options = {"reconnect": "1", "reconnect_streamed": "1", "reconnect_delay_max": "5"} if remote else {}
+    if backend == "pyav" and output_format == "pcm":
+        try:
+            return PyAVDecoder(source, filter_chain, start_seconds, options)
+        except DecoderUnavailable as e:
+            print(f"Falling back to ffmpeg: {e}")
+
+    input_arguments = []
+    if start_seconds:
+        input_arguments += ["-ss", f"{start_seconds:.3f}"]
+    for option, value in options.items():
+        input_arguments += [f"-{option}", value]
+    return SubprocessDecoder(input_arguments + ["-i", source], RenderCache.output_formats[output_format], filter_chain,
+                             opus=output_format == "opus")
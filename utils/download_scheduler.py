@@ -0,0 +1,79 @@
+import queue
+import threading
+from concurrent.futures import Executor
+from typing import *
+
+
+class OrderedDownloadScheduler:
+    """Download a list of entries concurrently but publish them in list order
+
+    Entries are handed to the workers lowest index first, so the entry that
+    is going to be played next is always the one being worked on first and
+    the rest are prefetched behind it. A finished entry is only published
+    once everything before it got published (or failed), so the playlist
+    order stay the same no matter which download finish first."""
+
+    def __init__(self, entries: Sequence[Any], download: Callable[[Any], Any],
+                 publish: Callable[[Any], None], concurrency: int):
+        self.entries = entries
+        self.download = download
+        self.publish = publish
+
+        self.work_queue: "queue.SimpleQueue[int]" = queue.SimpleQueue()
+        for index in range(len(entries)):
+            self.work_queue.put(index)
+
+        self.results_lock = threading.Lock()
+        self.results: Dict[int, Any] = {}
+        self.next_to_publish = 0
+
+        self.worker_count = max(1, min(concurrency, len(entries)))
+        self.workers_running = 0
+        self.cancelled = False
+        self.done = threading.Event()
+        if not entries:
+            self.done.set()
+
+    def start(self, pool: Executor):
+        self.workers_running = self.worker_count if self.entries else 0
+        for _ in range(self.workers_running):
+            pool.submit(self.worker)
+
+    def worker(self):
+        try:
+            while not self.cancelled:
+                try:
+                    index = self.work_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+                with self.results_lock:
+                    self.results[index] = None
+
+                try:
+                    result = self.download(self.entries[index])
+                except Exception as e:
+                    print(f"Failed to download playlist entry {index}: {e!r}")
+                    result = None
+                self.finish(index, result)
+        finally:
+            with self.results_lock:
+                self.workers_running -= 1
+                if self.workers_running == 0:
+                    self.done.set()
+
+    def finish(self, index: int, result: Any):
+        with self.results_lock:
+            self.results[index] = (result,)
+            while isinstance(self.results.get(self.next_to_publish), tuple):
+                ready, = self.results.pop(self.next_to_publish)
+                self.next_to_publish += 1
+                # still under results_lock so two workers can't publish out of order
+                if ready is not None and not self.cancelled:
+                    self.publish(ready)
+
+    def is_done(self) -> bool:
+        return self.done.is_set()
+
+    def cancel(self):
+        self.cancelled = True
@@ -0,0 +1,249 @@
+import numpy as np
+from typing import *
+
+# 3840 is the amount of byte that has 20ms amount of audio,
+# which is 960 stereo samples or 1920 int16 values
+FRAME_SIZE = 3840
+VALUES_PER_FRAME = FRAME_SIZE // 2
+
+INT16_MAX = 32767
+INT16_MIN = -32768
+
+
+class GainProcessor:
+    """Volume, mixing and soft limiting for s16le 48kHz stereo PCM
+
+    All the work happen in buffers allocated up front, so processing a frame
+    does not allocate anything except the bytes handed back to discord.
+    A volume change is ramped over one frame to avoid clicks."""
+
+    def __init__(self, volume: float = 1.0, limiter_threshold: float = 0.9, max_frames: int = 4):
+        self.target_volume = volume
+        self.current_volume = volume
+        self.limiter_threshold = limiter_threshold * INT16_MAX
+        self.limiter_headroom = INT16_MAX - self.limiter_threshold
+
+        # both values of a stereo sample get the same step of the ramp
+        self.ramp = np.repeat(np.arange(1, VALUES_PER_FRAME // 2 + 1, dtype=np.float32)
+                              / (VALUES_PER_FRAME // 2), 2)
+        self.ramp_gain = np.empty(VALUES_PER_FRAME, dtype=np.float32)
+
+        self.allocate(max_frames * VALUES_PER_FRAME)
+
+    def allocate(self, size: int):
+        self.work = np.empty(size, dtype=np.float32)
+        self.overlay_work = np.empty(size, dtype=np.float32)
+        self.magnitude = np.empty(size, dtype=np.float32)
+        self.over_threshold = np.empty(size, dtype=np.bool_)
+        self.output = np.empty(size, dtype=np.int16)
+
+    @property
+    def volume(self) -> float:
+        return self.target_volume
+
+    @volume.setter
+    def volume(self, value: float):
+        self.target_volume = value
+
+    def process(self, data: bytes, overlay: bytes = None, overlay_volume: float = 1.0) -> bytes:
+        """Apply the volume to one or more frames and limit the result
+
+        overlay is mixed in at overlay_volume before the volume is applied,
+        it may be shorter than data."""
+        samples = np.frombuffer(data, dtype=np.int16)
+        size = samples.size
+        if size > self.work.size:
+            self.allocate(size)
+
+        work = self.work[:size]
+        work[:] = samples
+
+        if overlay:
+            overlay_samples = np.frombuffer(overlay, dtype=np.int16)[:size]
+            overlay_work = self.overlay_work[:overlay_samples.size]
+            overlay_work[:] = overlay_samples
+            overlay_work *= overlay_volume
+            work[:overlay_samples.size] += overlay_work
+
+        self.apply_gain(work)
+        self.limit(work)
+
+        np.clip(work, INT16_MIN, INT16_MAX, out=work)
+        output = self.output[:size]
+        np.copyto(output, work, casting="unsafe")
+        return output.tobytes()
+
+    def apply_gain(self, work: np.ndarray):
+        target_volume = self.target_volume
+        if self.current_volume == target_volume:
+            work *= target_volume
+            return
+
+        ramp_size = min(work.size, VALUES_PER_FRAME)
+        ramp_gain = self.ramp_gain[:ramp_size]
+        np.multiply(self.ramp[:ramp_size],
+                    target_volume - self.current_volume, out=ramp_gain)
+        ramp_gain += self.current_volume
+        work[:ramp_size] *= ramp_gain
+        work[ramp_size:] *= target_volume
+
+        if ramp_size == VALUES_PER_FRAME:
+            self.current_volume = target_volume
+        else:
+            self.current_volume = float(ramp_gain[-1])
+
+    def limit(self, work: np.ndarray):
+        """Soft knee limiter, samples over the threshold are bent with tanh toward full scale"""
+        threshold = self.limiter_threshold
+        if work.max() <= threshold and work.min() >= -threshold:
+            return
+
+        size = work.size
+        magnitude = self.magnitude[:size]
+        over_threshold = self.over_threshold[:size]
+
+        np.abs(work, out=magnitude)
+        np.greater(magnitude, threshold, out=over_threshold)
+
+        magnitude -= threshold
+        magnitude /= self.limiter_headroom
+        np.tanh(magnitude, out=magnitude)
+        magnitude *= self.limiter_headroom
+        magnitude += threshold
+        np.copysign(magnitude, work, out=magnitude)
+
+        np.copyto(work, magnitude, where=over_threshold)
+
+
+
+class Crossfader:
+    """Equal power crossfade from the end of a track into the start of the next
+
+    The fade is spread over a number of frames and advance every sample,
+    not every frame, so it has no steps."""
+
+    def __init__(self):
+        samples_per_frame = VALUES_PER_FRAME // 2
+        self.samples_per_frame = samples_per_frame
+        # both values of a stereo sample are at the same point of the fade
+        self.sample_offsets = np.repeat(np.arange(samples_per_frame, dtype=np.float32), 2)
+        self.progress = np.empty(VALUES_PER_FRAME, dtype=np.float32)
+        self.fade = np.empty(VALUES_PER_FRAME, dtype=np.float32)
+        self.work = np.empty(VALUES_PER_FRAME, dtype=np.float32)
+        self.incoming_work = np.empty(VALUES_PER_FRAME, dtype=np.float32)
+        self.output = np.empty(VALUES_PER_FRAME, dtype=np.int16)
+
+    def mix(self, outgoing: bytes, incoming: bytes, position: int, length: int) -> bytes:
+        """Frame number position of a fade that last length frames, both frames have to be full size"""
+        progress = self.progress
+        np.add(self.sample_offsets, position * self.samples_per_frame, out=progress)
+        progress *= (np.pi / 2) / (length * self.samples_per_frame)
+
+        work = self.work
+        work[:] = np.frombuffer(outgoing, dtype=np.int16)
+        np.cos(progress, out=self.fade)
+        work *= self.fade
+
+        incoming_work = self.incoming_work
+        incoming_work[:] = np.frombuffer(incoming, dtype=np.int16)
+        np.sin(progress, out=self.fade)
+        incoming_work *= self.fade
+        work += incoming_work
+
+        np.clip(work, INT16_MIN, INT16_MAX, out=work)
+        np.copyto(self.output, work, casting="unsafe")
+        return self.output.tobytes()
+
+
+class SpeedupEqualizer:
+    """Nightcore the classic way, the song is played faster like a sped up record, then shelved
+
+    The speed up is a linear interpolation resample, pitch and tempo go up
+    together and nothing get stretched, so a block cost a few vector
+    operations instead of rubberband's phase vocoder. The shelves split
+    the sped up signal with moving averages taken from a running sum: the
+    band under about 90Hz get the bass gain and what is over about 3kHz
+    the treble gain, both linear phase so the bands add back up cleanly.
+
+    Blocks of s16le 48kHz stereo PCM of any size go in, what comes out is
+    speed times shorter and BASS_TAPS // 2 samples late, flush() hand out
+    what is still held back at the end of the song."""
+
+    # moving average lengths, odd so the bands have a whole sample of delay
+    BASS_TAPS = 241
+    TREBLE_TAPS = 7
+
+    def __init__(self, speed: float, bass_gain: float, treble_gain: float):
+        self.speed = speed
+        # the gains in dB, as what is added on top of the unchanged signal
+        self.bass_boost = 10 ** (bass_gain / 20) - 1
+        self.treble_boost = 10 ** (treble_gain / 20) - 1
+        self.delay = self.BASS_TAPS // 2
+
+        # the last input sample, the first output of a block can fall between it and the block
+        self.previous: Optional[np.ndarray] = None
+        # where the next output sample fall, counted from previous
+        self.phase = 0.0
+        # the last sped up samples, the moving averages reach back over them
+        self.history = np.zeros((self.BASS_TAPS - 1, 2), dtype=np.float64)
+
+    def process(self, data: bytes) -> bytes:
+        samples = np.frombuffer(data, dtype=np.int16, count=len(data) // 4 * 2).reshape(-1, 2)
+        if not samples.size:
+            return b''
+        return self.to_pcm(self.equalize(self.resample(samples)))
+
+    def flush(self) -> bytes:
+        return self.to_pcm(self.equalize(np.zeros((self.delay, 2), dtype=np.float64)))
+
+    def resample(self, samples: np.ndarray) -> np.ndarray:
+        samples = samples.astype(np.float32)
+        if self.previous is not None:
+            samples = np.concatenate((self.previous, samples))
+        self.previous = samples[-1:]
+        # an output sample need the input samples on both of its sides
+        last = len(samples) - 1
+        count = max(0, int(np.ceil((last - self.phase) / self.speed)))
+        positions = np.arange(count, dtype=np.float64)
+        positions *= self.speed
+        positions += self.phase
+        self.phase += count * self.speed - last
+
+        indexes = positions.astype(np.intp)
+        positions -= indexes
+        fractions = positions.astype(np.float32)[:, None]
+        before = np.take(samples, indexes, axis=0)
+        interpolated = np.take(samples, indexes + 1, axis=0)
+        interpolated -= before
+        interpolated *= fractions
+        interpolated += before
+        return interpolated
+
+    def equalize(self, samples: np.ndarray) -> np.ndarray:
+        count = len(samples)
+        extended = np.concatenate((self.history, samples))
+        self.history = extended[-(self.BASS_TAPS - 1):]
+
+        running_sum = np.zeros((len(extended) + 1, 2), dtype=np.float64)
+        np.cumsum(extended, axis=0, out=running_sum[1:])
+
+        # every output sample is the input delay samples earlier, the
+        # moving averages are centered on it
+        delay = self.delay
+        delayed = extended[delay:delay + count]
+        bass = running_sum[self.BASS_TAPS:self.BASS_TAPS + count] - running_sum[:count]
+        bass *= self.bass_boost / self.BASS_TAPS
+        half_treble = self.TREBLE_TAPS // 2
+        below_treble = running_sum[delay + half_treble + 1:delay + half_treble + 1 + count] - running_sum[delay - half_treble:delay - half_treble + count]
+        below_treble /= self.TREBLE_TAPS
+
+        treble = delayed - below_treble
+        treble *= self.treble_boost
+        treble += delayed
+        treble += bass
+        return treble
+
+    @staticmethod
+    def to_pcm(samples: np.ndarray) -> bytes:
+        np.clip(samples, INT16_MIN, INT16_MAX, out=samples)
+        return samples.astype(np.int16).tobytes()
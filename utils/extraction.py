@@ -0,0 +1,253 @@
+import os
+import time
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future
+from typing import *
+from utils import config
+from utils.extraction_cache import flatten_info
+from utils.song_info import SongFileInfo
+
+YDL_CONFIG = {
+    "outtmpl": os.path.join(config.MEDIA_DIR, "%(id)s.%(ext)s"),
+    "format": "250/251",
+    "quiet": True,
+    "noplaylist": True
+}
+
+
+# what youtube_dl doesn't need to download the format it picked, the
+# format list alone is most of the info of a video
+NOT_NEEDED_TO_DOWNLOAD = ("formats", "thumbnails", "automatic_captions", "subtitles", "description", "tags",
+                          "categories", "chapters", "heatmap")
+
+
+class ExtractionError(Exception):
+    """The worker timed out, died, the request got cancelled or the pool is closed"""
+
+
+class ExtractionRequest(NamedTuple):
+    """What a worker process is asked to do, has to stay picklable
+
+    operation is one of:
+        link:     unprocessed info of a link, a single video is also resolved
+        resolve:  the song behind url without downloading it
+        download: the song behind url, downloaded into the media directory
+        persist:  download processed_info, the trimmed result of an earlier resolve"""
+    operation: str
+    url: str = None
+    ie_key: str = None
+    processed_info: Dict = None
+
+
+class ExtractionResult(NamedTuple):
+    """What comes back from a worker process"""
+    # flattened unprocessed info, only for link
+    info: Dict = None
+    song: SongFileInfo = None
+    # kept so the song can be downloaded later without extracting it again,
+    # trimmed by download_info so there is little to unpickle on our side
+    processed_info: Dict = None
+    # the youtube_dl error message, the other fields can still be set
+    error: str = None
+
+
+def song_from_info(ydl, processed_info: Dict) -> SongFileInfo:
+    return SongFileInfo(ydl.prepare_filename(processed_info), processed_info.get("title"), processed_info.get("duration"),
+                        processed_info.get("url"), processed_info.get("id"))
+
+
+def download_info(processed_info: Dict) -> Dict:
+    return {key: value for key, value in processed_info.items() if key not in NOT_NEEDED_TO_DOWNLOAD}
+
+
+def extract_link(request: ExtractionRequest) -> ExtractionResult:
+    import youtube_dl
+    extracted_info = youtube_dl.YoutubeDL(params={"noplaylist": True, "quiet": True}).extract_info(request.url, process=False)
+    flat_info = flatten_info(extracted_info)
+    if flat_info.get("_type", "video") != "video" or "youtube" not in flat_info.get("extractor", ""):
+        return ExtractionResult(flat_info)
+
+    # the formats are already here, saves scraping the page a second time
+    with youtube_dl.YoutubeDL(params=YDL_CONFIG) as ydl:
+        try:
+            processed_info = ydl.process_ie_result(extracted_info, download=False)
+        except (youtube_dl.utils.ExtractorError, youtube_dl.utils.DownloadError) as e:
+            # most likely a livestream
+            return ExtractionResult(flat_info, error=str(e))
+        return ExtractionResult(flat_info, song_from_info(ydl, processed_info), download_info(processed_info))
+
+
+def extract_song(request: ExtractionRequest) -> ExtractionResult:
+    import youtube_dl
+    download = request.operation == "download"
+    with youtube_dl.YoutubeDL(params=YDL_CONFIG) as ydl:
+        processed_info = ydl.extract_info(request.url, ie_key=request.ie_key, download=download)
+        return ExtractionResult(song=song_from_info(ydl, processed_info), processed_info=None if download else download_info(processed_info))
+
+
+def persist_song(request: ExtractionRequest) -> ExtractionResult:
+    import youtube_dl
+    with youtube_dl.YoutubeDL(params=YDL_CONFIG) as ydl:
+        ydl.process_info(request.processed_info)
+        return ExtractionResult(song=song_from_info(ydl, request.processed_info))
+
+
+operations: Dict[str, Callable[[ExtractionRequest], ExtractionResult]] = {
+    "link": extract_link,
+    "resolve": extract_song,
+    "download": extract_song,
+    "persist": persist_song,
+}
+
+
+def worker_main(connection):
+    """Loop of a worker process, one request at a time"""
+    while True:
+        try:
+            request: ExtractionRequest = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        try:
+            result = operations[request.operation](request)
+        except Exception as e:
+            # youtube_dl exceptions don't always survive pickling, the message does
+            result = ExtractionResult(error=str(e) or type(e).__name__)
+        connection.send(result)
+
+
+class ExtractionWorker:
+    """A worker process and the pipe to it"""
+
+    def __init__(self, context: multiprocessing.context.BaseContext):
+        self.context = context
+        # close() can come from another thread while the worker is being restarted
+        self.lock = threading.Lock()
+        self.start()
+
+    def start(self):
+        self.connection, child_connection = self.context.Pipe()
+        self.process = self.context.Process(target=worker_main, args=(child_connection,), daemon=True)
+        self.process.start()
+        child_connection.close()
+
+    def restart(self):
+        """Kill the process no matter what it is doing and start a fresh one"""
+        with self.lock:
+            self.kill()
+            self.start()
+
+    def stop(self):
+        with self.lock:
+            self.kill()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+class ExtractionPool:
+    """youtube_dl running in worker processes
+
+    Extraction is pure Python and hold the GIL for long stretches, which is
+    enough to make the audio threads late. Each worker process is driven by
+    a thread of ours that only waits on its pipe. A request that run past
+    its timeout or get cancelled while running has its worker killed and
+    replaced, youtube_dl can't be interrupted any other way.
+
+    Lookups (link and resolve) are what a user is waiting on, they go
+    before downloads and persists on every worker, and the lookup_workers
+    only ever take lookups so a bot busy downloading still answer."""
+
+    lookups = ("link", "resolve")
+
+    def __init__(self, workers: int, timeout: float, lookup_workers: int = 0):
+        self.timeout = timeout
+        self.pending = threading.Condition()
+        self.pending_lookups: "Deque[Tuple[ExtractionRequest, float, Future]]" = deque()
+        self.pending_jobs: "Deque[Tuple[ExtractionRequest, float, Future]]" = deque()
+        self.cancelled_lock = threading.Lock()
+        self.cancelled: Set[Future] = set()
+        self.closed = False
+
+        # forking would copy the event loop and the voice threads
+        context = multiprocessing.get_context("spawn")
+        self.workers = [ExtractionWorker(context) for _ in range(workers + lookup_workers)]
+        for number, worker in enumerate(self.workers):
+            threading.Thread(target=self.drive, args=(worker, number >= workers), daemon=True).start()
+
+    def submit(self, request: ExtractionRequest, timeout: float = None) -> Future:
+        future = Future()
+        with self.pending:
+            if self.closed:
+                future.set_exception(ExtractionError(f"the pool is closed, {request.operation} of {request.url} not done"))
+                return future
+            lane = self.pending_lookups if request.operation in self.lookups else self.pending_jobs
+            lane.append((request, timeout or self.timeout, future))
+            # a lookup only worker could be the one woken up for a job
+            self.pending.notify_all()
+        return future
+
+    def take(self, lookups_only: bool) -> Optional[Tuple[ExtractionRequest, float, Future]]:
+        """The next request for a worker, None once the pool is closed"""
+        with self.pending:
+            while not self.closed:
+                if self.pending_lookups:
+                    return self.pending_lookups.popleft()
+                if self.pending_jobs and not lookups_only:
+                    return self.pending_jobs.popleft()
+                self.pending.wait()
+        return None
+
+    def cancel(self, future: Future):
+        if not future.cancel() and not future.done():
+            with self.cancelled_lock:
+                self.cancelled.add(future)
+
+    def drive(self, worker: ExtractionWorker, lookups_only: bool):
+        while True:
+            item = self.take(lookups_only)
+            if item is None:
+                break
+            request, timeout, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                worker.connection.send(request)
+                error = self.wait(worker, future, time.monotonic() + timeout)
+                if error is None:
+                    future.set_result(worker.connection.recv())
+                    continue
+            except (EOFError, OSError):
+                error = f"the worker died during {request.operation} of {request.url}"
+            future.set_exception(ExtractionError(error))
+            if self.closed:
+                break
+            worker.restart()
+
+    def wait(self, worker: ExtractionWorker, future: Future, deadline: float) -> Optional[str]:
+        """Wait for the result to be ready, return why if it never will be"""
+        while not worker.connection.poll(0.1):
+            with self.cancelled_lock:
+                if future in self.cancelled:
+                    self.cancelled.discard(future)
+                    return "cancelled"
+            if time.monotonic() > deadline:
+                return "timed out"
+        return None
+
+    def close(self):
+        with self.pending:
+            self.closed = True
+            left = list(self.pending_lookups) + list(self.pending_jobs)
+            self.pending_lookups.clear()
+            self.pending_jobs.clear()
+            self.pending.notify_all()
+        for request, _, future in left:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(ExtractionError(f"the pool got closed before {request.operation} of {request.url}"))
+        for worker in self.workers:
+            worker.stop()
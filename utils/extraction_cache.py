@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+from urllib.parse import urlparse, parse_qs
+from typing import *
+
+# the keys of a youtube_dl result that are needed to queue a link again
+FLAT_INFO_KEYS = ("_type", "id", "extractor", "ie_key", "url", "title", "webpage_url_basename")
+FLAT_ENTRY_KEYS = ("_type", "id", "ie_key", "url", "title")
+
+
+def normalize_url(video_link: str) -> str:
+    """The same key for every way of writing a youtube link"""
+    parsed = urlparse(video_link.strip())
+    host = parsed.netloc.lower()
+    if host.startswith("www.") or host.startswith("m."):
+        host = host.split(".", 1)[1]
+    query = parse_qs(parsed.query)
+
+    if host == "youtu.be" and parsed.path.strip("/"):
+        return "youtube:video:" + parsed.path.strip("/")
+    if host in ("youtube.com", "music.youtube.com"):
+        # noplaylist is set, a watch link inside a playlist is only the video
+        if "v" in query:
+            return "youtube:video:" + query["v"][0]
+        if "list" in query:
+            return "youtube:playlist:" + query["list"][0]
+    return parsed._replace(netloc=host, fragment="").geturl()
+
+
+def flatten_info(extracted_info: Dict) -> Dict:
+    """The part of an unprocessed extract_info result worth keeping, with the playlist entries as a list"""
+    flat_info = {key: extracted_info[key] for key in FLAT_INFO_KEYS if key in extracted_info}
+    if extracted_info.get("entries") is not None:
+        flat_info["entries"] = [{key: entry[key] for key in FLAT_ENTRY_KEYS if key in entry}
+                                for entry in extracted_info["entries"]]
+    return flat_info
+
+
+class ExtractionCache:
+    """youtube_dl extraction results kept in SQLite between runs
+
+    Two kinds of rows are stored: the unprocessed result of a link, keyed
+    by its normalized url, and the title and duration of a video, keyed by
+    its id. Playlists change more often than videos so they get their own
+    time to live. Lookups are cheap but still go to disk, use lookup() from
+    the event loop."""
+
+    schema = """CREATE TABLE IF NOT EXISTS extractions (
+                    key TEXT PRIMARY KEY,
+                    info TEXT NOT NULL,
+                    expires REAL NOT NULL)"""
+
+    def __init__(self, path: str, video_ttl: int, playlist_ttl: int):
+        self.path = path
+        self.video_ttl = video_ttl
+        self.playlist_ttl = playlist_ttl
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        self.lock = threading.Lock()
+        # used from the executor threads, one at a time under the lock
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(self.schema)
+        self.purge()
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT info FROM extractions WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, key: str, info: Dict, ttl: int):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO extractions (key, info, expires) VALUES (?, ?, ?)",
+                (key, json.dumps(info), time.time() + ttl))
+
+    def get_link(self, video_link: str) -> Optional[Dict]:
+        return self.get(normalize_url(video_link))
+
+    def put_link(self, video_link: str, extracted_info: Dict) -> Dict:
+        """Store an unprocessed extract_info result, return the flattened copy that got stored"""
+        flat_info = flatten_info(extracted_info)
+        ttl = self.playlist_ttl if flat_info.get("_type") == "playlist" else self.video_ttl
+        self.put(normalize_url(video_link), flat_info, ttl)
+        return flat_info
+
+    def get_video(self, video_id: str) -> Optional[Dict]:
+        if video_id is None:
+            return None
+        return self.get("video:" + video_id)
+
+    def put_video(self, video_id: str, title: str, duration: int):
+        if video_id is None or title is None or duration is None:
+            return
+        self.put("video:" + video_id, {"id": video_id, "title": title, "duration": duration}, self.video_ttl)
+
+    async def lookup(self, video_link: str, loop: asyncio.AbstractEventLoop = None) -> Optional[Dict]:
+        """get_link() without blocking the event loop"""
+        loop = loop or asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.get_link, video_link)
+
+    def purge(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM extractions WHERE expires <= ?", (time.time(),))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
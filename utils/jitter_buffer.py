@@ -0,0 +1,109 @@
+import threading
+from typing import *
+
+# 3840 is the amount of byte that has 20ms amount of audio
+PCM_SILENCE = bytes(3840)
+# what discord.py itself send as an Opus silence frame
+OPUS_SILENCE = b"\xf8\xff\xfe"
+
+
+class FrameRingBuffer:
+    """Fixed capacity ring buffer of 20ms audio frames
+
+    The writer block while the buffer is full, the reader never block:
+    when there is nothing to play it get silence and an underrun is counted.
+    After an underrun the buffer fill up to prebuffer_frames again before
+    real audio come out, so a late producer does not cause stutter."""
+
+    def __init__(self, capacity: int, prebuffer_frames: int, silence: bytes = PCM_SILENCE):
+        self.capacity = capacity
+        self.prebuffer_frames = min(prebuffer_frames, capacity)
+        self.silence = silence
+
+        self.slots: List[Optional[bytes]] = [None] * capacity
+        self.head = 0  # next slot to read
+        self.count = 0
+
+        self.condition = threading.Condition()
+        self.prebuffering = True
+        self.closed = False
+
+        # counters, only ever go up
+        self.frames_in = 0
+        self.frames_out = 0
+        self.underruns = 0
+        self.overruns = 0
+        self.silent_frames = 0
+
+    def put(self, frame: bytes, timeout: float = None) -> bool:
+        """Append a frame, waiting for space for at most timeout seconds"""
+        with self.condition:
+            if self.count == self.capacity:
+                self.condition.wait_for(
+                    lambda: self.count < self.capacity or self.closed, timeout)
+            if self.closed or self.count == self.capacity:
+                return False
+            self.append(frame)
+            return True
+
+    def put_overwrite(self, frame: bytes):
+        """Append a frame, dropping the oldest one if the buffer is full"""
+        with self.condition:
+            if self.closed:
+                return
+            if self.count == self.capacity:
+                self.slots[self.head] = None
+                self.head = (self.head + 1) % self.capacity
+                self.count -= 1
+                self.overruns += 1
+            self.append(frame)
+
+    def append(self, frame: bytes):
+        self.slots[(self.head + self.count) % self.capacity] = frame
+        self.count += 1
+        self.frames_in += 1
+
+    def get(self) -> bytes:
+        """Next frame, silence if the buffer is starving, b'' once closed and drained"""
+        with self.condition:
+            if self.prebuffering:
+                if self.count >= self.prebuffer_frames or (self.closed and self.count):
+                    self.prebuffering = False
+                elif self.closed:
+                    return b''
+                else:
+                    self.silent_frames += 1
+                    return self.silence
+
+            if self.count == 0:
+                if self.closed:
+                    return b''
+                self.underruns += 1
+                self.silent_frames += 1
+                self.prebuffering = True
+                return self.silence
+
+            frame = self.slots[self.head]
+            self.slots[self.head] = None
+            self.head = (self.head + 1) % self.capacity
+            self.count -= 1
+            self.frames_out += 1
+            self.condition.notify()
+            return frame
+
+    def close(self):
+        """No more frames will come, get() return b'' once the rest got played"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "occupancy": self.count,
+            "capacity": self.capacity,
+            "frames_in": self.frames_in,
+            "frames_out": self.frames_out,
+            "underruns": self.underruns,
+            "overruns": self.overruns,
+            "silent_frames": self.silent_frames
+        }
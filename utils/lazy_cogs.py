@@ -0,0 +1,79 @@
+import os
+import ast
+from typing import *
+from discord.ext import commands
+
+
+def find_commands(path: str) -> List[Tuple[str, List[str]]]:
+    """(name, aliases) of every @commands.command in a cog file, read without importing it"""
+    with open(path, "r", encoding="utf-8") as source_file:
+        tree = ast.parse(source_file.read(), path)
+
+    found = []
+    for node in ast.walk(tree):
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        for decorator in node.decorator_list:
+            call = decorator if isinstance(decorator, ast.Call) else None
+            target = call.func if call is not None else decorator
+            if not (isinstance(target, ast.Attribute) and target.attr == "command"):
+                continue
+
+            name, aliases = node.name, []
+            for keyword in call.keywords if call is not None else []:
+                if keyword.arg == "name":
+                    name = ast.literal_eval(keyword.value)
+                elif keyword.arg == "aliases":
+                    aliases = list(ast.literal_eval(keyword.value))
+            found.append((name, aliases))
+    return found
+
+
+class LazyCogLoader:
+    """Register placeholder commands and only load a cog when one of them is used
+
+    The placeholders are found by reading the cog files, so neither the cog
+    nor what it imports (numpy, the caches, the extraction workers) costs
+    anything at startup. The first use of a command loads the real cog in
+    place of the placeholders and runs the command again."""
+
+    def __init__(self, bot: commands.Bot, directory: str = "./cogs", package: str = "cogs"):
+        self.bot = bot
+        self.directory = directory
+        self.package = package
+        # extension name -> the placeholder commands standing in for it
+        self.placeholders: Dict[str, List[commands.Command]] = {}
+
+    def extension_names(self) -> List[str]:
+        return [f"{self.package}.{filename[:-3]}" for filename in sorted(os.listdir(self.directory))
+                if filename.endswith(".py") and not filename.startswith("_")]
+
+    def register_all(self):
+        for extension_name in self.extension_names():
+            path = os.path.join(self.directory, extension_name.split(".")[-1] + ".py")
+            placeholders = []
+            for name, aliases in find_commands(path):
+                placeholder = commands.Command(self.make_placeholder(extension_name), name=name, aliases=aliases,
+                                               help=f"Loads the {extension_name.split('.')[-1]} commands on first use")
+                self.bot.add_command(placeholder)
+                placeholders.append(placeholder)
+            self.placeholders[extension_name] = placeholders
+
+    def make_placeholder(self, extension_name: str):
+        async def load_and_invoke(ctx: commands.Context):
+            self.load(extension_name)
+            # parsed again, this time against the real command
+            real_ctx = await self.bot.get_context(ctx.message)
+            await self.bot.invoke(real_ctx)
+        return load_and_invoke
+
+    def load(self, extension_name: str):
+        if extension_name in self.bot.extensions:
+            return
+        for placeholder in self.placeholders.pop(extension_name, []):
+            self.bot.remove_command(placeholder.name)
+        self.bot.load_extension(extension_name)
+
+    def load_all(self):
+        for extension_name in self.extension_names():
+            self.load(extension_name)
@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import *
+
+
+@dataclass
+class MediaEntry:
+    """Class for a downloaded media file"""
+    video_id: str
+    path: str
+    size: int
+    title: str = None
+    duration: int = None
+    last_played: float = 0.0
+
+
+class MediaStore:
+    """Index of the downloaded media, one file per video id
+
+    The index map a video id to its file, size, duration and when it was
+    last played, so a song that is already on disk never touch the network
+    again. The directory is kept under max_bytes by removing the least
+    recently played files, except the ones pinned because they are queued
+    or playing. At startup the index is rebuilt from the directory listing
+    and the saved index, no file is ever opened to do so.
+
+    Changes only mark the index dirty, it is written every save_interval
+    seconds by a thread of its own and on close. touch is called from the
+    audio thread at every song start, it must not wait on the disk."""
+
+    ignored_extensions = (".part", ".ytdl", ".json", ".tmp")
+
+    def __init__(self, media_dir: str, max_bytes: int, save_interval: float = 5):
+        self.media_dir = media_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(media_dir, "index.json")
+        os.makedirs(media_dir, exist_ok=True)
+
+        self.lock = threading.RLock()
+        # least recently played first
+        self.entries: "OrderedDict[str, MediaEntry]" = OrderedDict()
+        self.total_bytes = 0
+        self.pins: Dict[str, int] = {}
+        self.dirty = False
+        # one write at a time, they all go through the same temporary file
+        self.save_lock = threading.Lock()
+
+        self.load()
+        self.save_interval = save_interval
+        self.closed = threading.Event()
+        self.saver = threading.Thread(target=self.save_periodically, daemon=True)
+        self.saver.start()
+
+    def load(self):
+        try:
+            with open(self.index_path, "r") as json_file:
+                saved_index: Dict[str, Dict] = json.load(json_file)
+        except (OSError, ValueError):
+            saved_index = {}
+
+        found: Dict[str, MediaEntry] = {}
+        duplicates: List[str] = []
+        for filename in os.listdir(self.media_dir):
+            if filename.endswith(self.ignored_extensions):
+                continue
+            path = os.path.join(self.media_dir, filename)
+            stat = os.stat(path)
+            video_id = os.path.splitext(filename)[0]
+            saved = saved_index.get(video_id, {})
+
+            entry = MediaEntry(video_id, path, stat.st_size, saved.get("title"), saved.get("duration"),
+                               saved.get("last_played", stat.st_mtime))
+            previous = found.get(video_id)
+            if previous is not None:
+                # the same video in another format, keep only the newest one
+                older, entry = sorted((previous, entry), key=lambda e: os.path.getmtime(e.path))
+                duplicates.append(older.path)
+            found[video_id] = entry
+
+        for path in duplicates:
+            os.remove(path)
+
+        with self.lock:
+            self.entries = OrderedDict(
+                (entry.video_id, entry) for entry in sorted(found.values(), key=lambda e: e.last_played))
+            self.total_bytes = sum(entry.size for entry in self.entries.values())
+        self.evict()
+        # the rebuilt index, before any player start
+        self.changed()
+        self.save()
+
+    def changed(self):
+        with self.lock:
+            self.dirty = True
+
+    def save(self):
+        """Write the index if it changed since the last time"""
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                self.dirty = False
+                index = {video_id: asdict(entry) for video_id, entry in self.entries.items()}
+            temporary_path = self.index_path + ".tmp"
+            try:
+                with open(temporary_path, "w") as json_file:
+                    json.dump(index, json_file)
+                os.replace(temporary_path, self.index_path)
+            except OSError as e:
+                print(f"Failed to save the media index: {e!r}")
+                self.changed()
+
+    def save_periodically(self):
+        while not self.closed.wait(self.save_interval):
+            self.save()
+
+    def close(self):
+        self.closed.set()
+        self.saver.join()
+        self.save()
+
+    def get(self, video_id: str) -> Optional[MediaEntry]:
+        """The entry of a video that is on disk, None if it has to be downloaded"""
+        if video_id is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(video_id)
+            if entry is None:
+                return None
+            if not os.path.exists(entry.path):
+                self.total_bytes -= self.entries.pop(video_id).size
+                return None
+            return entry
+
+    def add(self, video_id: str, path: str, title: str = None, duration: int = None):
+        """Record a finished download"""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self.lock:
+            previous = self.entries.pop(video_id, None)
+            if previous is not None:
+                self.total_bytes -= previous.size
+            self.entries[video_id] = MediaEntry(video_id, path, size, title, duration, time.time())
+            self.total_bytes += size
+        self.evict()
+        self.changed()
+
+    def touch(self, video_id: str):
+        """Mark a video as just played"""
+        with self.lock:
+            entry = self.entries.get(video_id)
+            if entry is None:
+                return
+            entry.last_played = time.time()
+            self.entries.move_to_end(video_id)
+        self.changed()
+
+    def pin(self, video_id: str):
+        if video_id is None:
+            return
+        with self.lock:
+            self.pins[video_id] = self.pins.get(video_id, 0) + 1
+
+    def unpin(self, video_id: str):
+        if video_id is None:
+            return
+        with self.lock:
+            remaining = self.pins.get(video_id, 0) - 1
+            if remaining > 0:
+                self.pins[video_id] = remaining
+            else:
+                self.pins.pop(video_id, None)
+
+    def evict(self):
+        """Remove the least recently played files until the store fit in max_bytes"""
+        victims = []
+        with self.lock:
+            for video_id in list(self.entries):
+                if self.total_bytes <= self.max_bytes:
+                    break
+                if video_id in self.pins:
+                    continue
+                entry = self.entries.pop(video_id)
+                self.total_bytes -= entry.size
+                victims.append(entry.path)
+
+        for path in victims:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        if victims:
+            self.changed()
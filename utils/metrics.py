@@ -0,0 +1,256 @@
+import time
+import asyncio
+import functools
+import threading
+from bisect import bisect_left
+from typing import *
+
+try:
+    import psutil
+except ImportError:
+    # the process stats are left out without it
+    psutil = None
+
+# a frame has to be ready within its 20ms or discord.py send it late
+FRAME_BUDGET = 0.02
+
+
+class Histogram:
+    """Counts of values falling under each bucket bound, the last bucket is unbounded"""
+
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q quantile"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds + [self.max], self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(bound, self.max)
+        return 0.0
+
+
+# seconds, from 50us up to two whole frames
+LATENCY_BOUNDS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.02, 0.04)
+LAG_BOUNDS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class SourceMetrics:
+    """Frame timing of one audio source
+
+    Only touched by the player thread of the source, the counters are read
+    without a lock so a stats dump can be a frame behind."""
+
+    def __init__(self, kind: str, guild_id: int, probe: Callable[[], Dict[str, float]] = None,
+                 processes: Callable[[], Iterable["subprocess.Popen"]] = None):
+        self.kind = kind
+        self.guild_id = guild_id
+        # extra gauges like buffer occupancy, asked for when the stats are read
+        self.probe = probe
+        # the ffmpeg processes working for the source
+        self.processes = processes
+
+        self.read_latency = Histogram(LATENCY_BOUNDS)
+        self.frames = 0
+        self.late_frames = 0
+        self.silent_frames = 0
+        self.bytes_out = 0
+
+    def record(self, elapsed: float, frame: bytes, silent: bool):
+        self.read_latency.observe(elapsed)
+        self.frames += 1
+        self.bytes_out += len(frame)
+        if elapsed > FRAME_BUDGET:
+            self.late_frames += 1
+        if silent:
+            self.silent_frames += 1
+
+    def gauges(self) -> Dict[str, float]:
+        if self.probe is None:
+            return {}
+        try:
+            return self.probe()
+        except AttributeError:
+            # the source got cleaned up meanwhile
+            return {}
+
+
+class MetricsRegistry:
+    """Every live source, the event loop lag and the ffmpeg process stats"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sources: Dict[int, SourceMetrics] = {}
+        self.loop_lag = Histogram(LAG_BOUNDS)
+        self.last_loop_lag = 0.0
+        # kept between dumps, psutil measure the cpu since the previous call,
+        # only used under lock since the text and prometheus dumps run on different threads
+        self.process_handles: Dict[int, "psutil.Process"] = {}
+
+    def register(self, source_metrics: SourceMetrics) -> SourceMetrics:
+        with self.lock:
+            self.sources[id(source_metrics)] = source_metrics
+        return source_metrics
+
+    def unregister(self, source_metrics: SourceMetrics):
+        with self.lock:
+            self.sources.pop(id(source_metrics), None)
+
+    def process_stats(self, source_metrics: SourceMetrics) -> List[Tuple[int, float, int]]:
+        """(pid, cpu percent, rss bytes) of the live ffmpeg processes of a source"""
+        if psutil is None or source_metrics.processes is None:
+            return []
+        try:
+            pids = [process.pid for process in source_metrics.processes() if process is not None and process.poll() is None]
+        except AttributeError:
+            return []
+
+        stats = []
+        with self.lock:
+            for pid in pids:
+                handle = self.process_handles.get(pid)
+                try:
+                    if handle is None:
+                        handle = self.process_handles[pid] = psutil.Process(pid)
+                    with handle.oneshot():
+                        stats.append((pid, handle.cpu_percent(), handle.memory_info().rss))
+                except psutil.Error:
+                    self.process_handles.pop(pid, None)
+        return stats
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            sources = list(self.sources.values())
+
+        snapshot = []
+        live_pids = set()
+        for source_metrics in sources:
+            process_stats = self.process_stats(source_metrics)
+            live_pids.update(pid for pid, _, _ in process_stats)
+            snapshot.append({
+                "kind": source_metrics.kind,
+                "guild": source_metrics.guild_id,
+                "metrics": source_metrics,
+                "gauges": source_metrics.gauges(),
+                "processes": process_stats,
+            })
+        with self.lock:
+            for pid in list(self.process_handles):
+                if pid not in live_pids:
+                    del self.process_handles[pid]
+        return snapshot
+
+    def render_text(self) -> str:
+        """Short human readable dump, for the stats command"""
+        lines = [f"event loop lag: last {self.last_loop_lag * 1000:.1f}ms, "
+                 f"p99 {self.loop_lag.quantile(0.99) * 1000:.0f}ms, max {self.loop_lag.max * 1000:.1f}ms"]
+        if psutil is not None:
+            bot_process = psutil.Process()
+            lines.append(f"bot: {bot_process.memory_info().rss / 2 ** 20:.0f}MiB rss, {bot_process.num_threads()} threads")
+
+        for source in self.snapshot():
+            source_metrics: SourceMetrics = source["metrics"]
+            latency = source_metrics.read_latency
+            lines.append(
+                f"{source['kind']} @ {source['guild']}: {source_metrics.frames} frames, "
+                f"{source_metrics.late_frames} late, {source_metrics.silent_frames} silent, "
+                f"read p50 {latency.quantile(0.5) * 1e6:.0f}us p99 {latency.quantile(0.99) * 1e6:.0f}us max {latency.max * 1e6:.0f}us")
+            if source["gauges"]:
+                lines.append("    " + ", ".join(f"{name} {value}" for name, value in source["gauges"].items()))
+            for pid, cpu_percent, rss in source["processes"]:
+                lines.append(f"    ffmpeg {pid}: {cpu_percent:.0f}% cpu, {rss / 2 ** 20:.0f}MiB rss")
+        return "\n".join(lines)
+
+    def render_prometheus(self) -> str:
+        """The Prometheus text exposition format"""
+        lines = []
+
+        def histogram(name: str, labels: str, values: Histogram):
+            total_labels = "{" + labels.rstrip(",") + "}" if labels else ""
+            cumulative = 0
+            for bound, count in zip(values.bounds, values.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {values.count}')
+            lines.append(f"{name}_sum{total_labels} {values.total}")
+            lines.append(f"{name}_count{total_labels} {values.count}")
+
+        lines.append("# TYPE nazbot_event_loop_lag_seconds histogram")
+        histogram("nazbot_event_loop_lag_seconds", "", self.loop_lag)
+
+        snapshot = self.snapshot()
+        lines.append("# TYPE nazbot_read_latency_seconds histogram")
+        for source in snapshot:
+            histogram("nazbot_read_latency_seconds", f'kind="{source["kind"]}",guild="{source["guild"]}",',
+                      source["metrics"].read_latency)
+
+        counters = ("frames", "late_frames", "silent_frames", "bytes_out")
+        for counter in counters:
+            lines.append(f"# TYPE nazbot_{counter}_total counter")
+            for source in snapshot:
+                lines.append(f'nazbot_{counter}_total{{kind="{source["kind"]}",guild="{source["guild"]}"}} '
+                             f'{getattr(source["metrics"], counter)}')
+
+        for source in snapshot:
+            for name, value in source["gauges"].items():
+                lines.append(f'nazbot_{name}{{kind="{source["kind"]}",guild="{source["guild"]}"}} {value}')
+            for pid, cpu_percent, rss in source["processes"]:
+                labels = f'kind="{source["kind"]}",guild="{source["guild"]}",pid="{pid}"'
+                lines.append(f"nazbot_ffmpeg_cpu_percent{{{labels}}} {cpu_percent}")
+                lines.append(f"nazbot_ffmpeg_rss_bytes{{{labels}}} {rss}")
+        return "\n".join(lines) + "\n"
+
+    async def monitor_event_loop(self, interval: float = 0.5):
+        """Measure how late the loop wake us up, a blocked loop delay every command and voice packet"""
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.last_loop_lag = max(0.0, loop.time() - expected)
+            self.loop_lag.observe(self.last_loop_lag)
+
+    async def serve_prometheus(self, host: str, port: int):
+        from aiohttp import web
+
+        async def handle(request: web.Request) -> web.Response:
+            text = await asyncio.get_event_loop().run_in_executor(None, self.render_prometheus)
+            return web.Response(text=text, content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+
+
+# shared by every cog
+registry = MetricsRegistry()
+
+
+def instrumented(read: Callable[[Any], bytes]) -> Callable[[Any], bytes]:
+    """Time an AudioSource.read, the source need a metrics attribute and a silence_frame"""
+
+    @functools.wraps(read)
+    def timed_read(self) -> bytes:
+        started = time.perf_counter()
+        frame = read(self)
+        elapsed = time.perf_counter() - started
+        metrics: SourceMetrics = getattr(self, "metrics", None)
+        if metrics is not None:
+            metrics.record(elapsed, frame, frame is self.silence_frame or frame == self.silence_frame)
+        return frame
+
+    return timed_read
@@ -0,0 +1,47 @@
+from dataclasses import dataclass
+from typing import *
+from utils import config
+from utils.dsp import SpeedupEqualizer
+
+ENGINES = ("rubberband", "resample")
+
+
+@dataclass(frozen=True)
+class NightcoreEffect:
+    """Class for how a guild want its nightcore
+
+    rubberband is the ffmpeg chain the bot always used, it stretch pitch
+    and tempo separately. resample just play the song faster, like a
+    record spun too fast, which is what nightcore classically is and cost
+    a fraction of it. For PCM it is done in the bot process by
+    SpeedupEqualizer, Opus output get the same thing from ffmpeg."""
+    engine: str = "rubberband"
+    speed: float = 1.3
+    # shelving gains in dB
+    bass: float = 2.0
+    treble: float = -1.0
+
+    @classmethod
+    def from_config(cls) -> "NightcoreEffect":
+        return cls(config.NIGHTCORE_ENGINE, config.NIGHTCORE_SPEED_PERCENT / 100,
+                   config.NIGHTCORE_BASS_GAIN, config.NIGHTCORE_TREBLE_GAIN)
+
+    def in_process(self, output_format: str) -> bool:
+        return self.engine == "resample" and output_format == "pcm"
+
+    def filter_chain(self, output_format: str) -> str:
+        """The ffmpeg filter chain, or when the effect is done in process the name its renders are cached under"""
+        shelving = f"bass=gain={self.bass:g},treble=gain={self.treble:g}"
+        if self.in_process(output_format):
+            return f"resample={self.speed:g},{shelving}"
+        if self.engine == "resample":
+            # the source is not always 48kHz, asetrate has to know what it start from
+            return f"aresample=48000,asetrate={round(48000 * self.speed)},aresample=48000,{shelving}"
+        return f"rubberband=tempo={self.speed:g}:pitch={self.speed:g},{shelving}"
+
+    def processor(self) -> SpeedupEqualizer:
+        """A new processor for one render, it keeps state from block to block"""
+        return SpeedupEqualizer(self.speed, self.bass, self.treble)
+
+    def describe(self) -> str:
+        return f"{self.engine}, {self.speed * 100:.0f}% speed, bass {self.bass:+g}dB, treble {self.treble:+g}dB"
@@ -0,0 +1,105 @@
+import asyncio
+import discord
+from typing import *
+
+
+class ChannelStatus:
+    """State of the status message of one text channel"""
+
+    def __init__(self, channel: discord.abc.Messageable):
+        self.channel = channel
+        self.message: discord.Message = None
+        self.shown_text: str = None
+        self.pending_text: str = None
+        self.last_request = 0.0
+        self.worker: asyncio.Task = None
+
+
+class NowPlayingNotifier:
+    """Keep a single now playing message per text channel up to date
+
+    Updates are debounced, an update that got superseded before it was sent
+    is dropped, and the message is edited in place instead of deleted and
+    sent again. Each channel has one worker sending at most one request
+    every min_interval seconds, which keep us well inside the per-route
+    rate limits no matter how fast the metadata change.
+
+    notify() is safe to call from any thread, the audio threads included."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, debounce: float = 1.5, min_interval: float = 2.0):
+        self.loop = loop
+        self.debounce = debounce
+        self.min_interval = min_interval
+        self.statuses: Dict[int, ChannelStatus] = {}
+
+    def notify(self, channel: discord.abc.Messageable, text: str):
+        self.loop.call_soon_threadsafe(self.schedule, channel, text)
+
+    def schedule(self, channel: discord.abc.Messageable, text: str):
+        status = self.statuses.get(channel.id)
+        if status is None:
+            status = self.statuses[channel.id] = ChannelStatus(channel)
+        status.pending_text = text
+
+        if status.worker is None or status.worker.done():
+            status.worker = self.loop.create_task(self.run(status))
+
+    async def run(self, status: ChannelStatus):
+        while status.pending_text is not None:
+            # let a burst of updates settle, only the last one get sent
+            await asyncio.sleep(self.debounce)
+            wait = status.last_request + self.min_interval - self.loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            text = status.pending_text
+            status.pending_text = None
+            if text == status.shown_text:
+                continue
+
+            status.last_request = self.loop.time()
+            try:
+                await self.show(status, text)
+            except discord.HTTPException as e:
+                print(f"Failed to update now playing in {status.channel}: {e}")
+
+    async def show(self, status: ChannelStatus, text: str):
+        if status.message is not None:
+            try:
+                await status.message.edit(content=text)
+                status.shown_text = text
+                return
+            except discord.NotFound:
+                # somebody deleted it, a new one get sent below
+                status.message = None
+
+        status.message = await status.channel.send(text)
+        status.shown_text = text
+        try:
+            await status.message.pin()
+        except discord.HTTPException:
+            # no permission to pin or too many pins, an unpinned message do the job too
+            pass
+
+    def forget(self, channel: discord.abc.Messageable):
+        """Start over with a new message on the next update, called by a player that stopped
+
+        Safe to call from any thread. An update still waiting to be shown
+        come from a player started since, that one is kept."""
+        self.loop.call_soon_threadsafe(self.drop, channel.id)
+
+    def drop(self, channel_id: int):
+        status = self.statuses.get(channel_id)
+        if status is None or status.pending_text is not None:
+            return
+        del self.statuses[channel_id]
+        if status.worker is not None:
+            status.worker.cancel()
+
+
+def get_notifier(bot) -> NowPlayingNotifier:
+    """The notifier shared by every cog of the bot"""
+    notifier = getattr(bot, "now_playing_notifier", None)
+    if notifier is None:
+        notifier = bot.now_playing_notifier = NowPlayingNotifier(bot.loop)
+    return notifier
@@ -0,0 +1,215 @@
+import zlib
+import struct
+from io import BufferedIOBase
+from typing import *
+
+# ffmpeg output arguments that give 20ms Opus packets in an Ogg container,
+# the packets can be sent to discord without encoding them again
+FFMPEG_OPUS_OUTPUT = ["-c:a", "libopus", "-b:a", "128k", "-frame_duration", "20",
+                      "-application", "audio", "-ac", "2", "-ar", "48000", "-f", "opus"]
+
+# the Ogg checksum is the non-reflected CRC-32, zlib only does the reflected
+# one, feeding it bit reversed bytes and reversing the result give the same
+BIT_REVERSE = bytes(int(f"{value:08b}"[::-1], 2) for value in range(256))
+
+
+def ogg_crc(page: memoryview) -> int:
+    """Checksum of a whole page, computed as if its checksum field was zero"""
+    crc = zlib.crc32(page[:22].tobytes().translate(BIT_REVERSE), 0xFFFFFFFF)
+    crc = zlib.crc32(b"\x00\x00\x00\x00", crc)
+    crc = zlib.crc32(page[26:].tobytes().translate(BIT_REVERSE), crc)
+    return int.from_bytes((crc ^ 0xFFFFFFFF).to_bytes(4, "little").translate(BIT_REVERSE), "big")
+
+
+class OggPage(NamedTuple):
+    """A page as views into the demuxer's buffer, only valid until the next feed"""
+    header_type: int
+    granule: int
+    serial: int
+    page_no: int
+    lacing_values: memoryview
+    body: memoryview
+    raw: memoryview
+
+    @property
+    def continued(self) -> bool:
+        return bool(self.header_type & 0x01)
+
+
+class OggDemuxer:
+    """Incremental Ogg demuxer
+
+    Bytes are fed into one reusable buffer and pages come out as memoryviews
+    over it, so a page can be forwarded exactly as it was received. Pages
+    with a bad checksum are dropped and the demuxer resynchronise on the
+    next capture pattern instead of giving up on the stream.
+
+    When given a buffer, like an mmap of a file, pages are read straight out
+    of it and nothing is copied."""
+
+    header_struct = struct.Struct("<4sBBqIIIB")
+    max_page_size = 27 + 255 + 255 * 255
+
+    def __init__(self, buffer: Union[bytes, bytearray, "mmap.mmap"] = None):
+        if buffer is None:
+            self.buffer = bytearray(2 * self.max_page_size)
+            self.end = 0
+        else:
+            self.buffer = buffer
+            self.end = len(buffer)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+
+        self.partial_packets: Dict[int, bytearray] = {}
+        self.last_page_numbers: Dict[int, int] = {}
+
+        self.pages_read = 0
+        self.crc_errors = 0
+        self.resyncs = 0
+
+    def make_room(self, size: int):
+        """Move the unread bytes to the front of the buffer, grow it if that is not enough"""
+        unread = self.end - self.start
+        if len(self.buffer) - self.end >= size:
+            return
+        if len(self.buffer) - unread < size:
+            buffer = bytearray(unread + size + self.max_page_size)
+            buffer[:unread] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            self.buffer[:unread] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = unread
+
+    def feed(self, data: bytes):
+        self.make_room(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def fill_from(self, file_handle: BufferedIOBase, size: int = 16384) -> int:
+        """Read straight into the buffer, return 0 at the end of the file"""
+        self.make_room(size)
+        readinto = getattr(file_handle, "readinto1", file_handle.readinto)
+        read_size = readinto(self.view[self.end:self.end + size]) or 0
+        self.end += read_size
+        return read_size
+
+    def resync(self):
+        """Skip to the next capture pattern after the current position"""
+        self.resyncs += 1
+        index = self.buffer.find(b"OggS", self.start + 1, self.end)
+        if index == -1:
+            # the pattern might be cut at the end of what we have so far
+            index = max(self.start + 1, self.end - 3)
+        self.start = index
+
+    def pages(self) -> Iterator[OggPage]:
+        """Every complete page in the buffer"""
+        while True:
+            available = self.end - self.start
+            if available < self.header_struct.size:
+                return
+
+            capture_pattern, version, header_type, granule, serial, page_no, crc, segment_count = self.header_struct.unpack_from(
+                self.buffer, self.start)
+            if capture_pattern != b"OggS" or version != 0:
+                self.resync()
+                continue
+
+            header_size = self.header_struct.size + segment_count
+            if available < header_size:
+                return
+            lacing_values = self.view[self.start + self.header_struct.size:self.start + header_size]
+            page_size = header_size + sum(lacing_values)
+            if available < page_size:
+                return
+
+            raw = self.view[self.start:self.start + page_size]
+            if ogg_crc(raw) != crc:
+                self.crc_errors += 1
+                self.resync()
+                continue
+
+            self.start += page_size
+            self.pages_read += 1
+            yield OggPage(header_type, granule, serial, page_no, lacing_values, raw[header_size:], raw)
+
+    def packets(self, page: OggPage) -> Iterator[Union[memoryview, bytes]]:
+        """The packets completed by this page
+
+        A packet end at the first lacing value below 255, so it can span
+        segments and pages. Packets contained in the page are views into
+        it, packets assembled across pages are bytes."""
+        partial_packet = self.partial_packets.pop(page.serial, None)
+        expected_page_no = self.last_page_numbers.get(page.serial, page.page_no - 1) + 1
+        self.last_page_numbers[page.serial] = page.page_no
+
+        if partial_packet is not None and (not page.continued or page.page_no != expected_page_no):
+            # a page went missing, what we had of the packet is garbage
+            partial_packet = None
+        # without the start of a continued packet its end is dropped too
+        skipping = page.continued and partial_packet is None
+
+        packet_start = 0
+        offset = 0
+        for lacing_value in page.lacing_values:
+            offset += lacing_value
+            if lacing_value == 255:
+                continue
+
+            piece = page.body[packet_start:offset]
+            packet_start = offset
+            if skipping:
+                skipping = False
+            elif partial_packet is not None:
+                partial_packet += piece
+                yield bytes(partial_packet)
+                partial_packet = None
+            else:
+                yield piece
+
+        if packet_start < offset and not skipping:
+            if partial_packet is None:
+                partial_packet = bytearray()
+            partial_packet += page.body[packet_start:offset]
+            self.partial_packets[page.serial] = partial_packet
+
+    def release(self):
+        """Let go of the buffer, needed before closing an mmap it was given"""
+        self.view.release()
+
+
+class OggPacketReader:
+    """Packets of an Ogg stream read from a file handle or a buffer"""
+
+    def __init__(self, file_handle: BufferedIOBase = None, tee: Callable[[memoryview], None] = None, buffer: Union[bytes, "mmap.mmap"] = None) -> None:
+        self.file_handle = file_handle
+        self.demuxer = OggDemuxer(buffer)
+        # called with every page as it is read, used to write the
+        # stream somewhere else while reading the packets out of it
+        self.tee = tee
+
+    def __iter__(self):
+        demuxer = self.demuxer
+        while True:
+            for page in demuxer.pages():
+                if self.tee is not None:
+                    self.tee(page.raw)
+                yield from demuxer.packets(page)
+
+            if self.file_handle is None or not demuxer.fill_from(self.file_handle):
+                break
+
+
+class OggOpusStream(OggPacketReader):
+    """Only the audio packets of an Ogg Opus stream, as bytes
+
+    The OpusHead and OpusTags header packets are skipped, including the
+    ones that start a new chained stream."""
+
+    def __iter__(self):
+        for packet in super().__iter__():
+            if packet[:8] in (b"OpusHead", b"OpusTags"):
+                continue
+            yield bytes(packet)
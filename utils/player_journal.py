@@ -0,0 +1,227 @@
+import os
+import json
+import uuid
+import queue
+import sqlite3
+import threading
+from dataclasses import dataclass, field, asdict
+from typing import *
+from utils import config
+
+
+@dataclass
+class GuildPlayerState:
+    """Class for what a guild is playing, folded from its journal events"""
+    guild_id: int
+    player: str
+    kind: str
+    voice_channel_id: int
+    text_channel_id: int
+    radio_code: str = None
+    volume: float = None
+    # video_id, filename, title and duration of every queued song
+    songs: List[Dict] = field(default_factory=list)
+    index: int = -1
+    # seconds into the song at index
+    offset: float = 0.0
+    repeating: bool = False
+    # the fields of the NightcoreEffect in use
+    effect: Dict = None
+
+    def apply(self, event: str, payload: Dict):
+        # the index follow the song playing the same way Playlist.cursor does
+        if event == "add":
+            self.songs.append(payload)
+        elif event == "insert":
+            song = dict(payload)
+            index = song.pop("index")
+            self.songs.insert(index, song)
+            if index <= self.index:
+                self.index += 1
+        elif event == "remove":
+            self.songs.pop(payload["index"])
+            if payload["index"] <= self.index:
+                self.index -= 1
+        elif event == "move":
+            index, destination = payload["index"], payload["destination"]
+            self.songs.insert(destination, self.songs.pop(index))
+            if index == self.index:
+                self.index = destination
+            elif index < self.index <= destination:
+                self.index -= 1
+            elif destination <= self.index < index:
+                self.index += 1
+        elif event == "order":
+            by_filename = {song["filename"]: song for song in self.songs}
+            self.songs = [by_filename[filename] for filename in payload["filenames"] if filename in by_filename]
+        elif event == "position":
+            self.index = payload["index"]
+            self.offset = payload["offset"]
+        elif event == "repeat":
+            self.repeating = payload["on"]
+        elif event == "volume":
+            self.volume = payload["volume"]
+        elif event == "effect":
+            self.effect = payload
+
+
+class PlayerJournal:
+    """Append only log of what every guild is playing, replayed at startup
+
+    A player write small events (song added, moved, position, volume...)
+    instead of its whole state. record() only fold the event into the state
+    kept in memory and hand it to a writer thread, so it is cheap enough
+    for the player threads. The writer commit whatever piled up in one
+    transaction, and once the log grew past compact_after rows it is
+    replaced by a single snapshot row per guild. Folding and queueing
+    happen under the same lock, so a snapshot always covers exactly the
+    events queued before it, which are dropped instead of written after it.
+
+    Every event carry the token of the player that wrote it, events of a
+    player that got replaced meanwhile are ignored."""
+
+    schema = """CREATE TABLE IF NOT EXISTS journal (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    guild_id INTEGER NOT NULL,
+                    player TEXT NOT NULL,
+                    event TEXT NOT NULL,
+                    payload TEXT NOT NULL)"""
+
+    def __init__(self, path: str, compact_after: int = 5000):
+        self.path = path
+        self.compact_after = compact_after
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.states: Dict[int, GuildPlayerState] = {}
+        self.pending: "queue.SimpleQueue[Optional[Tuple[int, str, str, Dict]]]" = queue.SimpleQueue()
+        self.rows = 0
+        self.closed = False
+
+        # only the writer thread use it once the journal is loaded, every
+        # "with self.connection" block is one transaction
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(self.schema)
+        self.load()
+        # what was playing before this start, for the cogs to resume
+        self.saved: List[GuildPlayerState] = [GuildPlayerState(**asdict(state)) for state in self.states.values()]
+
+        self.writer = threading.Thread(target=self.write_pending, daemon=True)
+        self.writer.start()
+
+    @staticmethod
+    def new_player() -> str:
+        return uuid.uuid4().hex
+
+    def load(self):
+        for guild_id, player, event, payload in self.connection.execute(
+                "SELECT guild_id, player, event, payload FROM journal ORDER BY seq"):
+            self.fold(guild_id, player, event, json.loads(payload))
+        self.compact()
+
+    def fold(self, guild_id: int, player: str, event: str, payload: Dict):
+        if event in ("start", "snapshot"):
+            self.states[guild_id] = GuildPlayerState(**payload)
+            return
+        state = self.states.get(guild_id)
+        if state is None or state.player != player:
+            return
+        if event == "stop":
+            del self.states[guild_id]
+            return
+        try:
+            state.apply(event, payload)
+        except (IndexError, KeyError) as e:
+            print(f"Ignoring journal event {event} of {guild_id}: {e!r}")
+
+    def record(self, guild_id: int, player: str, event: str, **payload):
+        if event == "start":
+            payload = dict(payload, guild_id=guild_id, player=player)
+        with self.lock:
+            if self.closed:
+                return
+            self.fold(guild_id, player, event, payload)
+            self.pending.put((guild_id, player, event, payload))
+
+    def write_pending(self):
+        while True:
+            batch = [self.pending.get()]
+            batch += self.drain_pending()
+
+            rows = [(guild_id, player, event, json.dumps(payload)) for guild_id, player, event, payload in batch if event is not None]
+            try:
+                with self.connection:
+                    self.connection.executemany(
+                        "INSERT INTO journal (guild_id, player, event, payload) VALUES (?, ?, ?, ?)", rows)
+                self.rows += len(rows)
+                if self.rows > self.compact_after:
+                    with self.lock:
+                        # already folded into the states the snapshot is
+                        # taken from, writing them after it would replay them twice
+                        batch += self.drain_pending()
+                        self.compact()
+            except sqlite3.Error as e:
+                print(f"Failed to write the player journal: {e!r}")
+
+            if any(event is None for _, _, event, _ in batch):
+                self.connection.close()
+                return
+
+    def drain_pending(self) -> List[Tuple[int, str, Optional[str], Dict]]:
+        drained = []
+        while True:
+            try:
+                drained.append(self.pending.get_nowait())
+            except queue.Empty:
+                return drained
+
+    def compact(self):
+        """Replace the whole log by one snapshot of every guild"""
+        with self.connection:
+            self.connection.execute("DELETE FROM journal")
+            self.connection.executemany(
+                "INSERT INTO journal (guild_id, player, event, payload) VALUES (?, ?, 'snapshot', ?)",
+                [(state.guild_id, state.player, json.dumps(asdict(state))) for state in self.states.values()])
+        self.rows = len(self.states)
+
+    def close(self):
+        """Stop recording, what is playing now stay in the journal to be resumed next time"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.pending.put((0, "", None, {}))
+        self.writer.join(5)
+
+
+journal: PlayerJournal = None
+journal_lock = threading.Lock()
+
+
+def get_journal() -> PlayerJournal:
+    """The journal shared by every cog, opened on first use"""
+    global journal
+    with journal_lock:
+        if journal is None:
+            journal = PlayerJournal(config.PLAYER_JOURNAL_PATH)
+        return journal
+
+
+class ResumedContext:
+    """Stands in for the commands.Context of the command that started a resumed player"""
+
+    def __init__(self, bot, channel):
+        self.bot = bot
+        self.channel = channel
+        self.guild = channel.guild
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+    def typing(self):
+        return self.channel.typing()
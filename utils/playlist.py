@@ -0,0 +1,183 @@
+import os
+import random
+import threading
+from typing import *
+from utils.song_info import SongFileInfo
+
+SONGS_PER_PAGE = 15
+# keeps a full page well under the 2000 characters of a message
+MAX_TITLE_LENGTH = 80
+
+
+class Playlist:
+    """Songs of a player in order, with the index of the one playing
+
+    Membership is checked against a count of every song key, so telling
+    whether a song is already queued does not scan the list. Inserting,
+    removing and moving songs keep the cursor on the song that is playing.
+    Every change bumps version, rendered queue pages are only built again
+    when it or the cursor changed.
+
+    With a speed every song in it get that speed, so the durations shown
+    are the ones of the nightcore effect playing them."""
+
+    def __init__(self, songs: Iterable[SongFileInfo] = (), speed: float = None):
+        self.lock = threading.RLock()
+        self.songs: List[SongFileInfo] = []
+        self.keys: Dict[str, int] = {}
+        self.cursor = -1
+        self.speed = speed
+        self.version = 0
+        self.rendered_pages: Dict[int, str] = {}
+        self.rendered_for: Tuple[int, int] = None
+
+        for song_file_info in songs:
+            self.append(song_file_info)
+
+    @staticmethod
+    def key(song_file_info: SongFileInfo) -> str:
+        # the same as SongFileInfo equality
+        return song_file_info.filename
+
+    def __len__(self) -> int:
+        return len(self.songs)
+
+    def __bool__(self) -> bool:
+        return bool(self.songs)
+
+    def __contains__(self, song_file_info: SongFileInfo) -> bool:
+        return self.key(song_file_info) in self.keys
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[SongFileInfo, List[SongFileInfo]]:
+        with self.lock:
+            return self.songs[index]
+
+    def __iter__(self) -> Iterator[SongFileInfo]:
+        # over a copy, the list can change while somebody is iterating
+        return iter(self.snapshot()[1])
+
+    def snapshot(self) -> Tuple[int, Tuple[SongFileInfo, ...], int]:
+        """(version, songs, cursor) as they were at one point in time"""
+        with self.lock:
+            return self.version, tuple(self.songs), self.cursor
+
+    def changed(self):
+        self.version += 1
+
+    def add_key(self, song_file_info: SongFileInfo):
+        if self.speed is not None:
+            song_file_info.speed = self.speed
+        key = self.key(song_file_info)
+        self.keys[key] = self.keys.get(key, 0) + 1
+
+    def remove_key(self, song_file_info: SongFileInfo):
+        key = self.key(song_file_info)
+        remaining = self.keys[key] - 1
+        if remaining:
+            self.keys[key] = remaining
+        else:
+            del self.keys[key]
+
+    def append(self, song_file_info: SongFileInfo) -> bool:
+        """Add the song at the end unless it is already queued, return whether it got added"""
+        with self.lock:
+            if song_file_info in self:
+                return False
+            self.songs.append(song_file_info)
+            self.add_key(song_file_info)
+            self.changed()
+            return True
+
+    def insert(self, position: int, song_file_info: SongFileInfo) -> bool:
+        """Add the song before position unless it is already queued, return whether it got added"""
+        with self.lock:
+            if song_file_info in self:
+                return False
+            position = max(0, min(position, len(self.songs)))
+            self.songs.insert(position, song_file_info)
+            self.add_key(song_file_info)
+            if position <= self.cursor:
+                self.cursor += 1
+            self.changed()
+            return True
+
+    def remove(self, position: int) -> SongFileInfo:
+        """Take the song out, removing the playing one leave the cursor just before the song after it"""
+        with self.lock:
+            song_file_info = self.songs.pop(position)
+            self.remove_key(song_file_info)
+            if position <= self.cursor:
+                self.cursor -= 1
+            self.changed()
+            return song_file_info
+
+    def move(self, source: int, destination: int):
+        with self.lock:
+            destination = max(0, min(destination, len(self.songs) - 1))
+            song_file_info = self.songs.pop(source)
+            self.songs.insert(destination, song_file_info)
+            if source == self.cursor:
+                self.cursor = destination
+            elif source < self.cursor <= destination:
+                self.cursor -= 1
+            elif destination <= self.cursor < source:
+                self.cursor += 1
+            self.changed()
+
+    def shuffle(self):
+        """Shuffle the songs that are still to come, what already played stay where it is"""
+        with self.lock:
+            upcoming = self.songs[self.cursor + 1:]
+            random.shuffle(upcoming)
+            self.songs[self.cursor + 1:] = upcoming
+            self.changed()
+
+    def set_speed(self, speed: float):
+        with self.lock:
+            self.speed = speed
+            for song_file_info in self.songs:
+                song_file_info.speed = speed
+            self.changed()
+
+    def clear(self):
+        with self.lock:
+            self.songs.clear()
+            self.keys.clear()
+            self.cursor = -1
+            self.changed()
+
+    @property
+    def page_count(self) -> int:
+        return max(1, -(-len(self.songs) // SONGS_PER_PAGE))
+
+    def render_page(self, page: int = 0) -> str:
+        """One page of the queue as a code block, page 0 is the page of the song playing"""
+        with self.lock:
+            if self.rendered_for != (self.version, self.cursor):
+                self.rendered_pages.clear()
+                self.rendered_for = (self.version, self.cursor)
+            if page == 0:
+                page = max(0, self.cursor) // SONGS_PER_PAGE + 1
+            page = max(1, min(page, self.page_count))
+
+            rendered = self.rendered_pages.get(page)
+            if rendered is None:
+                rendered = self.rendered_pages[page] = self.build_page(page)
+            return rendered
+
+    def build_page(self, page: int) -> str:
+        start = (page - 1) * SONGS_PER_PAGE
+        lines = ["```"]
+        for index, song_file_info in enumerate(self.songs[start:start + SONGS_PER_PAGE], start):
+            # the media store and the journal can hand back songs without their metadata
+            title = song_file_info.title or song_file_info.video_id or os.path.basename(song_file_info.filename)
+            if len(title) > MAX_TITLE_LENGTH:
+                title = title[:MAX_TITLE_LENGTH - 3] + "..."
+            duration = song_file_info.duration_nightcore_string if song_file_info.duration is not None else "?:??"
+            line = f"{index + 1}. {title} - {duration}"
+            if index == self.cursor:
+                line += " <--- Now playing"
+            lines.append(line)
+        lines.append(f"Page {page}/{self.page_count}, {len(self.songs)} songs")
+        lines.append("```")
+        return "\n".join(lines)
@@ -0,0 +1,6 @@
+import os
+from typing import *
+
+# Popen keyword arguments that keep every ffmpeg from opening a console
+# window on Windows, creationflags is refused anywhere else
+NO_WINDOW: Dict[str, int] = {"creationflags": 0x08000000} if os.name == "nt" else {}
@@ -0,0 +1,184 @@
+import os
+import json
+import threading
+from dataclasses import dataclass
+from typing import *
+
+
+@dataclass(frozen=True)
+class RadioStationInfo:
+    """Class for a station entry of radios.json"""
+    code: str
+    url: str
+    format: str
+    name: str
+
+
+class RadioRegistry:
+    """In-memory catalogue of the radio stations
+
+    radios.json is only parsed again when its mtime changes, every lookup
+    in between is served from the dicts built on the last load."""
+
+    # a discord message is capped at 2000 characters, the rest is
+    # for the code block and the page footer
+    page_character_limit = 1900
+    line_format = "{radio_name} -> {radio_code}\n"
+    annotated_line_format = "{radio_name} -> {radio_code} [{annotation}]\n"
+    # room kept on every line for the annotation, like "slow 12345ms aac"
+    annotation_width = 20
+
+    def __init__(self, path: str = "data/radios.json"):
+        self.path = path
+        self.reload_lock = threading.Lock()
+        self.mtime: Optional[int] = None
+
+        self.stations: Dict[str, RadioStationInfo] = {}
+        self.lowercase_codes: Dict[str, str] = {}
+        self.prefix_index: Dict[str, Tuple[str, ...]] = {}
+        self.deletion_index: Dict[str, Tuple[str, ...]] = {}
+        self.listing_pages: List[str] = []
+        self.listing_codes: List[Tuple[str, ...]] = []
+
+    def refresh(self):
+        """Reload the catalogue if the file changed since the last load"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        if mtime == self.mtime:
+            return
+
+        with self.reload_lock:
+            if mtime != self.mtime:
+                self.load(mtime)
+
+    def load(self, mtime: Optional[int]):
+        stations: Dict[str, RadioStationInfo] = {}
+        if mtime is not None:
+            with open(self.path, 'r') as json_file:
+                radios: Dict[str, List[str]] = json.load(json_file)
+
+            # There are always 3 element in the radio data, [0] is the url
+            # [1] is the format and [2] is the radio name
+            for radio_code, radio_data in radios.items():
+                stations[radio_code] = RadioStationInfo(
+                    radio_code, radio_data[0], radio_data[1], radio_data[2])
+
+        lowercase_codes: Dict[str, str] = {}
+        prefix_index: Dict[str, List[str]] = {}
+        deletion_index: Dict[str, List[str]] = {}
+        for radio_code in stations:
+            lowercase_code = radio_code.lower()
+            lowercase_codes.setdefault(lowercase_code, radio_code)
+
+            for end in range(1, len(lowercase_code) + 1):
+                prefix_index.setdefault(
+                    lowercase_code[:end], []).append(radio_code)
+
+            for variant in self.deletion_variants(lowercase_code):
+                codes = deletion_index.setdefault(variant, [])
+                if radio_code not in codes:
+                    codes.append(radio_code)
+
+        listing_pages: List[str] = []
+        listing_codes: List[Tuple[str, ...]] = []
+        page = ""
+        page_codes: List[str] = []
+        for radio_code, station in stations.items():
+            line = self.line_format.format(
+                radio_name=station.name, radio_code=radio_code)
+            if page and len(page) + len(line) + self.annotation_width * (len(page_codes) + 1) > self.page_character_limit:
+                listing_pages.append(page)
+                listing_codes.append(tuple(page_codes))
+                page = ""
+                page_codes = []
+            page += line
+            page_codes.append(radio_code)
+        listing_pages.append(page)
+        listing_codes.append(tuple(page_codes))
+
+        # swap everything at once so readers never see a half built index
+        self.stations = stations
+        self.lowercase_codes = lowercase_codes
+        self.prefix_index = {prefix: tuple(codes)
+                             for prefix, codes in prefix_index.items()}
+        self.deletion_index = {variant: tuple(codes)
+                               for variant, codes in deletion_index.items()}
+        self.listing_pages = listing_pages
+        self.listing_codes = listing_codes
+        self.mtime = mtime
+
+    @staticmethod
+    def deletion_variants(code: str) -> Set[str]:
+        """The code itself and every string made by deleting one of its characters"""
+        variants = {code}
+        for index in range(len(code)):
+            variants.add(code[:index] + code[index + 1:])
+        return variants
+
+    def get(self, radio_code: str) -> Optional[RadioStationInfo]:
+        """Exact lookup of a station by its code"""
+        self.refresh()
+        return self.stations.get(radio_code)
+
+    def resolve(self, radio_code: str) -> Optional[RadioStationInfo]:
+        """Lookup a station, tolerating case, unique prefixes and one typo"""
+        self.refresh()
+
+        station = self.stations.get(radio_code)
+        if station is not None:
+            return station
+
+        lowercase_code = radio_code.lower()
+        if lowercase_code in self.lowercase_codes:
+            return self.stations[self.lowercase_codes[lowercase_code]]
+
+        candidates = self.prefix_index.get(lowercase_code, ())
+        if len(candidates) == 1:
+            return self.stations[candidates[0]]
+
+        candidates = self.close_matches(lowercase_code)
+        if len(candidates) == 1:
+            return self.stations[candidates[0]]
+
+        return None
+
+    def close_matches(self, radio_code: str) -> List[str]:
+        """Codes within one insertion, deletion, substitution or transposition of radio_code"""
+        matches: List[str] = []
+        for variant in self.deletion_variants(radio_code.lower()):
+            for code in self.deletion_index.get(variant, ()):
+                if code not in matches:
+                    matches.append(code)
+        return matches
+
+    def suggestions(self, radio_code: str) -> List[str]:
+        """Codes that the user might have meant, used when resolve gives up"""
+        self.refresh()
+        lowercase_code = radio_code.lower()
+        matches = list(self.prefix_index.get(lowercase_code, ()))
+        for code in self.close_matches(lowercase_code):
+            if code not in matches:
+                matches.append(code)
+        return matches
+
+    def get_page(self, page_number: int, annotations: Dict[str, str] = None) -> Tuple[str, int]:
+        """Pre-rendered listing page, page_number start from 1
+
+        With annotations (code -> short text, like the station health) the
+        page is rendered again with the text after the stations that have one."""
+        self.refresh()
+        pages, pages_codes, stations = self.listing_pages, self.listing_codes, self.stations
+        page_number = max(1, min(page_number, len(pages)))
+        if not annotations:
+            return pages[page_number - 1], len(pages)
+
+        page = ""
+        for radio_code in pages_codes[page_number - 1]:
+            annotation = annotations.get(radio_code)
+            line_format = self.line_format if annotation is None else self.annotated_line_format
+            page += line_format.format(radio_name=stations[radio_code].name, radio_code=radio_code,
+                                       annotation=(annotation or "")[:self.annotation_width - 3])
+        return page, len(pages)
@@ -0,0 +1,320 @@
+import os
+import mmap
+import hashlib
+import threading
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import *
+from utils.ogg import OggOpusStream, FFMPEG_OPUS_OUTPUT
+from utils.processes import NO_WINDOW
+
+# 3840 is the amount of byte that has 20ms amount of audio
+FRAME_SIZE = 3840
+
+
+class CachedPCMReader:
+    """Memory-mapped reader of a rendered s16le 48kHz stereo file"""
+
+    def __init__(self, cache: "RenderCache", key: str, path: str):
+        self.cache = cache
+        self.key = key
+        self.position = 0
+        self.stopped = False
+
+        with open(path, "rb") as file_handle:
+            self.mapping = mmap.mmap(
+                file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.mapping)
+
+    @property
+    def frame_count(self) -> int:
+        return -(-self.size // FRAME_SIZE)
+
+    def read_frame(self) -> bytes:
+        if self.stopped:
+            return b''
+        frame = self.mapping[self.position:self.position + FRAME_SIZE]
+        self.position += len(frame)
+        return frame
+
+    def seek(self, frame: int):
+        """Continue reading from the given frame, exact to the sample"""
+        self.position = min(frame * FRAME_SIZE, self.size)
+
+    def __iter__(self):
+        while True:
+            frame = self.read_frame()
+            if not frame:
+                break
+            yield frame
+
+    def stop(self):
+        """Make the reader behave like it reached the end of the file"""
+        self.stopped = True
+
+    def close(self):
+        if self.mapping is None:
+            return
+        self.mapping.close()
+        self.mapping = None
+        self.cache.release(self.key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CachedOpusReader(CachedPCMReader):
+    """Memory-mapped reader of a rendered Ogg Opus file, read_frame give one 20ms packet"""
+
+    def __init__(self, cache: "RenderCache", key: str, path: str):
+        super().__init__(cache, key, path)
+        self.opus_stream = OggOpusStream(buffer=self.mapping)
+        self.packets = iter(self.opus_stream)
+
+    @property
+    def frame_count(self) -> int:
+        # the count is not known without reading the whole file
+        return 0
+
+    def read_frame(self) -> bytes:
+        if self.stopped:
+            return b''
+        return next(self.packets, b'')
+
+    def seek(self, frame: int):
+        """Continue reading from the given packet, the file is demuxed again from the start"""
+        self.packets.close()
+        self.opus_stream.demuxer.release()
+        self.opus_stream = OggOpusStream(buffer=self.mapping)
+        self.packets = iter(self.opus_stream)
+        for _ in range(frame):
+            if next(self.packets, None) is None:
+                break
+
+    def close(self):
+        if self.mapping is not None:
+            # the demuxer hold a view on the mapping, which block closing it
+            self.packets.close()
+            self.opus_stream.demuxer.release()
+        super().close()
+
+
+class CacheWriter:
+    """Tee live ffmpeg output into the cache, the file only becomes visible on commit"""
+
+    def __init__(self, cache: "RenderCache", key: str):
+        self.cache = cache
+        self.key = key
+        self.part_path = cache.path_for(key) + f".{threading.get_ident()}.part"
+        self.file_handle = open(self.part_path, "wb")
+
+    def write(self, frame: bytes):
+        self.file_handle.write(frame)
+
+    def commit(self):
+        self.file_handle.close()
+        try:
+            self.cache.publish(self.key, self.part_path)
+        finally:
+            self.cache.done_writing(self.key)
+
+    def abort(self):
+        self.file_handle.close()
+        try:
+            os.remove(self.part_path)
+        except OSError:
+            pass
+        self.cache.done_writing(self.key)
+
+
+class RenderCache:
+    """On-disk cache of processed nightcore audio
+
+    Rendered output is stored as raw s16le PCM or as Ogg Opus, keyed by the
+    source file, the filter chain and the format, and evicted least recently
+    used first once the cache grows over max_bytes."""
+
+    output_formats = {
+        "pcm": ["-f", "s16le", "-ac", "2", "-ar", "48000"],
+        "opus": FFMPEG_OPUS_OUTPUT
+    }
+    readers_by_format = {
+        "pcm": CachedPCMReader,
+        "opus": CachedOpusReader
+    }
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[str, int]" = OrderedDict()
+        self.total_bytes = 0
+        # entries that have an open reader, these are never evicted
+        self.readers: Dict[str, int] = {}
+        self.rendering: Dict[str, Future] = {}
+        # keys a live render is being teed into, only one guild write each
+        self.writing: Set[str] = set()
+
+        # rubberband is heavy so only one background render run at a time
+        self.render_pool = ThreadPoolExecutor(max_workers=1)
+
+        self.scan()
+
+    def scan(self):
+        """Rebuild the LRU order from the cache directory, oldest access first"""
+        found = []
+        for filename in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, filename)
+            if filename.endswith(".part"):
+                # leftover from a render that got interrupted
+                os.remove(path)
+                continue
+            if os.path.splitext(filename)[1][1:] not in self.output_formats:
+                continue
+            stat = os.stat(path)
+            found.append((stat.st_mtime, filename, stat.st_size))
+
+        with self.lock:
+            for _, key, size in sorted(found):
+                self.entries[key] = size
+                self.total_bytes += size
+        self.evict()
+
+    @staticmethod
+    def make_key(filename: str, filter_chain: str, output_format: str = "pcm") -> str:
+        """The file name of a render inside the cache directory"""
+        stat = os.stat(filename)
+        identity = f"{os.path.abspath(filename)}|{stat.st_size}|{stat.st_mtime_ns}|{filter_chain}"
+        return hashlib.sha1(identity.encode()).hexdigest() + "." + output_format
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def open_reader(self, filename: str, filter_chain: str, output_format: str = "pcm") -> Optional[CachedPCMReader]:
+        """Reader over the rendered audio or None on a cache miss"""
+        try:
+            key = self.make_key(filename, filter_chain, output_format)
+        except OSError:
+            return None
+
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            self.readers[key] = self.readers.get(key, 0) + 1
+
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+            return self.readers_by_format[output_format](self, key, path)
+        except (OSError, ValueError):
+            # file got removed behind our back or it is empty
+            self.release(key)
+            self.forget(key)
+            return None
+
+    def release(self, key: str):
+        with self.lock:
+            remaining = self.readers.get(key, 0) - 1
+            if remaining > 0:
+                self.readers[key] = remaining
+            else:
+                self.readers.pop(key, None)
+        self.evict()
+
+    def writer(self, filename: str, filter_chain: str, output_format: str = "pcm") -> Optional[CacheWriter]:
+        """Writer to tee a live render into, None if it is already cached or being rendered"""
+        try:
+            key = self.make_key(filename, filter_chain, output_format)
+        except OSError:
+            return None
+
+        with self.lock:
+            if key in self.entries or key in self.rendering or key in self.writing:
+                return None
+            self.writing.add(key)
+        try:
+            return CacheWriter(self, key)
+        except OSError:
+            self.done_writing(key)
+            return None
+
+    def done_writing(self, key: str):
+        with self.lock:
+            self.writing.discard(key)
+
+    def publish(self, key: str, part_path: str):
+        path = self.path_for(key)
+        size = os.path.getsize(part_path)
+        if size == 0:
+            os.remove(part_path)
+            return
+        os.replace(part_path, path)
+
+        with self.lock:
+            self.total_bytes += size - self.entries.get(key, 0)
+            self.entries[key] = size
+            self.entries.move_to_end(key)
+        self.evict()
+
+    def forget(self, key: str):
+        with self.lock:
+            size = self.entries.pop(key, None)
+            if size is not None:
+                self.total_bytes -= size
+
+    def evict(self):
+        """Remove least recently used renders until the cache fits in max_bytes"""
+        victims = []
+        with self.lock:
+            for key in list(self.entries):
+                if self.total_bytes <= self.max_bytes:
+                    break
+                if key in self.readers:
+                    continue
+                self.total_bytes -= self.entries.pop(key)
+                victims.append(key)
+
+        for key in victims:
+            try:
+                os.remove(self.path_for(key))
+            except OSError:
+                pass
+
+    def prerender(self, filename: str, filter_chain: str, output_format: str = "pcm") -> Optional[Future]:
+        """Render the file in the background so playing it later is a cache hit"""
+        try:
+            key = self.make_key(filename, filter_chain, output_format)
+        except OSError:
+            return None
+
+        with self.lock:
+            if key in self.entries or key in self.writing:
+                return None
+            if key in self.rendering:
+                return self.rendering[key]
+            future = self.render_pool.submit(
+                self.render, key, filename, filter_chain, output_format)
+            self.rendering[key] = future
+        return future
+
+    def render(self, key: str, filename: str, filter_chain: str, output_format: str):
+        part_path = self.path_for(key) + ".prerender.part"
+        try:
+            ffmpeg = subprocess.run(
+                ["ffmpeg", "-v", "error", "-y", "-i", filename, "-filter_complex", filter_chain]
+                + self.output_formats[output_format] + [part_path],
+                stdin=subprocess.DEVNULL, **NO_WINDOW)
+            if ffmpeg.returncode == 0:
+                self.publish(key, part_path)
+            elif os.path.exists(part_path):
+                os.remove(part_path)
+        finally:
+            with self.lock:
+                self.rendering.pop(key, None)
@@ -0,0 +1,23 @@
+from dataclasses import dataclass, field
+from utils import config
+
+
+@dataclass
+class SongFileInfo:
+    """Class for Song File Info"""
+    filename: str
+    title: str = field(compare=False)
+    duration: int = field(compare=False)
+    # media url to play from while filename is still being downloaded
+    stream_url: str = field(default=None, compare=False, repr=False)
+    video_id: str = field(default=None, compare=False)
+    # how much faster the nightcore effect play it, the playlist set the one of its guild
+    speed: float = field(default=config.NIGHTCORE_SPEED_PERCENT / 100, compare=False, repr=False)
+
+    @property
+    def nightcore_duration(self) -> int:
+        return int(self.duration / self.speed)
+
+    @property
+    def duration_nightcore_string(self):
+        return f"{self.nightcore_duration // 60}:{str(self.nightcore_duration % 60).zfill(2)}"
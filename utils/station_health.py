@@ -0,0 +1,297 @@
+import time
+import asyncio
+import aiohttp
+from collections import Counter, deque
+from dataclasses import dataclass
+from typing import *
+from utils.radio_registry import RadioRegistry, RadioStationInfo
+
+# Content-Type of the stream -> the codec shown in the listing
+CODECS = {
+    "audio/mpeg": "mp3",
+    "audio/mp3": "mp3",
+    "audio/aac": "aac",
+    "audio/aacp": "aac",
+    "audio/x-aac": "aac",
+    "audio/ogg": "ogg",
+    "application/ogg": "ogg",
+    "audio/opus": "opus",
+}
+
+# slower than this to send its first bytes and a station is marked slow
+SLOW_SECONDS = 2.0
+
+
+@dataclass
+class StationHealth:
+    """Class for the result of probing one station"""
+    code: str
+    up: bool
+    checked_at: float
+    # seconds until the connection was open, and until the first audio bytes
+    connect_latency: float = None
+    first_byte_latency: float = None
+    icy: bool = False
+    codec: str = None
+    error: str = None
+
+    @property
+    def annotation(self) -> str:
+        if not self.up:
+            return "down"
+        state = "slow" if self.first_byte_latency > SLOW_SECONDS else "up"
+        return f"{state} {self.first_byte_latency * 1000:.0f}ms {self.codec or '?'}"
+
+
+class WarmConnection:
+    """An icy stream opened ahead of time for a station that is often tuned into
+
+    The stream is read and split into audio and metadata the same way
+    RadioStation.ingest_icy does, keeping only the last backlog_bytes of
+    audio. A station starting up take the connection over with claim(),
+    feeds the backlog to its ffmpeg and carry on reading where this left
+    off, so it never wait for a connection or for the first bytes."""
+
+    def __init__(self, station_info: RadioStationInfo, session: aiohttp.ClientSession, backlog_bytes: int):
+        self.station_info = station_info
+        self.session = session
+        self.backlog_bytes = backlog_bytes
+
+        self.response: aiohttp.ClientResponse = None
+        self.metaint: int = None
+        # bytes of audio before the next metadata length byte
+        self.audio_left: Optional[int] = None
+        # bytes of the metadata block being read that are still to come
+        self.metadata_left = 0
+        self.metadata = b""
+        # the last complete metadata block, to announce what is on air
+        self.last_metadata: str = None
+
+        self.audio: Deque[bytes] = deque()
+        self.audio_size = 0
+        self.task: asyncio.Task = None
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self.task = loop.create_task(self.run())
+
+    @property
+    def alive(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    async def run(self):
+        try:
+            self.response = await self.session.get(self.station_info.url, headers={"Icy-MetaData": "1"})
+            self.response.raise_for_status()
+            metaint = self.response.headers.get("icy-metaint")
+            if metaint is not None:
+                self.metaint = self.audio_left = int(metaint)
+            while True:
+                # readany never lose data when cancelled, unlike readexactly
+                data = await self.response.content.readany()
+                if not data:
+                    break
+                self.feed(data)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            print(f"Warm connection to {self.station_info.name} failed: {e!r}")
+        # only reached when the stream ended, a claimed connection get cancelled instead
+        if self.response is not None:
+            self.response.close()
+
+    def feed(self, data: bytes):
+        if self.metaint is None:
+            self.keep_audio(data)
+            return
+        while data:
+            if self.metadata_left:
+                chunk = data[:self.metadata_left]
+                self.metadata += chunk
+                self.metadata_left -= len(chunk)
+                if not self.metadata_left:
+                    self.last_metadata = self.metadata.decode("utf-8", errors="replace")
+            elif self.audio_left:
+                chunk = data[:self.audio_left]
+                self.keep_audio(chunk)
+                self.audio_left -= len(chunk)
+            else:
+                # the metadata length byte, in blocks of 16 bytes
+                chunk = data[:1]
+                self.metadata_left = data[0] * 16
+                self.metadata = b""
+                self.audio_left = self.metaint
+            data = data[len(chunk):]
+
+    def keep_audio(self, data: bytes):
+        self.audio.append(data)
+        self.audio_size += len(data)
+        while self.audio_size - len(self.audio[0]) >= self.backlog_bytes:
+            self.audio_size -= len(self.audio.popleft())
+
+    def backlog(self) -> bytes:
+        return b"".join(self.audio)
+
+    async def claim(self) -> bool:
+        """Stop reading so the caller can take over the response, False if the connection is of no use"""
+        if not self.alive or self.response is None:
+            return False
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        return not self.response.closed
+
+    def close(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        if self.response is not None:
+            self.response.close()
+
+
+class StationProber:
+    """Check every station of the registry in the background
+
+    Each round opens every station concurrently, at most concurrency at a
+    time, and records how long the connection and the first bytes took,
+    whether the server interleave icy metadata and the codec it sends.
+    Between rounds it keeps a warm connection to the most played icy
+    stations that nobody is listening to right now."""
+
+    def __init__(self, registry: RadioRegistry, loop: asyncio.AbstractEventLoop, interval: float, concurrency: int,
+                 timeout: float, warm_stations: int, backlog_bytes: int, active_codes: Callable[[], Set[str]]):
+        self.registry = registry
+        self.loop = loop
+        self.interval = interval
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.warm_stations = warm_stations
+        self.backlog_bytes = backlog_bytes
+        # stations with a RadioStation running, they already have their connection
+        self.active_codes = active_codes
+
+        self.health: Dict[str, StationHealth] = {}
+        self.plays: Counter = Counter()
+        self.warm: Dict[str, WarmConnection] = {}
+        self.session: aiohttp.ClientSession = None
+        self.warm_session: aiohttp.ClientSession = None
+
+    def get_sessions(self) -> Tuple[aiohttp.ClientSession, aiohttp.ClientSession]:
+        if self.session is None or self.session.closed:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_create_end.append(self.connection_created)
+            # every probe measure a fresh connection, a stream can't go back to the pool anyway
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency, force_close=True, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=self.timeout), trace_configs=[trace_config])
+        if self.warm_session is None or self.warm_session.closed:
+            self.warm_session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30))
+        return self.session, self.warm_session
+
+    async def connection_created(self, session: aiohttp.ClientSession, trace_config_ctx, params):
+        if trace_config_ctx.trace_request_ctx is not None:
+            trace_config_ctx.trace_request_ctx["connected_at"] = self.loop.time()
+
+    async def probe(self, station_info: RadioStationInfo) -> StationHealth:
+        session, _ = self.get_sessions()
+        timings = {}
+        started = self.loop.time()
+        try:
+            headers = {"Icy-MetaData": "1"} if station_info.format != "vorbis" else {}
+            async with session.get(station_info.url, headers=headers, trace_request_ctx=timings) as response:
+                response.raise_for_status()
+                if not await response.content.readany():
+                    raise ValueError("empty stream")
+                first_byte_at = self.loop.time()
+                content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+                health = StationHealth(
+                    station_info.code, True, time.time(),
+                    connect_latency=timings.get("connected_at", first_byte_at) - started,
+                    first_byte_latency=first_byte_at - started,
+                    icy="icy-metaint" in response.headers,
+                    codec=CODECS.get(content_type, content_type or None))
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            health = StationHealth(station_info.code, False, time.time(), error=f"{type(e).__name__}: {e}")
+        self.health[station_info.code] = health
+        return health
+
+    async def probe_all(self):
+        self.registry.refresh()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def limited_probe(station_info: RadioStationInfo):
+            async with semaphore:
+                await self.probe(station_info)
+
+        await asyncio.gather(*(limited_probe(station_info) for station_info in self.registry.stations.values()))
+        # stations removed from radios.json
+        for code in set(self.health) - set(self.registry.stations):
+            del self.health[code]
+
+    async def run(self):
+        while True:
+            started = self.loop.time()
+            try:
+                await self.probe_all()
+                self.refresh_warm()
+            except Exception as e:
+                print(f"Station probing failed: {e!r}")
+            await asyncio.sleep(max(0.0, self.interval - (self.loop.time() - started)))
+
+    def get(self, code: str) -> Optional[StationHealth]:
+        return self.health.get(code)
+
+    def annotations(self) -> Dict[str, str]:
+        return {code: health.annotation for code, health in self.health.items()}
+
+    def ranking(self) -> List[StationHealth]:
+        """The stations that are up, quickest to send their first bytes first"""
+        return sorted((health for health in self.health.values() if health.up), key=lambda health: health.first_byte_latency)
+
+    def played(self, code: str):
+        # the warm connections are refreshed once the station took over its
+        # own, doing it now would warm up the station about to start
+        self.plays[code] += 1
+
+    def refresh_warm(self):
+        """Keep a warm connection to the most played icy stations nobody listen to"""
+        if not self.warm_stations:
+            return
+        active_codes = self.active_codes()
+        wanted = []
+        for code, _ in self.plays.most_common():
+            station_info = self.registry.stations.get(code)
+            health = self.health.get(code)
+            if (station_info is None or station_info.format in ("vorbis", "direct") or code in active_codes
+                    or (health is not None and not health.up)):
+                continue
+            wanted.append(station_info)
+            if len(wanted) == self.warm_stations:
+                break
+
+        wanted_codes = {station_info.code for station_info in wanted}
+        for code in list(self.warm):
+            if code not in wanted_codes or not self.warm[code].alive:
+                self.warm.pop(code).close()
+        _, warm_session = self.get_sessions()
+        for station_info in wanted:
+            if station_info.code not in self.warm:
+                warm_connection = self.warm[station_info.code] = WarmConnection(station_info, warm_session, self.backlog_bytes)
+                warm_connection.start(self.loop)
+
+    async def claim(self, code: str) -> Optional[WarmConnection]:
+        """Take the warm connection of a station, None if there isn't a usable one"""
+        warm_connection = self.warm.pop(code, None)
+        if warm_connection is None:
+            return None
+        if not await warm_connection.claim():
+            warm_connection.close()
+            return None
+        return warm_connection
+
+    async def close(self):
+        for warm_connection in self.warm.values():
+            warm_connection.close()
+        self.warm.clear()
+        for session in (self.session, self.warm_session):
+            if session is not None:
+                await session.close()
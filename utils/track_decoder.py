@@ -0,0 +1,168 @@
+import os
+import subprocess
+from collections import deque
+from typing import *
+from utils.decoders import SubprocessDecoder, PyAVDecoder, FrameBuffer, open_file_decoder
+from utils.dsp import SpeedupEqualizer
+from utils.render_cache import RenderCache, CachedPCMReader, CacheWriter, FRAME_SIZE
+from utils.song_info import SongFileInfo
+
+# 50 frames of 20ms make a second
+FRAMES_PER_SECOND = 50
+
+
+class TrackDecoder:
+    """The frames of one track, from the render cache or from a live decoder
+
+    The live decoder is ffmpeg in a subprocess, or libav in this process
+    with the pyav backend. start() can run on another thread ahead of
+    time, it starts the decoder and reads the first few frames so the
+    track can start right when the one before it ends. PCM frames always
+    come out full size, the last partial frame of a track is padded with
+    silence instead of being dropped.
+
+    With a processor the source is decoded as it is and every block goes
+    through a fresh processor from it, filter_chain is then only the name
+    the render is cached under."""
+
+    def __init__(self, song_file_info: SongFileInfo, render_cache: RenderCache, filter_chain: str,
+                 output_format: str, prebuffer_frames: int, tempo: float, backend: str = "subprocess",
+                 processor: Callable[[], SpeedupEqualizer] = None):
+        self.song_file_info = song_file_info
+        self.render_cache = render_cache
+        self.filter_chain = filter_chain
+        self.output_format = output_format
+        self.prebuffer_frames = prebuffer_frames
+        # how much faster than the source the filter chain play, to seek in the source
+        self.tempo = tempo
+
+        # one of decoders.BACKENDS, a live render fall back to ffmpeg when it has to
+        self.backend = backend
+        self.processor = processor
+        self.source_decoder: Union[SubprocessDecoder, PyAVDecoder] = None
+        self.cached_reader: CachedPCMReader = None
+        self.frames: Iterator[bytes] = None
+        self.prebuffered: Deque[bytes] = deque()
+        self.stopped = False
+
+    def start(self):
+        cached_reader = self.render_cache.open_reader(self.song_file_info.filename, self.filter_chain, self.output_format)
+        if cached_reader is not None:
+            # already rendered before, no need for ffmpeg at all
+            self.cached_reader = cached_reader
+            self.frames = iter(cached_reader)
+        else:
+            self.frames = self.live_frames()
+
+        while len(self.prebuffered) < self.prebuffer_frames and not self.stopped:
+            frame = next(self.frames, None)
+            if frame is None:
+                break
+            self.prebuffered.append(frame)
+
+    @property
+    def ffmpeg(self) -> Optional[subprocess.Popen]:
+        """The ffmpeg process of a live render, None for a cached or an in-process one"""
+        return self.source_decoder.process if self.source_decoder is not None else None
+
+    @property
+    def expected_frames(self) -> int:
+        """Roughly how many frames the track has"""
+        if self.cached_reader is not None and self.cached_reader.frame_count:
+            return self.cached_reader.frame_count
+        return int(self.song_file_info.duration / self.tempo * FRAMES_PER_SECOND)
+
+    def live_frames(self, start_frame: int = 0) -> Iterator[bytes]:
+        song_file_info = self.song_file_info
+        if os.path.exists(song_file_info.filename) or not song_file_info.stream_url:
+            source, remote = song_file_info.filename, False
+        else:
+            # still being downloaded, decode straight from the media url meanwhile
+            source, remote = song_file_info.stream_url, True
+
+        decoder = self.source_decoder = open_file_decoder(
+            self.backend, source, self.filter_chain if self.processor is None else None, self.output_format,
+            start_frame / FRAMES_PER_SECOND * self.tempo, remote)
+        # only a render from the very start is worth keeping
+        cache_writer: Optional[CacheWriter] = None
+        if not start_frame:
+            cache_writer = self.render_cache.writer(song_file_info.filename, self.filter_chain, self.output_format)
+
+        try:
+            if self.output_format == "opus":
+                # the pages are teed into the cache as they are demuxed
+                tee = cache_writer.write if cache_writer is not None else None
+                yield from decoder.frames(tee)
+                return
+
+            audio_frames = decoder.frames() if self.processor is None else self.processed_frames(decoder.frames())
+            for audio_frame in audio_frames:
+                if cache_writer is not None:
+                    cache_writer.write(audio_frame)
+                if len(audio_frame) < FRAME_SIZE:
+                    audio_frame += bytes(FRAME_SIZE - len(audio_frame))
+                yield audio_frame
+        finally:
+            if cache_writer is not None:
+                # a stopped song is only partly rendered
+                if not self.stopped and decoder.finished_cleanly():
+                    cache_writer.commit()
+                else:
+                    cache_writer.abort()
+
+    def processed_frames(self, source_frames: Iterator[bytes]) -> Iterator[bytes]:
+        processor = self.processor()
+        frame_buffer = FrameBuffer()
+        for source_frame in source_frames:
+            yield from frame_buffer.push(processor.process(source_frame))
+        if not self.stopped:
+            yield from frame_buffer.push(processor.flush())
+        yield from frame_buffer.flush()
+
+    def read_frame(self) -> bytes:
+        """The next frame, b'' at the end of the track"""
+        if self.stopped:
+            return b''
+        if self.prebuffered:
+            return self.prebuffered.popleft()
+        frame = next(self.frames, b'')
+        if 0 < len(frame) < FRAME_SIZE and self.output_format == "pcm":
+            # the end of a cached render
+            frame += bytes(FRAME_SIZE - len(frame))
+        return frame
+
+    def seek(self, frame: int):
+        """Continue from the given frame
+
+        A cached render is read from the new offset, a live ffmpeg gets
+        restarted from the matching point of the source."""
+        self.prebuffered.clear()
+        if self.cached_reader is not None:
+            self.cached_reader.seek(frame)
+            return
+        # the render so far is dropped along with the old decoder
+        if self.source_decoder is not None:
+            self.source_decoder.stop()
+        self.frames.close()
+        self.frames = self.live_frames(frame)
+
+    def stop(self):
+        """End the track early, the frames read so far are discarded"""
+        self.stopped = True
+        if self.cached_reader is not None:
+            self.cached_reader.stop()
+        if self.source_decoder is not None:
+            self.source_decoder.stop()
+
+    def close(self):
+        self.stop()
+        if self.frames is not None:
+            # runs the finally of live_frames, which drop the partial render
+            try:
+                self.frames.close()
+            except (AttributeError, ValueError):
+                # the iterator of a cached reader, or still running on the thread that started it
+                pass
+        if self.cached_reader is not None:
+            self.cached_reader.close()
+        self.prebuffered.clear()
@@ -0,0 +1,123 @@
+import asyncio
+import discord
+from typing import *
+
+
+class TimerWheel:
+    """Hashed timer wheel with one slot per tick
+
+    Scheduling and cancelling are O(1), and a single task ticks the wheel
+    only while something is scheduled on it."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, tick: float = 1.0, slot_count: int = 256):
+        self.loop = loop
+        self.tick = tick
+        self.slots: List[Dict[Hashable, Tuple[int, Callable[[], Any]]]] = [{} for _ in range(slot_count)]
+        # key -> slot index, to cancel without searching
+        self.scheduled: Dict[Hashable, int] = {}
+        self.current_slot = 0
+        self.ticker: asyncio.Task = None
+
+    def schedule(self, key: Hashable, delay: float, callback: Callable[[], Any]):
+        """Call callback in about delay seconds, replacing what was scheduled for key"""
+        self.cancel(key)
+        ticks = max(1, round(delay / self.tick))
+        # the slot is first reached after 1 to len(slots) ticks, a multiple
+        # of the wheel size lands on the current slot and is reached last
+        rounds = (ticks - 1) // len(self.slots)
+        slot_index = (self.current_slot + ticks) % len(self.slots)
+        self.slots[slot_index][key] = (rounds, callback)
+        self.scheduled[key] = slot_index
+
+        if self.ticker is None or self.ticker.done():
+            self.ticker = self.loop.create_task(self.run())
+
+    def cancel(self, key: Hashable):
+        slot_index = self.scheduled.pop(key, None)
+        if slot_index is not None:
+            del self.slots[slot_index][key]
+
+    def is_scheduled(self, key: Hashable) -> bool:
+        return key in self.scheduled
+
+    async def run(self):
+        while self.scheduled:
+            await asyncio.sleep(self.tick)
+            self.current_slot = (self.current_slot + 1) % len(self.slots)
+            slot = self.slots[self.current_slot]
+            for key, (rounds, callback) in list(slot.items()):
+                if rounds:
+                    slot[key] = (rounds - 1, callback)
+                    continue
+                del slot[key]
+                del self.scheduled[key]
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"Timer {key} failed: {e!r}")
+
+
+class VoicePresenceTracker:
+    """Count the people in every voice channel and leave the ones nobody listens in
+
+    The counts are kept up to date from voice state updates instead of
+    scanning channel members, and a channel the bot is connected to gets a
+    deadline on the timer wheel as soon as its last listener leaves. The
+    deadline is dropped if somebody comes back before it fires."""
+
+    def __init__(self, bot: discord.Client, idle_timeout: float):
+        self.bot = bot
+        self.idle_timeout = idle_timeout
+        self.listeners: Dict[int, int] = {}
+        self.wheel = TimerWheel(bot.loop)
+
+    @staticmethod
+    def count_listeners(channel: discord.VoiceChannel) -> int:
+        return sum(1 for member in channel.members if not member.bot)
+
+    async def on_voice_state_update(self, member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+        if before.channel == after.channel:
+            # mute, deafen and the like
+            return
+
+        if member.id == self.bot.user.id:
+            if after.channel is not None:
+                # the bot just joined, what happened in there before was not seen
+                self.listeners[after.channel.id] = self.count_listeners(after.channel)
+                self.check(after.channel)
+            if before.channel is not None:
+                self.wheel.cancel(before.channel.id)
+            return
+        if member.bot:
+            return
+
+        if before.channel is not None:
+            self.listeners[before.channel.id] = max(0, self.listeners.get(before.channel.id, 1) - 1)
+            self.check(before.channel)
+        if after.channel is not None:
+            self.listeners[after.channel.id] = self.listeners.get(after.channel.id, 0) + 1
+            self.check(after.channel)
+
+    def check(self, channel: discord.VoiceChannel):
+        voice_client: discord.VoiceClient = channel.guild.voice_client
+        if voice_client is None or voice_client.channel != channel:
+            self.wheel.cancel(channel.id)
+            return
+
+        if self.listeners.get(channel.id, 0) == 0:
+            if not self.wheel.is_scheduled(channel.id):
+                self.wheel.schedule(channel.id, self.idle_timeout, lambda: self.bot.loop.create_task(self.leave(channel)))
+        else:
+            self.wheel.cancel(channel.id)
+
+    async def leave(self, channel: discord.VoiceChannel):
+        voice_client: discord.VoiceClient = channel.guild.voice_client
+        if voice_client is None or voice_client.channel != channel or self.listeners.get(channel.id, 0) > 0:
+            return
+
+        # the players know where their commands came from
+        discord_ctx = getattr(voice_client.source, "discord_ctx", None)
+        voice_client.stop()
+        await voice_client.disconnect()
+        if discord_ctx is not None:
+            await discord_ctx.send("Disconnecting due to there is nobody in the VC")